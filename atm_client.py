@@ -2,8 +2,13 @@
 #
 # Automated Teller Machine (ATM) client application.
 
+import select
 import socket
 import re
+import time
+
+BUSY_RETRIES = 3        # times a request the server is too busy for ("060 <ms>") is sent again before giving up
+MAX_BUSY_WAIT = 5000    # longest wait, in milliseconds, before sending a refused request again
 
 ##########################################################
 #                                                        #
@@ -13,21 +18,91 @@ import re
 #                                                        #
 ##########################################################
 
+def frame_msg(msg):
+    """ Encode the string msg as a single frame: its length in bytes, a colon, then the message itself. """
+    payload = msg.encode('utf-8')
+    return str(len(payload)).encode('ascii') + b":" + payload
+
+def recv_exact(sock, count):
+    """ Receive exactly count bytes from the server. Raises ConnectionError if the server hangs up first. """
+    buf = bytearray()
+    while len(buf) < count:
+        chunk = sock.recv(count - len(buf))
+        if not chunk:
+            raise ConnectionError("connection closed by bank server")
+        buf += chunk
+    return bytes(buf)
+
 def send_to_server(sock, msg):
     """ Given an open socket connection (sock) and a string msg, send the string to the server. """
-    return sock.send(msg.encode('utf-8'))
+    return sock.sendall(frame_msg(msg))
 
 def get_from_server(sock):
     """ Attempt to receive a message from the active connection. Block until message is received. """
-    msg = sock.recv(1024)
-    return msg.decode('utf-8')
+    # read the length prefix one byte at a time up to the colon, then the message body in one go
+    length_field = b""
+    while True:
+        byte = recv_exact(sock, 1)
+        if byte == b":":
+            break
+        length_field += byte
+    return recv_exact(sock, int(length_field)).decode('utf-8')
+
+def send_pipelined(sock, msgs):
+    """ Send several messages to the server in a single write and return the server's replies, in the same order. """
+    sock.sendall(b"".join(frame_msg(msg) for msg in msgs))
+    return [get_from_server(sock) for _ in msgs]
+
+def is_busy(reply):
+    """ Return True if reply says the server is too busy to carry out the request right now ("060 <ms>"). """
+    return reply.split(" ")[0] == "060"
+
+def send_request(sock, msg, cache = None):
+    """ Send msg and return the server's reply, applying the balance pushes that arrive before it to cache, if given.
+    While the server answers that it is busy, wait the time it asks for and send msg again, up to BUSY_RETRIES times;
+    if it is still busy after that, the busy reply is returned. """
+    for attempt in range(BUSY_RETRIES + 1):
+        send_to_server(sock, msg)
+        reply = get_reply(sock, cache) if cache is not None else get_from_server(sock)
+        if not is_busy(reply) or attempt == BUSY_RETRIES:
+            return reply
+        delay = reply.partition(" ")[2]
+        time.sleep(min(int(delay) if delay.isdigit() else 0, MAX_BUSY_WAIT) / 1000)
 
 def login_to_server(sock, acct_num, pin):
-    """ Attempt to login to the bank server. Pass acct_num and pin, get response, parse and check whether login was successful. """
+    """ Attempt to login to the bank server. Pass acct_num and pin, get response, parse and check whether login was successful.
+    Returns the result code and, after a successful login (040), the account's starting balance (otherwise None). """
     account_info = "LOG" + " " + str(acct_num) + " " + str(pin) 
-    send_to_server(sock, account_info)
-    validated = (get_from_server(sock))
-    return validated
+    validated, _, bal = send_request(sock, account_info).partition(" ")
+    return validated, (bal or None)
+
+class CachedBalance:
+    """ The client's copy of the account balance. It starts with the balance sent at login and is kept current by
+    the new balance in every transaction reply and, while watching, by the balances the server pushes. """
+
+    def __init__(self, balance):
+        self.balance = balance
+
+def get_reply(sock, cache):
+    """ Receive the reply to the last request, applying any balance pushes (070) that arrive before it. """
+    while True:
+        msg = get_from_server(sock)
+        if not msg.startswith("070 "):
+            return msg
+        cache.balance = msg[4:]
+
+def apply_pushes(sock, cache):
+    """ Apply the balance pushes that arrived while the customer was idle, without waiting for more. """
+    while select.select([sock], [], [], 0)[0]:
+        msg = get_from_server(sock)
+        if msg.startswith("070 "):
+            cache.balance = msg[4:]
+
+def watch_balance(sock, cache):
+    """ Subscribe to balance pushes so the cached balance follows changes made from elsewhere (e.g. transfers in). """
+    reply = send_request(sock, "WATCH", cache)
+    if not is_busy(reply):
+        cache.balance = reply
 
 def get_login_info():
     """ Get info from customer. Validates inputs, ask again if given invalid input. """
@@ -52,20 +127,22 @@ def get_login_info():
     return acct_num, pin
 
 
-def process_deposit(sock):
+def process_deposit(sock, cache):
     """ Sends client input of deposit amount to server and receives the return value."""
 
     request_code = "DEP"
-    bal = get_acct_balance(sock)
     while True:
-        amt = (input(f"How much would you like to deposit? (You have ${bal} available) "))
+        amt = (input(f"How much would you like to deposit? (You have ${cache.balance} available) "))
         msg = request_code + " " + amt
-        send_to_server(sock, msg)
-        new_bal = get_from_server(sock)
+        new_bal = send_request(sock, msg, cache)
         if (new_bal == "030"):
             print("Incorrect format entered.")
             continue
+        elif is_busy(new_bal):
+            print("The bank is busy right now. Please try again later.")
+            break
         else:
+            cache.balance = new_bal
             print("Deposit transaction completed.")
             print(f"Your balance is: ${round(float(new_bal), 2)}")
             break
@@ -77,61 +154,103 @@ def get_acct_balance(sock):
     bal = get_from_server(sock);
     return bal
 
-def process_withdrawal(sock):
+def process_withdrawal(sock, cache):
     """ Sends client input of withdrawal amount to server and receives the return value."""
     request_code = "WD"
-    bal = get_acct_balance(sock)
     while True:
-        amt = (input(f"How much would you like to withdraw? (You have ${bal} available) "))
+        amt = (input(f"How much would you like to withdraw? (You have ${cache.balance} available) "))
         msg = request_code + " " + amt
-        send_to_server(sock, msg)
-        new_bal = get_from_server(sock)
+        new_bal = send_request(sock, msg, cache)
         if (new_bal == "030"):
             print("Incorrect format entered.")
             continue
         elif (new_bal == "031"):
             print("Insufficient Funds.")
             break
+        elif is_busy(new_bal):
+            print("The bank is busy right now. Please try again later.")
+            break
         else: 
+            cache.balance = new_bal
             print("Withdrawal transaction completed.")
             print(f"Your balance is: ${round(float(new_bal), 2)}")
             break
     return 
 
-def process_customer_transactions(sock):
+def process_transfer(sock, cache):
+    """ Sends a transfer of client input amount to another account and receives the return value."""
+    request_code = "TRANSFER"
+    while True:
+        to_acct = input("Which account would you like to transfer to? ")
+        amt = input("How much would you like to transfer? ")
+        msg = request_code + " " + to_acct + " " + amt
+        new_bal = send_request(sock, msg, cache)
+        if (new_bal == "030"):
+            print("Incorrect format entered.")
+            continue
+        elif (new_bal == "031"):
+            print("Insufficient Funds.")
+        elif (new_bal in ("032", "033", "050")):
+            print("That account cannot receive transfers.")
+        elif is_busy(new_bal):
+            print("The bank is busy right now. Please try again later.")
+        else:
+            cache.balance = new_bal
+            print("Transfer completed.")
+            print(f"Your balance is: ${round(float(new_bal), 2)}")
+        break
+
+def send_batch(sock, ops):
+    """ Send several DEP/WD/TRANSFER operations as one all-or-nothing BATCH request.
+    Returns whether the batch was applied, the result code of each operation and the resulting balance. """
+    reply = send_request(sock, "BATCH " + ";".join(ops)).split(" ")
+    if len(reply) != len(ops) + 2:
+        # malformed batch (e.g. 050), or the server stayed busy
+        return False, reply, None
+    return reply[0] == "020", reply[1:-1], float(reply[-1])
+
+def process_customer_transactions(sock, cache):
     """ Ask customer for a transaction, communicate with server."""
+    watch_balance(sock, cache)
     while True:
-        print("Select a transaction. Enter 'd' to deposit, 'w' to withdraw, or 'b' to get balance, or 'x' to exit.")
+        print("Select a transaction. Enter 'd' to deposit, 'w' to withdraw, 't' to transfer, or 'b' to get balance, or 'x' to exit.")
         req = input("Your choice? ").lower()
-        if req not in ('d', 'w', 'x', 'b'):
+        if req not in ('d', 'w', 't', 'x', 'b'):
             print("Unrecognized choice, please try again.")
             continue
         if req == 'x':
             # if customer wants to exit, break out of the loop
             send_to_server(sock, "EXIT")
             break
-        elif req == 'd':
-            process_deposit(sock)
+        # Pick up transfers into the account that happened while the customer was choosing
+        apply_pushes(sock, cache)
+        if req == 'd':
+            process_deposit(sock, cache)
+
+        elif req == 't':
+            process_transfer(sock, cache)
 
         elif req == 'b':
-            bal = (get_acct_balance(sock))
-            print(f"Your balance is: ${round(float(bal), 2)}")
+            print(f"Your balance is: ${round(float(cache.balance), 2)}")
         else:
-            process_withdrawal(sock)
+            process_withdrawal(sock, cache)
 
 def run_atm_core_loop(sock):
     """ Given an active network connection to the bank server, run the core business loop. """
     while True:
         acct_num, pin = get_login_info()
-        validated = login_to_server(sock, acct_num, pin)
+        validated, bal = login_to_server(sock, acct_num, pin)
         if validated == "040":
             print("Thank you, your credentials have been validated.")
-            process_customer_transactions(sock)
+            process_customer_transactions(sock, CachedBalance(bal))
             print("ATM session terminating.")
             return True
         elif validated == "041":
             print("Account number and PIN do not match. Retry login.")
             continue
+        elif validated == "060":
+            print("The bank is busy right now. Please try to log in again in a moment.")
+            continue
         elif validated == "043":
             print("Account doesn't exist. Retry login.")
             continue
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# ATM load generator
+#
+# Drives many simulated ATM sessions against a running bank server using the same protocol
+# functions as the interactive client (login_to_server, get_acct_balance, send_to_server and
+# get_from_server), and reports per-command throughput and latency percentiles.
+#
+# Example: 2000 sessions over 4 processes for 30 seconds, mostly balance checks, 50 ms mean think time:
+#
+#     python3 atm_loadgen.py --accounts accounts.txt --sessions 2000 --processes 4 --duration 30 \
+#         --mix BAL=60,DEP=20,WD=20 --think-ms 50 --output run.json
+#
+# A server whose account file has hashed PINs (see bank_pins.py) needs the plain PINs to log in with:
+#
+#     python3 atm_loadgen.py --accounts hashed.txt --pins accounts.txt
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import socket
+import sys
+import threading
+import time
+
+import atm_client
+import bank_accountfile
+import bank_pins
+
+
+HISTOGRAM_GROWTH = 1.02     # each histogram bucket is 2% wider than the one before
+THREAD_STACK_SIZE = 256 * 1024
+
+
+class LatencyHistogram:
+    """ A log-bucketed latency histogram with 2% resolution that can be merged across threads and processes. """
+
+    def __init__(self, buckets = None):
+        """ Create an empty histogram, or rebuild one from the buckets of another. """
+        self.buckets = dict(buckets or {})
+
+    def record(self, seconds):
+        """ Add one latency sample. """
+        index = int(math.log(max(seconds * 1e6, 1.0), HISTOGRAM_GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        """ Add every sample of other to this histogram. """
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def count(self):
+        return sum(self.buckets.values())
+
+    def percentile_ms(self, fraction):
+        """ Return the upper bound, in milliseconds, of the bucket holding the given fraction of samples. """
+        target = fraction * self.count()
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return HISTOGRAM_GROWTH ** (index + 1) / 1000
+        return 0.0
+
+    def to_json(self):
+        """ Return the non-empty buckets as {upper bound in ms: count}. """
+        return {f"{HISTOGRAM_GROWTH ** (index + 1) / 1000:.4f}": self.buckets[index] for index in sorted(self.buckets)}
+
+class CommandStats:
+    """ Latency histogram and reply tallies for one request code. """
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.replies = {}
+
+    def record(self, seconds, reply):
+        """ Add one request: its latency and its reply (a result code, or 'balance' for a balance value). """
+        self.histogram.record(seconds)
+        if reply.startswith("060 "):
+            # Busy; the retry delay that follows the code varies
+            kind = "060"
+        else:
+            kind = reply if reply.isdigit() and len(reply) == 3 else "balance"
+        self.replies[kind] = self.replies.get(kind, 0) + 1
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        for kind, count in other.replies.items():
+            self.replies[kind] = self.replies.get(kind, 0) + count
+
+##########################################################
+#                                                        #
+# Simulated ATM Sessions                                 #
+#                                                        #
+##########################################################
+
+def run_request(sock, command, amount):
+    """ Perform one request with the interactive client's protocol functions and return the server's reply. """
+    if command == "BAL":
+        return atm_client.get_acct_balance(sock)
+    atm_client.send_to_server(sock, f"{command} {amount}")
+    return atm_client.get_from_server(sock)
+
+def run_session(address, acct_num, pin, config, deadline, stats, failures):
+    """ One simulated customer: log in, then issue requests drawn from the mix until the deadline, pausing for an
+    exponentially distributed think time between them. Records into stats (a dict of CommandStats). """
+    commands, weights = zip(*config["mix"].items())
+    rng = random.Random()
+    think_mean = config["think_ms"] / 1000
+    try:
+        with socket.create_connection(address) as sock:
+            start = time.perf_counter()
+            reply, _ = atm_client.login_to_server(sock, acct_num, pin)
+            stats.setdefault("LOG", CommandStats()).record(time.perf_counter() - start, reply)
+            if reply != "040":
+                return
+            while time.perf_counter() < deadline:
+                if think_mean:
+                    time.sleep(rng.expovariate(1 / think_mean))
+                command = rng.choices(commands, weights)[0]
+                start = time.perf_counter()
+                reply = run_request(sock, command, config["amount"])
+                stats.setdefault(command, CommandStats()).record(time.perf_counter() - start, reply)
+            atm_client.send_to_server(sock, "EXIT")
+    except OSError:
+        failures.append(acct_num)
+
+def run_process(address, accounts, config):
+    """ Run one thread per (acct_num, pin) in accounts until the configured duration is over.
+    Returns the merged per-command stats as plain data, and the number of failed sessions. """
+    threading.stack_size(THREAD_STACK_SIZE)
+    deadline = time.perf_counter() + config["duration"]
+    per_thread = [dict() for _ in accounts]
+    failures = []
+    threads = [threading.Thread(target=run_session, args=(address, acct_num, pin, config, deadline, stats, failures))
+               for (acct_num, pin), stats in zip(accounts, per_thread)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    merged = {}
+    for stats in per_thread:
+        for command, command_stats in stats.items():
+            merged.setdefault(command, CommandStats()).merge(command_stats)
+    return {command: (s.histogram.buckets, s.replies) for command, s in merged.items()}, len(failures)
+
+##########################################################
+#                                                        #
+# Reporting                                              #
+#                                                        #
+##########################################################
+
+def summarize(merged, failures, config, elapsed):
+    """ Build the machine-readable report. Rates are per second of the configured run time, the window in which
+    requests are issued; elapsed also covers connection setup and shutdown. """
+    report = {"config": config, "elapsed_sec": round(elapsed, 3), "failed_sessions": failures, "commands": {}}
+    for command in sorted(merged):
+        stats = merged[command]
+        histogram = stats.histogram
+        report["commands"][command] = {
+            "count": histogram.count(),
+            "per_sec": round(histogram.count() / config["duration"], 1),
+            "p50_ms": round(histogram.percentile_ms(0.50), 3),
+            "p99_ms": round(histogram.percentile_ms(0.99), 3),
+            "p999_ms": round(histogram.percentile_ms(0.999), 3),
+            "replies": stats.replies,
+            "histogram_ms": histogram.to_json(),
+        }
+    return report
+
+def print_table(report):
+    """ Print a human-readable summary of the report. """
+    print(f"{'command':>8} {'count':>9} {'per sec':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8}  replies")
+    for command, row in report["commands"].items():
+        print(f"{command:>8} {row['count']:>9} {row['per_sec']:>9} {row['p50_ms']:>8} {row['p99_ms']:>8} "
+              f"{row['p999_ms']:>8}  {row['replies']}")
+    print(f"failed sessions: {report['failed_sessions']}")
+
+##########################################################
+#                                                        #
+# Load Generator Startup Operations                      #
+#                                                        #
+##########################################################
+
+def parse_mix(text):
+    """ Parse an operation mix such as 'BAL=60,DEP=20,WD=20' into {command: weight}. """
+    mix = {}
+    for part in text.split(","):
+        command, _, weight = part.partition("=")
+        if command not in ("BAL", "DEP", "WD"):
+            raise argparse.ArgumentTypeError(f"unknown command in mix: {command}")
+        mix[command] = float(weight)
+    return mix
+
+def parse_args(argv):
+    """ Parse the load generator's command line options. """
+    parser = argparse.ArgumentParser(description="ATM load generator")
+    parser.add_argument("--host", default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument("--port", type=int, default=65432)
+    parser.add_argument("--accounts", default="accounts.txt", help="account file supplying account numbers and PINs")
+    parser.add_argument("--pins", help="account file with the plain PINs of accounts whose PINs are hashed")
+    parser.add_argument("--sessions", type=int, default=100, help="concurrent ATM sessions (at most one per account)")
+    parser.add_argument("--processes", type=int, default=1, help="processes to spread the sessions over")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("BAL=50,DEP=25,WD=25"), help="weighted request mix")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean think time between requests")
+    parser.add_argument("--amount", type=int, default=1, help="whole-dollar DEP/WD amount")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+def session_accounts(acct_file, pin_file, count):
+    """ Return up to count (acct_num, PIN) pairs to log in with, from acct_file. A hashed PIN cannot be sent, so the
+    plain PIN comes from pin_file; exits with an error if there is none. """
+    accounts = [(acct_num, pin) for acct_num, pin, _ in bank_accountfile.read_account_file(acct_file)][:count]
+    hashed = [acct_num for acct_num, pin in accounts if bank_pins.is_pin_hash(pin)]
+    if not hashed:
+        return accounts
+    plain = dict()
+    if pin_file is not None:
+        plain = {acct_num: pin for acct_num, pin, _ in bank_accountfile.read_account_file(pin_file)
+                 if not bank_pins.is_pin_hash(pin)}
+    missing = [acct_num for acct_num in hashed if acct_num not in plain]
+    if missing:
+        sys.exit(f"{acct_file} holds hashed PINs, which cannot be used to log in; give the plain PINs of "
+                 f"{len(missing)} accounts, {missing[0]} first, with --pins")
+    return [(acct_num, plain[acct_num] if bank_pins.is_pin_hash(pin) else pin) for acct_num, pin in accounts]
+
+def main(argv):
+    args = parse_args(argv)
+    accounts = session_accounts(args.accounts, args.pins, args.sessions)
+    if len(accounts) < args.sessions:
+        print(f"only {len(accounts)} accounts available; running that many sessions", file=sys.stderr)
+    config = {"sessions": len(accounts), "processes": args.processes, "duration": args.duration, "mix": args.mix,
+              "think_ms": args.think_ms, "amount": args.amount}
+    chunks = [accounts[i::args.processes] for i in range(args.processes)]
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.starmap(run_process, [((args.host, args.port), chunk, config) for chunk in chunks])
+    elapsed = time.perf_counter() - start
+    merged = {}
+    for stats, _ in results:
+        for command, (buckets, replies) in stats.items():
+            command_stats = CommandStats()
+            command_stats.histogram = LatencyHistogram(buckets)
+            command_stats.replies = replies
+            merged.setdefault(command, CommandStats()).merge(command_stats)
+    report = summarize(merged, sum(failed for _, failed in results), config, elapsed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print_table(report)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
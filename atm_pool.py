@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+#
+# Pooled ATM client library
+#
+# For ATM concentrators that front many terminals: instead of one socket per terminal, an ATMPool keeps
+# a few persistent framed connections to the bank server and multiplexes hundreds of logical ATM
+# sessions over them. Every request of a logical session is tagged with its session id ("@sid request",
+# see abnf.txt) and the server tags the reply the same way, so replies for different sessions can share
+# a connection and still find their way back.
+#
+#     pool = ATMPool(("10.0.0.5", 65432), size=4)
+#     atm = pool.open_session()
+#     if atm.login("ac-12345", "1324").startswith("040"):
+#         print(atm.deposit(20), atm.balance())
+#     atm.close()
+#     pool.close()
+#
+# A logical session issues one request at a time, like an ATM; different sessions, and different
+# threads, may use the pool concurrently. submit() returns a concurrent.futures.Future for callers that
+# want several sessions in flight from one thread.
+
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import atm_client
+
+
+RECV_SIZE = 65536           # bytes read from the server per recv
+MAX_SESSION_ID = 10 ** 9    # session ids wrap around before they outgrow the server's 9-digit limit
+SESSIONS_PER_CONNECTION = 256   # the server's limit on logical sessions per connection (MAX_CHANNELS)
+BUSY_RETRIES = 3            # times a request answered busy (060) is sent again before the busy reply is returned
+
+
+class PooledConnection:
+    """ One persistent connection of an ATMPool. A reader thread matches each tagged reply to the oldest
+    request still waiting for a reply on the same session id. """
+
+    def __init__(self, address):
+        """ Connect to the bank server at address and start reading replies. """
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.waiting = dict()       # session id -> list of Futures, oldest first
+        self.watchers = dict()      # session id -> ATMSession receiving balance pushes
+        self.sessions = 0           # logical sessions currently open on this connection
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+
+    def submit(self, sid, msg, expect_reply = True):
+        """ Send msg on behalf of session sid. Returns a Future for the reply (None if expect_reply is False). """
+        future = Future() if expect_reply else None
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionError("connection to bank server is closed")
+            if future is not None:
+                self.waiting.setdefault(sid, []).append(future)
+            atm_client.send_to_server(self.sock, f"@{sid} {msg}")
+        return future
+
+    def read_replies(self):
+        """ Reader thread body: split the byte stream into frames and resolve the matching Futures. """
+        buf = bytearray()
+        try:
+            while True:
+                chunk = self.sock.recv(RECV_SIZE)
+                if not chunk:
+                    raise ConnectionError("connection closed by bank server")
+                buf += chunk
+                for reply in split_frames(buf):
+                    self.deliver(reply)
+        except (OSError, ValueError) as e:
+            self.fail(e if isinstance(e, ConnectionError) else ConnectionError(str(e)))
+
+    def deliver(self, reply):
+        """ Resolve the oldest Future waiting on the session the reply is tagged with, or hand a balance push
+        (070) to the session watching its balance. """
+        tag, _, body = reply.partition(" ")
+        if not tag.startswith("@"):
+            # Only a rogue or malformed request gets an untagged reply, and the server hangs up after it
+            raise ConnectionError(f"bank server rejected the connection ({reply})")
+        if body.startswith("070 "):
+            atm = self.watchers.get(tag[1:])
+            if atm is not None:
+                atm.balance_pushed(body[4:])
+            return
+        with self.send_lock:
+            futures = self.waiting.get(tag[1:])
+            if not futures:
+                return
+            future = futures.pop(0)
+            if not futures:
+                del self.waiting[tag[1:]]
+        future.set_result(body)
+
+    def fail(self, error):
+        """ Mark the connection dead and fail every request still waiting for a reply. """
+        with self.send_lock:
+            self.closed = True
+            waiting, self.waiting = self.waiting, dict()
+        for futures in waiting.values():
+            for future in futures:
+                future.set_exception(error)
+        self.sock.close()
+
+    def close(self):
+        """ Close the connection; the server logs out every session still open on it. """
+        with self.send_lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.join()
+
+def split_frames(buf):
+    """ Remove every complete frame from buf and return the payloads as strings. Raises ValueError on a bad frame. """
+    payloads = []
+    pos = 0
+    while True:
+        sep = buf.find(b":", pos)
+        if sep == -1:
+            break
+        if not buf[pos:sep].isdigit():
+            raise ValueError("bad frame from bank server")
+        end = sep + 1 + int(buf[pos:sep])
+        if end > len(buf):
+            break
+        payloads.append(buf[sep + 1:end].decode("utf-8"))
+        pos = end
+    del buf[:pos]
+    return payloads
+
+class ATMSession:
+    """ One logical ATM session on a pooled connection. Its methods mirror the interactive client's requests
+    and return the server's reply string: a result code or a balance. """
+
+    def __init__(self, pool, conn, sid):
+        self.pool = pool
+        self.conn = conn
+        self.sid = sid
+        self.cached_balance = None
+        self.on_balance = None
+
+    def submit(self, msg):
+        """ Send one request and return a Future for its reply. """
+        return self.conn.submit(self.sid, msg)
+
+    def request(self, msg, timeout = None):
+        """ Send one request and wait for its reply. A busy reply (060) means the server did not carry the request
+        out, so it is sent again after the delay the server asked for, up to BUSY_RETRIES times. """
+        for _ in range(BUSY_RETRIES):
+            reply = self.submit(msg).result(timeout)
+            if not reply.startswith("060 "):
+                return reply
+            time.sleep(int(reply[4:]) / 1000)
+        return self.submit(msg).result(timeout)
+
+    def login(self, acct_num, pin):
+        """ Log in; a successful reply is 040 followed by the starting balance. """
+        reply = self.request(f"LOG {acct_num} {pin}")
+        if reply.startswith("040 "):
+            self.cached_balance = reply[4:]
+        return reply
+
+    def balance(self):
+        return self.request("BAL")
+
+    def deposit(self, amount):
+        return self.request(f"DEP {amount}")
+
+    def withdraw(self, amount):
+        return self.request(f"WD {amount}")
+
+    def transfer(self, acct_num, amount):
+        return self.request(f"TRANSFER {acct_num} {amount}")
+
+    def watch(self, on_balance = None):
+        """ Ask the server to push this account's balance whenever another session changes it. cached_balance
+        then stays current without BAL requests, and on_balance(balance) is called from the reader thread
+        for every push. Returns the current balance. """
+        self.on_balance = on_balance
+        self.conn.watchers[self.sid] = self
+        self.cached_balance = self.request("WATCH")
+        return self.cached_balance
+
+    def balance_pushed(self, balance):
+        """ Called by the connection's reader thread with a balance pushed by the server. """
+        self.cached_balance = balance
+        if self.on_balance is not None:
+            self.on_balance(balance)
+
+    def batch(self, ops):
+        """ Send DEP/WD/TRANSFER operations as one all-or-nothing BATCH; see atm_client.send_batch for the reply. """
+        return self.request("BATCH " + ";".join(ops))
+
+    def close(self):
+        """ Log out and end the session. The connection stays open for the pool's other sessions. """
+        if self.conn is None:
+            return
+        self.conn.watchers.pop(self.sid, None)
+        try:
+            self.conn.submit(self.sid, "EXIT", expect_reply=False)
+        except OSError:
+            pass
+        self.pool.release(self)
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ATMPool:
+    """ A fixed-size pool of persistent connections to one bank server, shared by up to
+    SESSIONS_PER_CONNECTION logical sessions per connection. """
+
+    def __init__(self, address, size = 4):
+        """ address is the server's (host, port); connections are opened as sessions first need them. """
+        self.address = address
+        self.size = size
+        self.conns = []
+        self.lock = threading.Lock()
+        self.sids = itertools.count(1)
+
+    def open_session(self):
+        """ Return a new ATMSession on the least loaded live connection, replacing connections that have died.
+        Raises RuntimeError if every connection already carries as many sessions as the server allows. """
+        with self.lock:
+            self.conns = [conn for conn in self.conns if not conn.closed]
+            if len(self.conns) < self.size:
+                self.conns.append(PooledConnection(self.address))
+            conn = min(self.conns, key=lambda c: c.sessions)
+            if conn.sessions >= SESSIONS_PER_CONNECTION:
+                raise RuntimeError(f"all {self.size} pooled connections are full")
+            conn.sessions += 1
+            sid = str(next(self.sids) % MAX_SESSION_ID)
+        return ATMSession(self, conn, sid)
+
+    def release(self, atm):
+        """ Forget a session that has been closed. """
+        with self.lock:
+            atm.conn.sessions -= 1
+
+    def close(self):
+        """ Close every connection. Sessions still open are logged out by the server. """
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for conn in conns:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#
+# Bank Server account file
+#
+# The text account file lists one account per line as account number, PIN and balance, separated by
+# commas; lines starting with "#" are comments. These are the rules for reading it: the validators the
+# server applies to account numbers and PINs, and the parser the snapshot converter, hot reload and the
+# load generator read the file with. Like bank_pins.py and bank_store.py, it imports nothing from the
+# server, so any of them can use it.
+
+import bank_pins
+import bank_store
+
+
+def acctNumberIsValid(ac_num):
+    """Return True if ac_num represents a valid account number. This does NOT test whether the account actually exists, only
+    whether the value of ac_num is properly formatted to be used as an account number.  A valid account number must be a string,
+    lenth = 8, and match the format AA-NNNNN where AA are two alphabetic characters and NNNNN are five numeric characters."""
+    return isinstance(ac_num, str) and \
+        len(ac_num) == 8 and \
+        ac_num[2] == '-' and \
+        ac_num[:2].isalpha() and \
+        ac_num[3:8].isdigit()
+
+def acctPinIsValid(pin):
+    """Return True if pin represents a valid PIN number. A valid PIN number is a four-character string of only numeric characters."""
+    return (isinstance(pin, str) and \
+        len(pin) == 4 and \
+        pin.isdigit())
+
+def pinIsStorable(pin):
+    """Return True if pin can be kept as an account's PIN: a valid PIN number, or a PIN hash (see bank_pins.py)."""
+    return acctPinIsValid(pin) or (isinstance(pin, str) and bank_pins.is_pin_hash(pin))
+
+def read_account_file(acct_file):
+    """ Yield (acct_num, pin, cents) for every valid, non-duplicate line of a text account file, using the same
+    rules as the server's text loader. A balance that is not a number, or does not fit bank_store.MAX_CENTS, makes
+    the line invalid. """
+    seen = set()
+    with open(acct_file, "r") as f:
+        for line in f:
+            if line[0] == "#":
+                continue
+            acct_data = line.lower().replace(" ", "").rstrip("\n").split(',')
+            if len(acct_data) != 3 or not acctNumberIsValid(acct_data[0]) or acct_data[0] in seen:
+                continue
+            try:
+                cents = round(float(acct_data[2]) * 100)
+            except (ValueError, OverflowError):
+                # not a number, or infinite
+                continue
+            if abs(cents) > bank_store.MAX_CENTS:
+                continue
+            seen.add(acct_data[0])
+            yield acct_data[0], acct_data[1] if pinIsStorable(acct_data[1]) else "", cents
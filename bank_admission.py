@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Bank Server admission control
+#
+# Every request is admitted before any work is done for it. Token buckets limit the request rate of
+# each peer address, however many connections it opens, and of each account, however many addresses
+# it is used from (which also slows down PIN guessing). A bucket holds up to burst tokens and refills
+# at rate tokens per second; a request takes one. On top of that, the loop lag (how long a ready
+# request waits for the event loop to get to it) is kept as a moving average, and while it is above
+# the overload threshold every request is turned away until the loop has caught up.
+#
+# A request that is not admitted is answered "060 <ms>": busy, retry after ms milliseconds. It has not
+# been carried out, so the client may simply send it again. Buckets that have refilled are forgotten,
+# so the tables only hold the clients that are busy right now.
+
+import math
+
+
+LAG_SMOOTHING = 0.2     # weight of the newest sample in the loop lag average
+SWEEP_MIN = 1024        # buckets a table may hold before the refilled ones are swept out
+
+
+class TokenBucket:
+    """ The tokens left in one bucket, as of time stamp. """
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+class BucketTable:
+    """ The token buckets of one kind of key (peer addresses or accounts), sharing a rate and a burst size. """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = dict()
+        self.sweep_at = SWEEP_MIN
+        self.shed = 0           # requests turned away for lack of a token
+
+    def take(self, key, now):
+        """ Take a token from key's bucket. Returns 0.0 if there was one, else the seconds until there will be. """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.sweep_at:
+                self.sweep(now)
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+        else:
+            tokens = bucket.tokens + (now - bucket.stamp) * self.rate
+            bucket.tokens = tokens if tokens < self.burst else self.burst
+            bucket.stamp = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+        self.shed += 1
+        return (1 - bucket.tokens) / self.rate
+
+    def sweep(self, now):
+        """ Forget the buckets that have refilled, which behave exactly like new ones. """
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if bucket.tokens + (now - bucket.stamp) * self.rate < self.burst}
+        self.sweep_at = max(SWEEP_MIN, 2 * len(self.buckets))
+
+    def report(self):
+        return {"rate": self.rate, "burst": self.burst, "tracked": len(self.buckets), "shed": self.shed}
+
+class Admission:
+    """ Decides whether each request goes ahead: per-peer and per-account token buckets and the loop lag. """
+
+    def __init__(self, peer_rate = 0.0, peer_burst = None, account_rate = 0.0, account_burst = None,
+                 overload_lag = 0.0):
+        """ Rates are in requests per second and 0 means no limit; a burst of None allows one second's worth of
+        requests at once. overload_lag is the loop lag, in seconds, above which requests are turned away; 0 never. """
+        self.peers = BucketTable(peer_rate, peer_burst or max(peer_rate, 1)) if peer_rate > 0 else None
+        self.accounts = BucketTable(account_rate, account_burst or max(account_rate, 1)) if account_rate > 0 else None
+        self.overload_lag = overload_lag
+        self.lag = 0.0
+        self.shed_overload = 0  # requests turned away while the loop was lagging
+
+    def record_lag(self, seconds):
+        """ Add one loop lag sample to the moving average. """
+        self.lag += LAG_SMOOTHING * (seconds - self.lag)
+
+    def overloaded(self):
+        return 0 < self.overload_lag < self.lag
+
+    def admit(self, peer, acct_num, now):
+        """ Decide on a request from peer address peer, for account acct_num (None if it names none).
+        Returns 0 if it may go ahead, else the whole milliseconds after which it may be tried again. """
+        if self.overload_lag and self.lag > self.overload_lag:
+            self.shed_overload += 1
+            wait = self.lag
+        else:
+            wait = self.peers.take(peer, now) if self.peers is not None else 0.0
+            if not wait and acct_num is not None and self.accounts is not None:
+                wait = self.accounts.take(acct_num, now)
+        return max(math.ceil(wait * 1000), 1) if wait else 0
+
+    def report(self):
+        """ Return the limits and what they have turned away, as plain data. """
+        return {
+            "peer": self.peers.report() if self.peers is not None else None,
+            "account": self.accounts.report() if self.accounts is not None else None,
+            "overload": {"lag_ms": round(self.lag * 1000, 3), "threshold_ms": round(self.overload_lag * 1000, 3),
+                         "overloaded": self.overloaded(), "shed": self.shed_overload},
+        }
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+#
+# Bank Server asyncio engine
+#
+# An alternative to the selectors loop in bank_server.run_network_server(), selected with
+# --engine asyncio. It speaks the same protocol and reuses the same account core, sessions and
+# request handlers; only the connection handling differs. Transports buffer outgoing data, and a
+# client that stops reading its replies is paused once its buffer passes WRITE_HIGH_WATER, so one
+# slow ATM cannot make the server queue unbounded work. uvloop is used when it is installed.
+
+import asyncio
+import functools
+import time
+
+import bank_metrics
+import bank_server
+import bank_trace
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+WRITE_HIGH_WATER = 65536    # pause reading from a client once this many reply bytes are buffered for it
+WRITE_LOW_WATER = 16384     # resume reading once the buffer drains below this
+LAG_PROBE_INTERVAL = 0.05   # seconds between loop lag samples for admission control
+
+
+class BankProtocol(asyncio.Protocol):
+    """ One ATM client connection. Requests are processed as soon as they arrive; replies are written once the
+    journal batch they belong to is durable (see flush_pending). """
+
+    def connection_made(self, transport):
+        """ Create the session for a new connection and set the backpressure limits, or turn the connection away
+        if the server is at its connection limit. """
+        self.transport = transport
+        if bank_server.max_connections and len(bank_server.sessions) >= bank_server.max_connections:
+            bank_server.metrics.refused += 1
+            self.session = None
+            transport.abort()
+            return
+        self.session = bank_server.Session(transport.get_extra_info("socket"), transport.get_extra_info("peername"))
+        bank_server.sessions.add(self.session)
+        bank_server.metrics.accepted += 1
+        protocols[self.session] = self
+        transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+        if bank_server.capture is not None:
+            bank_server.capture.record(self.session.conn_id, bank_trace.OPEN)
+
+    def data_received(self, data):
+        """ Buffer the bytes, process every complete request and schedule the replies. """
+        session = self.session
+        if session.closing:
+            return
+        started = time.perf_counter()
+        if bank_server.capture is not None:
+            bank_server.capture.record(session.conn_id, bank_trace.IN, data)
+        session.inb += data
+        session.last_active = time.monotonic()
+        self.process_buffered(started)
+
+    def process_buffered(self, started = None):
+        """ Process every complete request buffered for the session. started is the time.perf_counter() at which the
+        bytes were received; the transport has already read them. """
+        parse_from = time.perf_counter()
+        messages, parse = bank_server.parse_requests(self.session)
+        self.dispatch(messages, started or parse_from, parse)
+
+    def dispatch(self, messages, started, parse = 0.0):
+        """ Process messages in order (see bank_server.handle_requests) and schedule the replies. """
+        bank_server.handle_requests(self.session, messages, functools.partial(schedule_flush, self), started, 0.0,
+                                    parse)
+
+    def flush(self):
+        """ Hand the queued replies to the transport, and close the connection if the session is over. """
+        session = self.session
+        if session.outb:
+            replies = bytes(session.outb)
+            started = time.perf_counter()
+            self.transport.write(replies)
+            session.outb.clear()
+            bank_server.trace_sent(session, time.perf_counter() - started)
+            if bank_server.capture is not None:
+                bank_server.capture.record(session.conn_id, bank_trace.OUT, replies)
+        if session.closing:
+            # close() sends whatever is still buffered before it closes the socket
+            self.transport.close()
+
+    def pause_writing(self):
+        """ The client is not keeping up with its replies: stop reading its requests. """
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        """ The client has caught up: start reading its requests again. """
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        """ Forget the session, releasing its account. """
+        if self.session is None:
+            return
+        bank_server.metrics.closed += 1
+        bank_server.log.debug("Closing connection to %s", self.session.addr)
+        if bank_server.capture is not None:
+            bank_server.capture.record(self.session.conn_id, bank_trace.CLOSE)
+        bank_server.sessions.remove(self.session)
+        protocols.pop(self.session, None)
+        pending_flush.discard(self)
+
+# The protocol serving each live Session
+protocols = dict()
+
+# Protocols with replies waiting for the current batch to be committed
+pending_flush = set()
+
+def schedule_flush(protocol):
+    """ Queue protocol's replies for the end of this event-loop iteration, scheduling the flush on first use. """
+    if not pending_flush:
+        asyncio.get_running_loop().call_soon(flush_pending)
+    pending_flush.add(protocol)
+
+class AsyncioEngine:
+    """ The network engine methods of bank_server.SelectorsEngine, for connections served by BankProtocol. """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def call_soon_threadsafe(self, func, *args):
+        """ Runs func(*args) on the event loop thread. May be called from any thread. """
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def wake_writer(self, session):
+        """ Sends a message pushed to session once the current batch is committed. """
+        protocol = protocols.get(session)
+        if protocol is not None:
+            schedule_flush(protocol)
+
+    def resume_requests(self, session, target):
+        """ Carries on with the requests held behind target's login once it has completed, and sends its reply. """
+        protocol = protocols.get(session)
+        if protocol is not None:
+            messages, target.held = target.held, []
+            protocol.dispatch(messages, time.perf_counter())
+
+    def evict_session(self, session):
+        """ Drops a session's connection at once, discarding anything still unsent. """
+        protocol = protocols.get(session)
+        if protocol is not None:
+            protocol.transport.abort()
+
+def flush_pending():
+    """ Group commit: make the batch's balance changes durable with one fsync, then release its replies. """
+    bank_server.commit_batch()
+    for protocol in pending_flush:
+        protocol.flush()
+    pending_flush.clear()
+
+class AdminProtocol(asyncio.Protocol):
+    """ One connection to the local admin socket: reads a command line, replies and hangs up. """
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.inb = bytearray()
+
+    def data_received(self, data):
+        self.inb += data
+        if b"\n" in self.inb or len(self.inb) >= bank_server.ADMIN_MAX:
+            self.reply()
+
+    def eof_received(self):
+        if self.inb:
+            self.reply()
+
+    def reply(self):
+        line = self.inb.split(b"\n")[0].decode("utf-8", errors="replace")
+        self.inb.clear()
+        self.transport.write(bank_server.admin_reply(line).encode("utf-8") + b"\n")
+        self.transport.close()
+        if bank_server.pending_pushes:
+            # Balances the command changed (POST) are pushed once committed, like those requests change
+            asyncio.get_running_loop().call_soon(flush_pending)
+
+async def flush_logs_periodically():
+    """ Write out buffered log (and trace) records that have waited long enough, for as long as the server runs. """
+    while True:
+        await asyncio.sleep(bank_metrics.LOG_FLUSH_INTERVAL)
+        bank_metrics.flush_logs(stale_only=True)
+        if bank_server.capture is not None:
+            bank_server.capture.flush_if_stale()
+
+async def evict_idle_periodically():
+    """ Advance the idle timers once per tick, for as long as the server runs. """
+    while True:
+        await asyncio.sleep(bank_server.TIMER_TICK)
+        bank_server.evict_idle_sessions(time.monotonic())
+
+async def finish_compaction_periodically():
+    """ Collect a finished background snapshot once per tick, even while no requests come in to be committed. """
+    while True:
+        await asyncio.sleep(bank_server.TIMER_TICK)
+        bank_server.finish_compaction()
+
+async def reload_accounts_periodically():
+    """ Check the account file for changes once per tick, and apply a reload one slice per loop iteration. """
+    while True:
+        reloading = bank_server.step_reload(time.monotonic())
+        # sleep(0) lets every ready connection be served before the next slice
+        await asyncio.sleep(0 if reloading else bank_server.TIMER_TICK)
+
+async def measure_loop_lag():
+    """ Sample how late the loop runs a sleeping task, as admission control's loop lag, for as long as the server runs. """
+    loop = asyncio.get_running_loop()
+    while True:
+        due = loop.time() + LAG_PROBE_INTERVAL
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        bank_server.admission.record_lag(loop.time() - due)
+
+async def serve(host, port):
+    """ Accept connections on host:port, and admin connections on the admin socket, until cancelled. """
+    loop = asyncio.get_running_loop()
+    bank_server.use_engine(AsyncioEngine(loop))
+    server = await loop.create_server(BankProtocol, host, port, reuse_address=True, backlog=4096)
+    bank_server.log.info("Listening on %s:%s (asyncio engine, %s loop)", host, port, type(loop).__module__)
+    if bank_server.admin_path is not None:
+        await loop.create_unix_server(AdminProtocol, sock=bank_server.open_admin_socket(bank_server.admin_path))
+    log_flusher = loop.create_task(flush_logs_periodically())
+    evictor = loop.create_task(evict_idle_periodically())
+    reloader = loop.create_task(reload_accounts_periodically())
+    compactor = loop.create_task(finish_compaction_periodically())
+    tasks = [log_flusher, evictor, reloader, compactor]
+    if bank_server.admission is not None:
+        tasks.append(loop.create_task(measure_loop_lag()))
+    async with server:
+        await server.serve_forever()
+    for task in tasks:
+        task.cancel()
+
+def run_asyncio_server():
+    """ Runs the server on the asyncio engine. """
+    host, port = bank_server.get_server_address()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if bank_server.admin_path is not None:
+            bank_server.remove_admin_socket(bank_server.admin_path)
@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+#
+# Bank Server benchmarks
+#
+# Run one benchmark by name, e.g.:  python3 bank_bench.py sessions
+
+import argparse
+import multiprocessing
+import os
+import random
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import types
+from array import array
+
+import atm_client
+import atm_pool
+import bank_admission
+import bank_history
+import bank_pins
+import bank_posting
+import bank_server
+import bank_store
+import bank_snapshot
+import bank_timers
+import bank_trace
+import bank_wire
+
+
+##########################################################
+#                                                        #
+# Benchmark Helpers                                      #
+#                                                        #
+##########################################################
+
+class FakeConn:
+    """ Stands in for a client socket so sessions can be created without opening real connections. """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+def synthetic_acct_num(i):
+    """ Return the i-th synthetic account number, e.g. 'bb-00042'. """
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    prefix = letters[(i // 100000) // 26 % 26] + letters[(i // 100000) % 26]
+    return f"{prefix}-{i % 100000:05d}"
+
+def populate_accounts(count):
+    """ Fill ALL_ACCOUNTS with count synthetic accounts, bypassing the chatty file loader. """
+    bank_server.ALL_ACCOUNTS.clear()
+    for i in range(count):
+        acct_num = synthetic_acct_num(i)
+        bank_server.ALL_ACCOUNTS[acct_num] = bank_server.BankAccount(acct_num, "1234", 100.0)
+
+def write_account_file(path, count, pin = "1234"):
+    """ Write a text account file with count synthetic accounts, all with the same stored PIN (which may be a hash
+    of 1234). """
+    with open(path, "w") as f:
+        f.write("# synthetic accounts for benchmarking\n")
+        for i in range(count):
+            f.write(f"{synthetic_acct_num(i)}, {pin}, {i % 100000}.{i % 100:02d}\n")
+
+def run_child(code):
+    """ Run code in a fresh interpreter (with stdout discarded) and return what it printed to stderr. """
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    return result.stderr.strip()
+
+def server_address():
+    """ Return the (host, port) the bank server listens on. """
+    return socket.gethostbyname(socket.gethostname()), 65432
+
+def start_server(*options):
+    """ Start bank_server.py with the given command line options (journal off) and wait until it accepts connections. """
+    server = subprocess.Popen([sys.executable, "bank_server.py", "--no-journal", *options],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(server_address()).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("bank server did not start")
+
+def stop_server(server):
+    """ Stop a server started by start_server, workers included. """
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+def read_frames(sock, count):
+    """ Read count framed replies from sock in large chunks and return them as strings. """
+    buf = bytearray()
+    replies = []
+    while len(replies) < count:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed by bank server")
+        buf += chunk
+        while True:
+            sep = buf.find(b":")
+            if sep < 0 or len(buf) < sep + 1 + int(buf[:sep]):
+                break
+            end = sep + 1 + int(buf[:sep])
+            replies.append(buf[sep + 1:end].decode("utf-8"))
+            del buf[:end]
+    return replies
+
+def percentile(sorted_values, fraction):
+    """ Return the value at the given fraction (e.g. 0.99) of an already sorted list. """
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def proc_status_kb(field):
+    """ Return a size field (e.g. 'VmRSS') of /proc/self/status, in kB. """
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field + ":"))
+
+def per_call_usec(func, number):
+    """ Return the best-of-three cost of one call to func, in microseconds. """
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+##########################################################
+#                                                        #
+# Benchmarks                                             #
+#                                                        #
+##########################################################
+
+def bench_sessions(args):
+    """ Per-request cost of BAL as the number of logged-in sessions grows. The registry lookup should stay
+    flat; the old reverse scan over client_dict is timed alongside for comparison. """
+    print(f"{'sessions':>10} {'BAL usec':>10} {'reverse scan usec':>18}")
+    for count in args.sizes:
+        populate_accounts(count)
+        registry = bank_server.sessions = bank_server.SessionRegistry()
+        for i in range(count):
+            session = bank_server.Session(FakeConn(i), ("127.0.0.1", i))
+            registry.add(session)
+            registry.bind(session, synthetic_acct_num(i))
+        probe = registry.by_fd[count - 1]
+        bal_cost = per_call_usec(lambda: bank_server.process_msg("BAL", probe), args.number)
+        # the pre-registry lookup: two list builds and a linear index() per request
+        client_dict = {acct: s.conn for acct, s in registry.by_acct.items()}
+        conn = probe.conn
+        scan_cost = per_call_usec(lambda: list(client_dict.keys())[list(client_dict.values()).index(conn)],
+                                  max(1, args.number // count))
+        print(f"{count:>10} {bal_cost:>10.2f} {scan_cost:>18.2f}")
+
+def bench_dispatch(args):
+    """ Per-message cost of parsing and dispatching each request code through process_msg. """
+    populate_accounts(1)
+    bank_server.sessions = bank_server.SessionRegistry()
+    session = bank_server.Session(FakeConn(0), ("127.0.0.1", 0))
+    bank_server.sessions.add(session)
+    bank_server.sessions.bind(session, synthetic_acct_num(0))
+    messages = ["LOG aa-00000 1234", "BAL", "DEP 1", "WD 1", "XDEP 5", "WD 1 2"]
+    print(f"{'message':>20} {'usec':>8} {'reply':>10}")
+    for msg in messages:
+        reply = bank_server.process_msg(msg, session)
+        cost = per_call_usec(lambda: bank_server.process_msg(msg, session), args.number)
+        print(f"{msg!r:>20} {cost:>8.2f} {reply!s:>10}")
+
+def bench_idle(args):
+    """ Per-tick cost of idle eviction bookkeeping as the number of sessions grows: the timer wheel, with every
+    session's timer firing once per idle timeout and being set again, against scanning every session each tick. """
+    print(f"{'sessions':>10} {'wheel usec/tick':>16} {'scan usec/tick':>15}")
+    ticks = int(bank_server.IDLE_TIMEOUT / bank_server.TIMER_TICK)
+    for count in args.sizes:
+        rng = random.Random(count)
+        last_active = {i: rng.uniform(0, bank_server.IDLE_TIMEOUT) for i in range(count)}
+        wheel = bank_timers.TimerWheel(bank_server.TIMER_TICK, 0.0)
+        for i, active in last_active.items():
+            wheel.schedule(i, active)
+        start = time.perf_counter()
+        for tick in range(1, ticks + 1):
+            # every session stays busy, so each timer that fires is set again one idle timeout later
+            for i in wheel.advance(tick * bank_server.TIMER_TICK):
+                wheel.schedule(i, tick * bank_server.TIMER_TICK + bank_server.IDLE_TIMEOUT)
+        wheel_cost = (time.perf_counter() - start) / ticks * 1e6
+        # the scan compares every session's last activity against the eviction cut-off, here the start of the run
+        scan_cost = per_call_usec(lambda: [i for i, active in last_active.items() if active <= 0.0],
+                                  max(1, args.number // count))
+        print(f"{count:>10} {wheel_cost:>16.2f} {scan_cost:>15.2f}")
+
+def bench_history(args):
+    """ Cost of recording a transaction and of HIST pages as one account's history grows: the newest page, served
+    from memory, and a page halfway back, which walks the spill file. """
+    print(f"{'entries':>10} {'append usec':>12} {'newest page usec':>17} {'middle page usec':>17}")
+    for count in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            history = bank_history.History(os.path.join(tmp, "bench.hist"))
+            start = time.perf_counter()
+            for i in range(count):
+                history.append("aa-00000", time.time(), "DEP", 100, 20, i * 100)
+            append_cost = (time.perf_counter() - start) / count * 1e6
+            newest = per_call_usec(lambda: history.page("aa-00000", 0, bank_server.HIST_PAGE), args.number)
+            middle = per_call_usec(lambda: history.page("aa-00000", count // 2, bank_server.HIST_PAGE),
+                                   max(1, args.number // 100))
+            history.close()
+        print(f"{count:>10} {append_cost:>12.2f} {newest:>17.2f} {middle:>17.2f}")
+
+STARTUP_PROBE = """
+import sys, time
+start = time.perf_counter()
+import bank_server
+{load}
+acct = bank_server.get_acct("aa-00000")
+elapsed = time.perf_counter() - start
+# VmHWM is the peak RSS of this process image; unlike ru_maxrss it is not inherited across exec
+peak_kb = next(int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmHWM:"))
+print(f"{{elapsed:.3f}} {{peak_kb // 1024}}", file=sys.stderr)
+"""
+
+def bench_startup(args):
+    """ Time to first served lookup, and peak RSS, for the text loader versus the memory-mapped snapshot. """
+    print(f"{'accounts':>10} {'text sec':>9} {'text MB':>8} {'snap sec':>9} {'snap MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.sizes:
+            text_file = os.path.join(tmp, "accounts.txt")
+            snap_file = os.path.join(tmp, "accounts.snap")
+            write_account_file(text_file, count)
+            bank_snapshot.convert(text_file, snap_file)
+            text = run_child(STARTUP_PROBE.format(load=f"bank_server.load_all_accounts({text_file!r})"))
+            snap = run_child(STARTUP_PROBE.format(load=f"bank_server.load_snapshot({snap_file!r})"))
+            (text_sec, text_mb), (snap_sec, snap_mb) = text.split(), snap.split()
+            print(f"{count:>10} {text_sec:>9} {text_mb:>8} {snap_sec:>9} {snap_mb:>8}")
+
+def store_probe(kind, count, ops):
+    """ Child side of bench_store: build count accounts in the given kind of store, then report bytes per
+    account, build time and deposit/withdraw throughput on stderr. """
+    base_kb = proc_status_kb("VmRSS")
+    start = time.perf_counter()
+    if kind == "array":
+        bank_server.use_account_store(count)
+        for i in range(count):
+            bank_server.ALL_ACCOUNTS.add(synthetic_acct_num(i), "1234", 10000)
+    else:
+        for i in range(count):
+            acct_num = synthetic_acct_num(i)
+            bank_server.ALL_ACCOUNTS[acct_num] = bank_server.BankAccount(acct_num, "1234", 100.0)
+    build_sec = time.perf_counter() - start
+    bytes_per_acct = (proc_status_kb("VmRSS") - base_kb) * 1024 / count
+    probes = [synthetic_acct_num(random.randrange(count)) for _ in range(ops)]
+    start = time.perf_counter()
+    for acct_num in probes:
+        acct = bank_server.get_acct(acct_num)
+        acct.deposit(1.25)
+        acct.withdraw(1.25)
+    ops_per_sec = ops / (time.perf_counter() - start)
+    print(f"{bytes_per_acct:.0f} {build_sec:.2f} {ops_per_sec:.0f}", file=sys.stderr)
+
+def bench_store(args):
+    """ Memory per account, build time and get_acct+deposit+withdraw throughput for the dictionary of BankAccount
+    objects versus the array-backed AccountStore. """
+    print(f"{'accounts':>10} {'store':>6} {'bytes/acct':>11} {'build sec':>10} {'ops/sec':>10}")
+    for count in args.sizes:
+        for kind in args.kinds:
+            result = run_child(f"import bank_bench; bank_bench.store_probe({kind!r}, {count}, {args.number})")
+            bytes_per_acct, build_sec, ops_per_sec = result.split()
+            print(f"{count:>10} {kind:>6} {bytes_per_acct:>11} {build_sec:>10} {ops_per_sec:>10}")
+
+def shard_load_client(acct_nums, seconds, depth):
+    """ Child side of bench_shards: log one connection in to each account, then keep depth pipelined DEP/WD
+    requests in flight on every connection for the given number of seconds. Returns the requests completed. """
+    socks = []
+    for acct_num in acct_nums:
+        sock = socket.create_connection(server_address())
+        atm_client.send_pipelined(sock, [f"LOG {acct_num} 1234"])
+        socks.append(sock)
+    batch = b"".join(atm_client.frame_msg(msg) for msg in ["DEP 1", "WD 1"] * (depth // 2))
+    completed = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for sock in socks:
+            sock.sendall(batch)
+        for sock in socks:
+            read_frames(sock, depth // 2 * 2)
+        completed += len(socks) * (depth // 2 * 2)
+    for sock in socks:
+        sock.close()
+    return completed
+
+def bench_shards(args):
+    """ DEP/WD throughput of the sharded server with 1 to --max-workers worker processes, driven by --clients
+    load processes that each hold --connections logged-in sessions. """
+    print(f"{'workers':>8} {'requests/sec':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        acct_file = os.path.join(tmp, "accounts.txt")
+        total = args.clients * args.connections
+        write_account_file(acct_file, total)
+        chunks = [[synthetic_acct_num(i) for i in range(c, total, args.clients)] for c in range(args.clients)]
+        for workers in range(1, args.max_workers + 1):
+            server = start_server("--accounts", acct_file, "--snapshot", os.path.join(tmp, "none"),
+                                  "--workers", str(workers))
+            try:
+                with multiprocessing.Pool(args.clients) as pool:
+                    counts = pool.starmap(shard_load_client, [(chunk, args.seconds, args.depth) for chunk in chunks])
+            finally:
+                stop_server(server)
+            print(f"{workers:>8} {sum(counts) / args.seconds:>13.0f}")
+
+def latency_client(acct_nums, seconds, binary = False):
+    """ Child side of bench_engines: hold one logged-in connection per account and keep exactly one DEP, WD or BAL
+    request in flight on each of them for the given number of seconds, in the text protocol or the binary one.
+    Returns every request's latency in seconds. """
+    if binary:
+        requests = [bank_wire.encode_request(opcode, value=100)
+                    for opcode in (bank_wire.OP_DEP, bank_wire.OP_WD, bank_wire.OP_BAL)]
+    else:
+        requests = [atm_client.frame_msg(msg) for msg in ("DEP 1", "WD 1", "BAL")]
+    client_sel = selectors.DefaultSelector()
+    for acct_num in acct_nums:
+        sock = socket.create_connection(server_address())
+        if binary:
+            bank_wire.BinaryConnection(sock).login(acct_num, "1234")
+        else:
+            atm_client.send_pipelined(sock, [f"LOG {acct_num} 1234"])
+        sock.setblocking(False)
+        client_sel.register(sock, selectors.EVENT_READ, types.SimpleNamespace(inb=bytearray(), sent_at=0.0, count=0))
+    for key in list(client_sel.get_map().values()):
+        key.data.sent_at = time.perf_counter()
+        key.fileobj.send(requests[0])
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for key, _ in client_sel.select(timeout=0.1):
+            state = key.data
+            state.inb += key.fileobj.recv(4096)
+            if binary:
+                if len(state.inb) < bank_wire.REPLY.size:
+                    continue
+                del state.inb[:bank_wire.REPLY.size]
+            else:
+                sep = state.inb.find(b":")
+                if sep < 0 or len(state.inb) < sep + 1 + int(state.inb[:sep]):
+                    continue
+                del state.inb[:sep + 1 + int(state.inb[:sep])]
+            now = time.perf_counter()
+            latencies.append(now - state.sent_at)
+            state.count += 1
+            state.sent_at = now
+            key.fileobj.send(requests[state.count % len(requests)])
+    for key in list(client_sel.get_map().values()):
+        key.fileobj.close()
+    return latencies
+
+def bench_engines(args):
+    """ Throughput and tail latency of the selectors and asyncio engines with --clients x --connections
+    concurrent sessions, each with one request in flight. """
+    print(f"{'engine':>10} {'sessions':>9} {'req/sec':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        acct_file = os.path.join(tmp, "accounts.txt")
+        total = args.clients * args.connections
+        write_account_file(acct_file, total)
+        chunks = [[synthetic_acct_num(i) for i in range(c, total, args.clients)] for c in range(args.clients)]
+        for engine in ("selectors", "asyncio"):
+            server = start_server("--accounts", acct_file, "--snapshot", os.path.join(tmp, "none"), "--engine", engine)
+            try:
+                with multiprocessing.Pool(args.clients) as pool:
+                    results = pool.starmap(latency_client, [(chunk, args.seconds) for chunk in chunks])
+            finally:
+                stop_server(server)
+            latencies = sorted(latency * 1000 for result in results for latency in result)
+            print(f"{engine:>10} {total:>9} {len(latencies) / args.seconds:>9.0f} {percentile(latencies, 0.5):>8.2f} "
+                  f"{percentile(latencies, 0.99):>8.2f} {percentile(latencies, 0.999):>8.2f} {latencies[-1]:>8.2f}")
+
+def pool_client(acct_nums, pool_size, seconds):
+    """ Child side of bench_pool: log a logical session in to each account over an ATMPool of pool_size connections,
+    then keep one BAL in flight per session for the given number of seconds.
+    Returns (seconds to log every session in, requests completed). """
+    with atm_pool.ATMPool(server_address(), size=pool_size) as pool:
+        start = time.perf_counter()
+        atms = [pool.open_session() for _ in acct_nums]
+        logins = [atm.submit(f"LOG {acct_num} 1234") for atm, acct_num in zip(atms, acct_nums)]
+        for login in logins:
+            login.result()
+        login_seconds = time.perf_counter() - start
+        completed = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for future in [atm.submit("BAL") for atm in atms]:
+                future.result()
+            completed += len(atms)
+    return login_seconds, completed
+
+def bench_pool(args):
+    """ Login time and BAL throughput for --connections ATM sessions per load process, multiplexed over pools of
+    a few connections, against one socket per session. """
+    print(f"{'connections':>12} {'sessions':>9} {'login ms':>9} {'requests/sec':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        acct_file = os.path.join(tmp, "accounts.txt")
+        total = args.clients * args.connections
+        write_account_file(acct_file, total)
+        chunks = [[synthetic_acct_num(i) for i in range(c, total, args.clients)] for c in range(args.clients)]
+        server = start_server("--accounts", acct_file, "--snapshot", os.path.join(tmp, "none"))
+        try:
+            fewest = -(-args.connections // atm_pool.SESSIONS_PER_CONNECTION)
+            for pool_size in sorted({fewest, max(fewest, 4), max(fewest, 16), args.connections}):
+                with multiprocessing.Pool(args.clients) as pool:
+                    results = pool.starmap(pool_client, [(chunk, pool_size, args.seconds) for chunk in chunks])
+                login_ms = max(login_seconds for login_seconds, _ in results) * 1000
+                print(f"{pool_size * args.clients:>12} {total:>9} {login_ms:>9.1f} "
+                      f"{sum(count for _, count in results) / args.seconds:>13.0f}")
+        finally:
+            stop_server(server)
+
+def login_storm_client(acct_nums, seconds):
+    """ Child side of bench_logins: one thread per account connects, logs in and hangs up, over and over, for the
+    given number of seconds. Returns the number of logins completed. """
+    counts = []
+    deadline = time.perf_counter() + seconds
+    def log_in_repeatedly(acct_num):
+        count = 0
+        while time.perf_counter() < deadline:
+            with socket.create_connection(server_address()) as sock:
+                atm_client.login_to_server(sock, acct_num, "1234")
+            count += 1
+        counts.append(count)
+    threads = [threading.Thread(target=log_in_repeatedly, args=(acct_num,)) for acct_num in acct_nums]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+def bench_logins(args):
+    """ Latency of DEP, WD and BAL for --clients x --connections logged-in sessions while --storm clients keep
+    logging in to accounts with hashed PINs, with the hashes checked in the thread pool and inline on the loop. """
+    print(f"{'pin checks':>11} {'storm':>6} {'logins/sec':>11} {'req/sec':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} "
+          f"{'max ms':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        acct_file = os.path.join(tmp, "accounts.txt")
+        total = args.clients * args.connections
+        write_account_file(acct_file, total + args.storm, pin=bank_pins.hash_pin("1234"))
+        chunks = [[synthetic_acct_num(i) for i in range(c, total, args.clients)] for c in range(args.clients)]
+        stormers = [synthetic_acct_num(i) for i in range(total, total + args.storm)]
+        for pin_workers, storm in ((4, []), (4, stormers), (0, stormers)):
+            server = start_server("--accounts", acct_file, "--snapshot", os.path.join(tmp, "none"),
+                                  "--pin-workers", str(pin_workers))
+            try:
+                with multiprocessing.Pool(args.clients + 1) as pool:
+                    storm_run = pool.apply_async(login_storm_client, (storm, args.seconds))
+                    results = pool.starmap(latency_client, [(chunk, args.seconds) for chunk in chunks])
+                    logins = storm_run.get()
+            finally:
+                stop_server(server)
+            latencies = sorted(latency * 1000 for result in results for latency in result)
+            print(f"{'pool' if pin_workers else 'inline':>11} {len(storm):>6} {logins / args.seconds:>11.1f} "
+                  f"{len(latencies) / args.seconds:>9.0f} {percentile(latencies, 0.5):>8.2f} "
+                  f"{percentile(latencies, 0.99):>8.2f} {percentile(latencies, 0.999):>8.2f} {latencies[-1]:>8.2f}")
+
+def text_round_trip():
+    """ One DEP through the text protocol's codecs: the client frames it, the server splits, decodes and parses it,
+    then formats and frames the new balance, which the client parses back into a number. """
+    session = types.SimpleNamespace(inb=bytearray(atm_client.frame_msg("DEP 20")), framed=True, binary=False)
+    request_code, _, amount = bank_server.extract_messages(session)[0].partition(" ")
+    amount = float(amount) if bank_server.amount_token_is_valid(amount) else None
+    reply = bank_server.encode_message(session, str(round(1024.32 + amount, 2)))
+    sep = reply.find(b":")
+    return round(float(reply[sep + 1:sep + 1 + int(reply[:sep])].decode("utf-8")), 2)
+
+def binary_round_trip():
+    """ The same DEP through the binary protocol's codecs. """
+    session = types.SimpleNamespace(inb=bytearray(bank_wire.encode_request(bank_wire.OP_DEP, value=2000)),
+                                    framed=True, binary=True)
+    opcode, acct_id, cents = bank_wire.REQUEST.unpack(bank_server.extract_messages(session)[0])
+    reply = bank_wire.REPLY.pack(20, round((1024.32 + cents / 100) * 100))
+    return bank_wire.REPLY.unpack(reply)[1]
+
+def bench_wire(args):
+    """ Cost of encoding and decoding a request and its reply, server-side cost of a DEP from the buffered request to
+    the queued reply, and end-to-end throughput and latency for --clients x --connections sessions with one DEP,
+    WD or BAL in flight each, in the text and binary protocols. """
+    populate_accounts(1)
+    bank_server.sessions = bank_server.SessionRegistry()
+    session = bank_server.Session(FakeConn(0), ("127.0.0.1", 0))
+    bank_server.sessions.add(session)
+    bank_server.sessions.bind(session, synthetic_acct_num(0))
+    def handle_request(request):
+        session.inb += request
+        for msg in bank_server.extract_messages(session):
+            bank_server.queue_reply(session, bank_server.process_msg(msg, session))
+        session.outb.clear()
+    print(f"{'protocol':>9} {'codec usec':>11} {'server usec':>12} {'req/sec':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        acct_file = os.path.join(tmp, "accounts.txt")
+        total = args.clients * args.connections
+        write_account_file(acct_file, total)
+        chunks = [[synthetic_acct_num(i) for i in range(c, total, args.clients)] for c in range(args.clients)]
+        server = start_server("--accounts", acct_file, "--snapshot", os.path.join(tmp, "none"))
+        try:
+            for protocol, round_trip in (("text", text_round_trip), ("binary", binary_round_trip)):
+                codec_cost = per_call_usec(round_trip, args.number)
+                session.framed = True
+                session.binary = protocol == "binary"
+                if session.binary:
+                    request = bank_wire.encode_request(bank_wire.OP_DEP, value=100)
+                else:
+                    request = atm_client.frame_msg("DEP 1")
+                server_cost = per_call_usec(lambda: handle_request(request), args.number)
+                with multiprocessing.Pool(args.clients) as pool:
+                    results = pool.starmap(latency_client, [(chunk, args.seconds, protocol == "binary") for chunk in chunks])
+                latencies = sorted(latency * 1000 for result in results for latency in result)
+                print(f"{protocol:>9} {codec_cost:>11.2f} {server_cost:>12.2f} {len(latencies) / args.seconds:>9.0f} "
+                      f"{percentile(latencies, 0.5):>8.2f} {percentile(latencies, 0.99):>8.2f}")
+        finally:
+            stop_server(server)
+
+def bench_capture(args):
+    """ Cost of capturing one read or send of a framed DEP-sized message, buffer flushes included, and the size
+    of its trace record. """
+    payload = b"6:DEP 20"
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = bank_trace.TraceWriter(os.path.join(tmp, "bench.trace"))
+        cost = per_call_usec(lambda: writer.record(1, bank_trace.IN, payload), args.number)
+        writer.close()
+    print(f"capture {cost:.3f} usec per record, {bank_trace.RECORD.size + len(payload)} bytes per record")
+
+def bench_admission(args):
+    """ Per-request cost of admission control on BAL: with no limits configured, admitted by the peer and account
+    token buckets, and answered busy. """
+    populate_accounts(1)
+    bank_server.sessions = bank_server.SessionRegistry()
+    session = bank_server.Session(FakeConn(0), ("127.0.0.1", 0))
+    bank_server.sessions.add(session)
+    bank_server.sessions.bind(session, synthetic_acct_num(0))
+    cases = [("no limits", None),
+             ("admitted", bank_admission.Admission(peer_rate=1e9, account_rate=1e9)),
+             ("busy", bank_admission.Admission(peer_rate=1e-6, peer_burst=1))]
+    print(f"{'admission':>10} {'usec':>8} {'reply':>10}")
+    for name, admission in cases:
+        bank_server.admission = admission
+        cost = per_call_usec(lambda: bank_server.process_msg("BAL", session), args.number)
+        print(f"{name:>10} {cost:>8.2f} {bank_server.process_msg('BAL', session):>10}")
+    bank_server.admission = None
+
+def synthetic_store(count):
+    """ Return an AccountStore holding count synthetic accounts with random balances. Only its columns are filled,
+    not its hash table, so it serves for whole-store operations but not for lookups. """
+    store = bank_store.AccountStore()
+    store.ids = array("i", range(count))
+    store.pins = array("H", [1234]) * count
+    store.cents = array("q", (random.randrange(-5000, 500000) for _ in range(count)))
+    return store
+
+def bench_posting(args):
+    """ Posting interest and a fee to every account of an array store: one deposit and one withdraw call per account,
+    as a nightly job would do without a posting, versus post_store, plus the snapshot pack_store then writes. """
+    schedule = bank_posting.Schedule(rate=0.0001, fee=250, waive_at=100000)
+    print(f"{'accounts':>10} {'per-account sec':>16} {'posting sec':>12} {'pack sec':>9}")
+    for count in args.sizes:
+        store = synthetic_store(count)
+        start = time.perf_counter()
+        for acct in store.values():
+            acct.deposit(round(max(acct.acct_balance, 0.0) * schedule.rate, 2))
+            if acct.acct_balance < schedule.waive_at / 100:
+                acct.withdraw(schedule.fee / 100)
+        calls = time.perf_counter() - start
+        start = time.perf_counter()
+        bank_posting.post_store(store, schedule)
+        posting = time.perf_counter() - start
+        start = time.perf_counter()
+        if bank_posting.pack_store(store, 0) is None:
+            bank_snapshot.pack_records(0, bank_snapshot.account_records(store.values()))
+        pack = time.perf_counter() - start
+        print(f"{count:>10} {calls:>16.3f} {posting:>12.3f} {pack:>9.3f}")
+
+BENCHMARKS = {
+    "sessions": bench_sessions,
+    "dispatch": bench_dispatch,
+    "idle": bench_idle,
+    "history": bench_history,
+    "startup": bench_startup,
+    "store": bench_store,
+    "shards": bench_shards,
+    "engines": bench_engines,
+    "pool": bench_pool,
+    "wire": bench_wire,
+    "logins": bench_logins,
+    "capture": bench_capture,
+    "posting": bench_posting,
+    "admission": bench_admission,
+}
+
+##########################################################
+#                                                        #
+# Benchmark Startup Operations                           #
+#                                                        #
+##########################################################
+
+def parse_args(argv):
+    """ Parse the command line: the benchmark name and its tuning knobs. """
+    parser = argparse.ArgumentParser(description="Bank server benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000, 100000],
+                        help="population sizes to sweep")
+    parser.add_argument("--number", type=int, default=20000, help="iterations per timing sample")
+    parser.add_argument("--kinds", nargs="+", choices=("dict", "array"), default=["dict", "array"],
+                        help="account stores to compare (store benchmark)")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count(), help="largest worker count to sweep (shards benchmark)")
+    parser.add_argument("--clients", type=int, default=os.cpu_count(), help="load generating processes")
+    parser.add_argument("--connections", type=int, default=16, help="logged-in connections per load process")
+    parser.add_argument("--depth", type=int, default=32, help="requests pipelined per connection per round trip")
+    parser.add_argument("--storm", type=int, default=8, help="clients logging in over and over (logins benchmark)")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each load run")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+#
+# Bank Server transaction history
+#
+# Every account that has transacted owns a ring of its DEPTH most recent entries: time, verb, amount,
+# result code and resulting balance, amounts in integer cents. The rings live in parallel arrays shared
+# by all accounts (27 bytes per entry), so memory grows with the number of active accounts, never with
+# the length of their histories. When a ring fills up, its older half is appended to the spill file as
+# one block:
+#
+#     block header:  account id u32, entry count u16, 2 pad bytes, block number u32, jump block number u32,
+#                    entries spilled up to this block i64, entries spilled up to the jump block i64,
+#                    offset of the previous block i64, offset of the jump block i64
+#     entry:         time f64, verb u8, result code u16, amount i64, balance i64
+#
+# An account's spilled history is thus a chain of blocks running backwards through the file from the
+# offset kept in memory. Each block also points to an older "jump" block, chosen as in a skew-binary
+# list (Myers, "An applicative random-access stack"), so reaching any depth takes a logarithmic number
+# of reads. The newest entries are read from memory without touching the file. The chain heads are
+# rebuilt from the block headers at startup; entries still in memory when the server stops are not kept.
+
+import os
+import struct
+from array import array
+
+import bank_store
+
+
+DEPTH = 32              # entries kept in memory per account
+VERBS = ("DEP", "WD", "TRANSFER", "TRANSFER-IN", "BATCH")
+VERB_CODES = {verb: code for code, verb in enumerate(VERBS)}
+BLOCK_HEADER = struct.Struct("<IH2xIIqqqq")
+ENTRY = struct.Struct("<dBHqq")
+NO_BLOCK = -1           # chain head of an account that has spilled nothing
+
+
+class History:
+    """ Bounded in-memory transaction histories backed by an append-only spill file. """
+
+    def __init__(self, path, depth = DEPTH):
+        """ Open (or create) the spill file at path and find every account's spilled blocks in it.
+        depth is the number of entries kept in memory per account; half of them are spilled at a time. """
+        self.depth = depth
+        self.block = max(depth // 2, 1)
+        self.rings = dict()         # acct_num -> ring number
+        self.free = []              # ring numbers of forgotten accounts, for reuse
+        self.times = array("d")
+        self.verbs = array("B")
+        self.codes = array("H")
+        self.amounts = array("q")
+        self.balances = array("q")
+        self.starts = array("H")    # per ring: position of its oldest entry
+        self.counts = array("H")    # per ring: entries held in memory
+        self.heads = array("q")     # per ring: file offset of its newest spilled block, or NO_BLOCK
+        self.spilled = array("q")   # per ring: entries in the spill file
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = self.recover()
+
+    def close(self):
+        os.close(self.fd)
+
+    def recover(self):
+        """ Rebuild the chain heads from the spill file's block headers and return the length of its intact part,
+        cutting off a block torn by a crash. """
+        size = os.fstat(self.fd).st_size
+        offset = 0
+        while offset + BLOCK_HEADER.size <= size:
+            acct_id, count = BLOCK_HEADER.unpack(os.pread(self.fd, BLOCK_HEADER.size, offset))[:2]
+            end = offset + BLOCK_HEADER.size + count * ENTRY.size
+            if count == 0 or end > size:
+                break
+            ring = self.ring_of(bank_store.unpack_acct_num(acct_id))
+            self.heads[ring] = offset
+            self.spilled[ring] += count
+            offset = end
+        if offset < size:
+            os.ftruncate(self.fd, offset)
+        return offset
+
+    def ring_of(self, acct_num):
+        """ Return acct_num's ring number, giving it an empty ring if it has none. """
+        ring = self.rings.get(acct_num)
+        if ring is not None:
+            return ring
+        if self.free:
+            ring = self.free.pop()
+        else:
+            ring = len(self.starts)
+            for entries, zero in ((self.times, 0.0), (self.verbs, 0), (self.codes, 0), (self.amounts, 0),
+                                  (self.balances, 0)):
+                entries.extend([zero] * self.depth)
+            for field in (self.starts, self.counts, self.heads, self.spilled):
+                field.append(0)
+        self.starts[ring] = self.counts[ring] = self.spilled[ring] = 0
+        self.heads[ring] = NO_BLOCK
+        self.rings[acct_num] = ring
+        return ring
+
+    def forget(self, acct_num):
+        """ Drop acct_num's in-memory entries, e.g. when the account is removed. Its spilled blocks stay in the file. """
+        ring = self.rings.pop(acct_num, None)
+        if ring is not None:
+            self.free.append(ring)
+
+    def append(self, acct_num, when, verb, amount, code, balance):
+        """ Add an entry to acct_num's history.
+        :param verb: One of VERBS
+        :param amount: The amount in cents
+        :param code: The result code, as an int
+        :param balance: The resulting balance in cents
+        """
+        ring = self.ring_of(acct_num)
+        if self.counts[ring] == self.depth:
+            self.spill(acct_num, ring)
+        index = ring * self.depth + (self.starts[ring] + self.counts[ring]) % self.depth
+        self.times[index] = when
+        self.verbs[index] = VERB_CODES[verb]
+        self.codes[index] = code
+        self.amounts[index] = amount
+        self.balances[index] = balance
+        self.counts[ring] += 1
+
+    def entry(self, index):
+        """ Return the in-memory entry at array index as (time, verb, amount, code, balance). """
+        return self.times[index], VERBS[self.verbs[index]], self.amounts[index], self.codes[index], self.balances[index]
+
+    def read_header(self, offset):
+        """ Return the header of the spilled block at offset as (count, number, jump number, total, jump total,
+        previous offset, jump offset). """
+        return BLOCK_HEADER.unpack(os.pread(self.fd, BLOCK_HEADER.size, offset))[1:]
+
+    def spill(self, acct_num, ring, count = None):
+        """ Move the oldest count entries (by default half) of acct_num's ring to the end of the spill file as one block. """
+        count = self.block if count is None else count
+        base, start = ring * self.depth, self.starts[ring]
+        previous, total = self.heads[ring], self.spilled[ring] + count
+        number, jump, jump_number, jump_total = 0, NO_BLOCK, 0, 0
+        if previous != NO_BLOCK:
+            _, prev_number, prev_jump_number, prev_total, prev_jump_total, _, prev_jump = self.read_header(previous)
+            number = prev_number + 1
+            jump, jump_number, jump_total = previous, prev_number, prev_total
+            if prev_jump != NO_BLOCK:
+                _, _, far_number, _, far_total, _, far = self.read_header(prev_jump)
+                if far != NO_BLOCK and prev_number - prev_jump_number == prev_jump_number - far_number:
+                    jump, jump_number, jump_total = far, far_number, far_total
+        block = bytearray(BLOCK_HEADER.pack(bank_store.pack_acct_num(acct_num), count, number, jump_number,
+                                            total, jump_total, previous, jump))
+        for back in range(count):
+            index = base + (start + back) % self.depth
+            block += ENTRY.pack(self.times[index], self.verbs[index], self.codes[index], self.amounts[index],
+                                self.balances[index])
+        os.write(self.fd, block)
+        self.heads[ring] = self.size
+        self.size += len(block)
+        self.spilled[ring] = total
+        self.starts[ring] = (start + count) % self.depth
+        self.counts[ring] -= count
+
+    def spill_all(self):
+        """ Move every entry held in memory to the spill file, so that another process opening it sees them all. """
+        for acct_num, ring in self.rings.items():
+            if self.counts[ring]:
+                self.spill(acct_num, ring, self.counts[ring])
+
+    def page(self, acct_num, skip, count):
+        """ Return (total, entries) for acct_num: the number of entries in its history, and up to count of them,
+        newest first, starting skip entries back from the newest. Entries are (time, verb, amount, code, balance). """
+        ring = self.rings.get(acct_num)
+        if ring is None:
+            return 0, []
+        held = self.counts[ring]
+        newest = self.starts[ring] + held - 1
+        entries = [self.entry(ring * self.depth + (newest - back) % self.depth)
+                   for back in range(skip, min(skip + count, held))]
+        # wanted is the position, counting from the oldest spilled entry, of the newest spilled entry on the page
+        wanted = self.spilled[ring] - 1 - max(skip - held, 0)
+        offset = self.heads[ring]
+        if len(entries) == count or wanted < 0 or offset == NO_BLOCK:
+            return held + self.spilled[ring], entries
+        spilled, _, _, total, jump_total, previous, jump = self.read_header(offset)
+        while total - spilled > wanted:
+            # The entry is older than this block: jump when that does not overshoot it, else step back one block
+            offset = jump if jump != NO_BLOCK and jump_total > wanted else previous
+            spilled, _, _, total, jump_total, previous, jump = self.read_header(offset)
+        while len(entries) < count:
+            # Entries are oldest first within a block, so the page is read from the wanted entry backwards
+            last = wanted - (total - spilled)
+            first = max(last + 1 - (count - len(entries)), 0)
+            data = os.pread(self.fd, (last + 1 - first) * ENTRY.size, offset + BLOCK_HEADER.size + first * ENTRY.size)
+            for when, verb, code, amount, balance in reversed(list(ENTRY.iter_unpack(data))):
+                entries.append((when, VERBS[verb], amount, code, balance))
+            wanted = total - spilled - 1
+            if previous == NO_BLOCK:
+                break
+            offset = previous
+            spilled, _, _, total, jump_total, previous, jump = self.read_header(offset)
+        return held + self.spilled[ring], entries
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Bank Server write-ahead journal
+#
+# Every committed change is appended to the journal as one line:
+#
+#     <seq> <acct-num> <balance> [<acct-num> <balance> ...] <crc32>
+#
+# where crc32 covers the text before it. A change that touches several accounts at once (a transfer
+# or a batch) is a single line, so after a crash it is replayed either completely or not at all.
+# Records are buffered in memory and written with a single fsync per event-loop batch (group commit).
+# Periodically the whole account table is written out as a binary snapshot (see bank_snapshot.py),
+# stamped with the last journal sequence number it contains, and the journal is truncated. Startup
+# maps the snapshot and replays the journal records after it.
+#
+# A compaction in the background renames the journal to <journal>.old and starts a fresh one, while a
+# thread writes the snapshot from a copy of the accounts taken as it starts. (A forked child is not safe
+# once the server runs other threads: it could inherit a lock one of them holds.) Once the snapshot is
+# in place the .old file is deleted; if it could not be written, or the server stopped before it was,
+# the .old records are put back in front of the journal's (and startup replays them first).
+
+import os
+import shutil
+import threading
+import zlib
+
+import bank_snapshot
+
+
+COMPACT_EVERY = 10000   # journal records between snapshot compactions, at least; see Journal.needs_compaction
+ROTATED_SUFFIX = ".old" # appended to the journal's file name while a background snapshot covers its records
+
+
+def format_record(seq, changes):
+    """ Return the journal line for one atomic change, checksum included.
+    :param changes: A list of (acct_num, new balance) pairs
+    """
+    body = " ".join([str(seq)] + [f"{acct_num} {balance:.2f}" for acct_num, balance in changes])
+    return f"{body} {zlib.crc32(body.encode('utf-8')):08x}\n"
+
+def parse_record(line):
+    """ Return (seq, [(acct_num, balance), ...]) for a journal line, or None if the line is torn or corrupt. """
+    body, _, crc = line.rstrip("\n").rpartition(" ")
+    fields = body.split(" ")
+    if len(fields) < 3 or len(fields) % 2 == 0 or crc != f"{zlib.crc32(body.encode('utf-8')):08x}":
+        return None
+    return int(fields[0]), [(fields[i], float(fields[i + 1])) for i in range(1, len(fields), 2)]
+
+def rotated_path(path):
+    """ Return the name the journal at path is kept under while a background snapshot is being written. """
+    return path + ROTATED_SUFFIX
+
+def read_journal(path, after_seq):
+    """ Return (records, valid_length) for the journal at path. records lists (seq, changes) for
+    every intact record with a sequence number above after_seq; valid_length is the size in bytes of the
+    intact prefix of the file. Reading stops at the first torn or corrupt record, which can only be the
+    tail of a write that was interrupted by a crash. """
+    records = []
+    valid_length = 0
+    if not os.path.exists(path):
+        return records, valid_length
+    with open(path, "rb") as f:
+        for line in f:
+            record = parse_record(line.decode("utf-8", errors="replace")) if line.endswith(b"\n") else None
+            if record is None:
+                break
+            valid_length += len(line)
+            if record[0] > after_seq:
+                records.append(record)
+    return records, valid_length
+
+class Journal:
+    """ An append-only journal of committed balance changes with group commit and snapshot compaction. """
+
+    def __init__(self, path, snapshot_path, last_seq = 0, valid_length = None, compact_every = COMPACT_EVERY):
+        """ Open the journal at path for appending. last_seq is the highest sequence number already on disk;
+        if valid_length is given, anything after that many bytes (a torn tail) is cut off first. """
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.seq = last_seq
+        self.compact_every = compact_every
+        self.pending = []
+        self.since_compact = 0
+        self.requested = False
+        self.writer = None      # (thread, errors it ran into) while a background snapshot is written
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        if valid_length is not None and os.fstat(self.fd).st_size > valid_length:
+            os.ftruncate(self.fd, valid_length)
+            os.fsync(self.fd)
+        # Left behind by a server that stopped while its snapshot was being written
+        self.merge_rotated()
+        bank_snapshot.fsync_dir(path)
+
+    def append(self, changes):
+        """ Buffer an atomic change, a list of (acct_num, new balance) pairs. It becomes durable at the next commit(). """
+        self.seq += 1
+        self.pending.append(format_record(self.seq, changes))
+
+    def commit(self):
+        """ Write every buffered record with a single write and fsync. Returns the number of records committed. """
+        if not self.pending:
+            return 0
+        data = "".join(self.pending).encode("utf-8")
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        os.fsync(self.fd)
+        count = len(self.pending)
+        self.pending.clear()
+        self.since_compact += count
+        return count
+
+    def needs_compaction(self, accounts = 0):
+        """ Return True once enough records have been committed since the last snapshot, or one was requested.
+        Enough is compact_every, or as many records as there are accounts if that is more: a snapshot costs time in
+        proportion to the accounts, and so does replaying that many records. """
+        return self.requested or self.since_compact >= max(self.compact_every, accounts)
+
+    def request_compaction(self):
+        """ Have the next commit take a snapshot, for changes the journal does not record (such as added accounts). """
+        self.requested = True
+
+    def defer_compaction(self):
+        """ Put compaction off for another compact_every records, after a snapshot that could not be written. """
+        self.since_compact = 0
+        self.requested = False
+
+    def compacting(self):
+        """ Return True while a background snapshot is being written. """
+        return self.writer is not None
+
+    def start_compaction(self, pack):
+        """ compact() without waiting for the snapshot: records from now on go to a fresh journal file, and a thread
+        writes the snapshot while the caller carries on. Must be called with nothing pending and no compaction under
+        way; finish_compaction() collects the thread. Raises OSError if the thread cannot be started.
+        :param pack: Called on the thread with the current sequence number, returns the snapshot's contents; it
+        must only read what the caller does not change meanwhile, such as a copy of the accounts
+        """
+        rotated = rotated_path(self.path)
+        os.close(self.fd)
+        os.replace(self.path, rotated)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        bank_snapshot.fsync_dir(self.path)
+        self.since_compact = 0
+        self.requested = False
+        errors = []
+
+        def write(seq = self.seq):
+            try:
+                bank_snapshot.write_packed(self.snapshot_path, pack(seq))
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=write, name="snapshot-writer", daemon=True)
+        try:
+            writer.start()
+        except RuntimeError as e:
+            self.merge_rotated()
+            raise OSError(f"could not start the snapshot writer: {e}") from e
+        self.writer = (writer, errors)
+
+    def finish_compaction(self, block = False):
+        """ Collect the thread writing a background snapshot once it has finished, waiting for it if block. Returns
+        True if the snapshot is in place and the rotated journal has been deleted. If the snapshot could not be
+        written, the rotated records are put back in the journal and OSError is raised with the thread's error.
+        Returns False while the thread is still running or if there is none. """
+        if self.writer is None:
+            return False
+        writer, errors = self.writer
+        if block:
+            writer.join()
+        elif writer.is_alive():
+            return False
+        self.writer = None
+        if errors:
+            self.merge_rotated()
+            if isinstance(errors[0], OSError):
+                raise errors[0]
+            raise OSError(str(errors[0])) from errors[0]
+        os.unlink(rotated_path(self.path))
+        bank_snapshot.fsync_dir(self.path)
+        return True
+
+    def merge_rotated(self):
+        """ Put the records of a rotated journal back in front of the journal's, if there is one. Should the process
+        die part way, both files are still there and the merge is done again at startup; records it leaves in the
+        journal twice are replayed twice, in order, to the same result. """
+        rotated = rotated_path(self.path)
+        if not os.path.exists(rotated):
+            return
+        merged_path = self.path + ".tmp"
+        with open(merged_path, "wb") as merged:
+            for part in (rotated, self.path):
+                with open(part, "rb") as f:
+                    shutil.copyfileobj(f, merged)
+            merged.flush()
+            os.fsync(merged.fileno())
+        os.replace(merged_path, self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        os.unlink(rotated)
+        bank_snapshot.fsync_dir(self.path)
+
+    def compact(self, accounts):
+        """ Write a snapshot of accounts covering every committed record, then empty the journal.
+        Must be called with nothing pending. If the process dies between the two steps, replay simply
+        skips the records the snapshot already covers. """
+        bank_snapshot.write_snapshot(self.snapshot_path, self.seq, accounts)
+        self.truncate()
+
+    def compact_packed(self, data):
+        """ compact() with the snapshot's contents already packed, stamped with the current sequence number. """
+        bank_snapshot.write_packed(self.snapshot_path, data)
+        self.truncate()
+
+    def truncate(self):
+        """ Empty the journal once a snapshot covers everything in it. """
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        self.since_compact = 0
+        self.requested = False
+
+    def close(self):
+        """ Commit anything still buffered and close the journal file. """
+        self.commit()
+        os.close(self.fd)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#
+# Bank Server metrics and logging
+#
+# Metrics are plain counters and power-of-two latency histograms updated inline by the event loop,
+# so recording a request costs a few integer operations. They are read through the server's local
+# admin socket:
+#
+#     python3 bank_metrics.py bank_admin.sock          # prints the STATS report as JSON
+#
+# Logging goes through the standard logging module into a buffering handler: records below the
+# configured level are dropped by a cached level check before any formatting, and the ones that pass
+# are written out in batches instead of one synchronous write per line.
+#
+# For a closer look at where the time goes, the event loop can be run under cProfile for a while
+# without restarting the server (PROFILE START / PROFILE STOP on the admin socket, or SIGUSR1 to
+# toggle it); the profile is written in the pstats format.
+
+import cProfile
+import io
+import logging
+import logging.handlers
+import pstats
+import socket
+import sys
+import time
+
+
+LOG_BUFFER_RECORDS = 256    # log records buffered before they are written out
+LOG_FLUSH_INTERVAL = 1.0    # seconds a buffered log record may wait to be written
+HISTOGRAM_BUCKETS = 64      # bucket i counts latencies below 2**i microseconds
+PROFILE_TOP = 25            # functions listed in the summary of a stopped profile
+# The stages a request goes through on the event loop, timed separately (the asyncio engine's
+# transports do their own reads, so it has no read samples)
+STAGES = ("read", "parse", "handle", "commit", "send")
+
+log = logging.getLogger("bank_server")
+
+
+class Histogram:
+    """ A latency histogram with power-of-two microsecond buckets. """
+    __slots__ = ("buckets", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """ Add one sample. """
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def count(self):
+        return sum(self.buckets)
+
+    def percentile_ms(self, fraction):
+        """ Return the latency, in milliseconds, below which the given fraction of the samples falls. It is
+        interpolated within its bucket, which is twice as wide as the one before, and never above the largest sample. """
+        target = fraction * self.count()
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            if count and seen + count >= target:
+                lower = (1 << index >> 1) / 1000
+                upper = (1 << index) / 1000
+                estimate = lower + (upper - lower) * (target - seen) / count
+                return round(min(estimate, self.max * 1000), 3)
+            seen += count
+        return 0.0
+
+    def report(self):
+        """ Return a summary of the histogram as plain data. """
+        count = self.count()
+        return {
+            "count": count,
+            "mean_ms": round(self.total / count * 1000, 3) if count else 0.0,
+            "p50_ms": self.percentile_ms(0.50),
+            "p99_ms": self.percentile_ms(0.99),
+            "p999_ms": self.percentile_ms(0.999),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+class Metrics:
+    """ Everything the server counts: requests and their latency per verb, replies per result code,
+    connections, and the duration of each event loop iteration. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.verbs = dict()         # request code -> Histogram of handling time
+        self.results = dict()       # result code, "balance" or "none" (no reply) -> replies sent
+        self.accepted = 0
+        self.closed = 0
+        self.refused = 0            # connections turned away at the connection limit
+        self.evicted = 0            # sessions disconnected for being idle
+        self.loop_busy = Histogram()    # time from select() returning to the next select() call
+        self.loop_wait = Histogram()    # time blocked in select()
+        self.stages = {stage: Histogram() for stage in STAGES}
+
+    def record_request(self, verb, reply, seconds):
+        """ Count one processed request. verb is its request code ("other" if unrecognised). """
+        histogram = self.verbs.get(verb)
+        if histogram is None:
+            histogram = self.verbs[verb] = Histogram()
+        histogram.record(seconds)
+        if reply is None:
+            code = "none"
+        elif reply[3:4] in ("", " ") and reply[:3].isdigit():
+            code = reply[:3]
+        else:
+            code = "balance"
+        self.results[code] = self.results.get(code, 0) + 1
+
+    def report(self, sessions):
+        """ Return the STATS report as plain data. sessions is the server's SessionRegistry. """
+        return {
+            "uptime_sec": round(time.time() - self.started, 1),
+            "sessions": {"active": len(sessions), "logged_in": len(sessions.by_acct)},
+            "connections": {"accepted": self.accepted, "closed": self.closed, "refused": self.refused,
+                            "evicted": self.evicted},
+            "requests": {verb: histogram.report() for verb, histogram in sorted(self.verbs.items())},
+            "results": dict(sorted(self.results.items())),
+            "loop": {"busy": self.loop_busy.report(), "wait": self.loop_wait.report()},
+            "stages": {stage: histogram.report() for stage, histogram in self.stages.items()},
+        }
+
+class Profiler:
+    """ cProfile, started and stopped while the server runs. Only the thread that starts it is profiled. """
+
+    def __init__(self):
+        self.profile = None
+        self.started = None
+
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        """ Start profiling. Returns False if the profiler is already running. """
+        if self.profile is not None:
+            return False
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.profile.enable()
+        return True
+
+    def stop(self, path):
+        """ Stop profiling and write the profile to path. Returns a summary of it: the functions that took the
+        most time, callees included. Returns None if the profiler is not running. """
+        if self.profile is None:
+            return None
+        profile = self.profile
+        profile.disable()
+        try:
+            profile.dump_stats(path)
+        except OSError:
+            # Keep profiling, so the profile can still be written somewhere else
+            profile.enable()
+            raise
+        self.profile = None
+        summary = io.StringIO()
+        print(f"profile of {time.time() - self.started:.1f} s written to {path}", file=summary)
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        return summary.getvalue()
+
+##########################################################
+#                                                        #
+# Buffered Logging                                       #
+#                                                        #
+##########################################################
+
+class BufferedHandler(logging.handlers.BufferingHandler):
+    """ Holds log records in memory and writes them to stream with a single write: when the buffer is full, when
+    an error is logged, or once the oldest buffered record is LOG_FLUSH_INTERVAL old. """
+
+    def __init__(self, stream):
+        super().__init__(LOG_BUFFER_RECORDS)
+        self.stream = stream
+        self.oldest = None
+
+    def shouldFlush(self, record):
+        if self.oldest is None:
+            self.oldest = record.created
+        return (len(self.buffer) >= self.capacity or record.levelno >= logging.ERROR
+                or record.created - self.oldest >= LOG_FLUSH_INTERVAL)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.stream.write("".join(self.format(record) + "\n" for record in self.buffer))
+                self.stream.flush()
+                self.buffer.clear()
+            self.oldest = None
+        finally:
+            self.release()
+
+    def flush_if_stale(self):
+        """ Write out buffered records that have waited LOG_FLUSH_INTERVAL; called from the server's loop. """
+        if self.oldest is not None and time.time() - self.oldest >= LOG_FLUSH_INTERVAL:
+            self.flush()
+
+def flush_logs(stale_only = False):
+    """ Write out the buffered log records; with stale_only, only if the oldest has waited LOG_FLUSH_INTERVAL. """
+    for handler in log.handlers:
+        if isinstance(handler, BufferedHandler):
+            if stale_only:
+                handler.flush_if_stale()
+            else:
+                handler.flush()
+
+def configure_logging(level):
+    """ Send the server's log records at or above level (a name such as "info") to stdout through a buffer. """
+    log.addHandler(BufferedHandler(sys.stdout))
+    log.setLevel(level.upper())
+    log.propagate = False
+
+##########################################################
+#                                                        #
+# Admin Socket Client                                    #
+#                                                        #
+##########################################################
+
+def query(admin_path, command = "STATS"):
+    """ Send one command to the admin socket at admin_path and return the decoded reply. """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(admin_path)
+        sock.sendall(command.encode("ascii") + b"\n")
+        reply = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    return reply.decode("utf-8")
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("usage: bank_metrics.py ADMIN_SOCKET [COMMAND]")
+        sys.exit(2)
+    print(query(*sys.argv[1:]))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Bank Server PIN hashing
+#
+# A PIN may be stored either as the plain four digits or as a salted, deliberately slow hash:
+#
+#     pbkdf2_sha256$<iterations>$<salt, hex>$<PBKDF2-HMAC-SHA256 digest, hex>
+#
+# Hex keeps the hash intact through the account file loader, which lower-cases every line.
+# Verifying a hash takes tens of milliseconds on purpose, so the server runs it in a thread pool
+# (hashlib releases the GIL while it works) instead of on the event loop.
+#
+# Replace the PINs of an account file with hashes:   python3 bank_pins.py accounts.txt > hashed.txt
+
+import hashlib
+import hmac
+import os
+import sys
+
+
+SCHEME = "pbkdf2_sha256"
+ITERATIONS = 100000     # PBKDF2 rounds for newly hashed PINs; stored hashes carry their own count
+SALT_BYTES = 16
+HASH_WIDTH = len(SCHEME) + 1 + 7 + 1 + SALT_BYTES * 2 + 1 + 64     # longest hash text, with up to 7 iteration digits
+
+
+def hash_pin(pin, iterations = ITERATIONS, salt = None):
+    """ Return the hash text for a PIN, with a fresh random salt unless one is given. """
+    salt = os.urandom(SALT_BYTES) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac("sha256", pin.encode("ascii"), salt, iterations)
+    return f"{SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def is_pin_hash(stored):
+    """ Return True if a stored PIN is a hash rather than plain digits. """
+    return stored.startswith(SCHEME + "$")
+
+def verify_pin(stored, pin):
+    """ Return True if pin matches the stored PIN, which may be plain digits or a hash. Slow for hashes. """
+    if not is_pin_hash(stored):
+        return hmac.compare_digest(stored.encode("ascii"), pin.encode("ascii"))
+    try:
+        _, iterations, salt, digest = stored.split("$")
+        expected = bytes.fromhex(digest)
+        actual = hashlib.pbkdf2_hmac("sha256", pin.encode("ascii"), bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        # A malformed hash matches nothing
+        return False
+    return hmac.compare_digest(expected, actual)
+
+def hash_account_file(acct_file, out = sys.stdout, iterations = ITERATIONS):
+    """ Copy a text account file to out with every plain PIN replaced by its hash. """
+    with open(acct_file, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split(",")
+            if line[0] != "#" and len(fields) == 3 and fields[1].strip().isdigit():
+                fields[1] = " " + hash_pin(fields[1].strip(), iterations)
+                line = ",".join(fields) + "\n"
+            out.write(line)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: bank_pins.py ACCOUNT_FILE > HASHED_ACCOUNT_FILE", file=sys.stderr)
+        sys.exit(2)
+    hash_account_file(sys.argv[1])
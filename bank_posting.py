@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Bank Server end-of-day posting
+#
+# A posting applies one schedule to every account at once: interest is credited on positive
+# balances, then a flat maintenance fee is charged. Both follow the per-request rules: amounts are
+# whole cents (interest is rounded half to even, as round() does), interest that would take a balance
+# past bank_store.MAX_CENTS is refused like a deposit that would, and a fee larger than the balance
+# is refused like an overdrawing withdrawal, never taken in part.
+#
+# The schedule is applied to a column of balances in integer cents. With NumPy installed, that is a
+# handful of whole-array operations with the rules as boolean masks; without it, a plain loop
+# computes the same result. The array-backed store (bank_store.py) already keeps its balances in
+# such a column, so it is posted in place through a NumPy view of it, and pack_store writes its
+# snapshot without building an object per account.
+
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import bank_snapshot
+import bank_store
+
+
+class Schedule:
+    """ What a posting applies to each account. """
+
+    def __init__(self, rate = 0.0, fee = 0, waive_at = None):
+        """
+        :param rate: Interest credited, as a fraction of a positive balance
+        :param fee: The maintenance fee in cents
+        :param waive_at: The balance in cents, after interest, from which the fee is waived; None never waives it
+        """
+        if not rate >= 0 or fee < 0:
+            raise ValueError("interest rate and fee must not be negative")
+        self.rate = rate
+        self.fee = fee
+        self.waive_at = waive_at
+
+def parse_schedule(args):
+    """ Return the Schedule given by rate=FRACTION, fee=DOLLARS and waive=DOLLARS arguments; any may be left out.
+    Raises ValueError for anything else. """
+    values = dict()
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if not sep or name.lower() not in ("rate", "fee", "waive") or name.lower() in values:
+            raise ValueError(f"unexpected argument {arg!r}")
+        values[name.lower()] = float(value)
+        if not math.isfinite(values[name.lower()]):
+            raise ValueError(f"not a finite number: {arg!r}")
+    cents = {name: round(values[name] * 100) for name in ("fee", "waive") if name in values}
+    return Schedule(values.get("rate", 0.0), cents.get("fee", 0), cents.get("waive"))
+
+def post_cents(cents, schedule):
+    """ Return (posted balances, summary) for a column of balances in cents, which is left unchanged. With NumPy,
+    cents may be anything numpy.asarray accepts and the posted balances are an int64 array; without it, cents is
+    an iterable of ints and they are an array("q"). The summary counts what the posting did, amounts in cents. """
+    if numpy is None:
+        return post_cents_loop(cents, schedule)
+    cents = numpy.asarray(cents, dtype=numpy.int64)
+    with numpy.errstate(over="ignore"):
+        exact = numpy.rint(cents * schedule.rate)
+    exact[cents <= 0] = 0
+    # Interest of 2**63 cents or more cannot even be converted; the rest is refused if the balance has no room for it
+    unrepresentable = ~(exact < 2.0 ** 63)
+    exact[unrepresentable] = 0
+    interest = exact.astype(numpy.int64)
+    room = bank_store.MAX_CENTS - numpy.maximum(cents, 0)
+    refused_interest = unrepresentable | (interest > room)
+    interest[refused_interest] = 0
+    posted = cents + interest
+    charged = refused = 0
+    if schedule.fee:
+        due = posted < schedule.waive_at if schedule.waive_at is not None else numpy.ones(len(posted), dtype=bool)
+        covered = posted >= schedule.fee
+        charged = int(numpy.count_nonzero(due & covered))
+        refused = int(numpy.count_nonzero(due)) - charged
+        posted -= numpy.where(due & covered, schedule.fee, 0)
+    return posted, summary(len(posted), int(interest.sum()), int(numpy.count_nonzero(refused_interest)), charged,
+                           refused, schedule.fee)
+
+def post_cents_loop(cents, schedule):
+    """ post_cents one balance at a time, for when NumPy is not installed. """
+    posted = array("q")
+    total_interest = refused_interest = charged = refused = 0
+    for balance in cents:
+        if balance > 0:
+            exact = balance * schedule.rate
+            if not math.isfinite(exact) or round(exact) > bank_store.MAX_CENTS - balance:
+                refused_interest += 1
+            else:
+                interest = round(exact)
+                balance += interest
+                total_interest += interest
+        if schedule.fee and (schedule.waive_at is None or balance < schedule.waive_at):
+            if balance >= schedule.fee:
+                balance -= schedule.fee
+                charged += 1
+            else:
+                refused += 1
+        posted.append(balance)
+    return posted, summary(len(posted), total_interest, refused_interest, charged, refused, schedule.fee)
+
+def summary(accounts, interest, interest_refused, charged, refused, fee):
+    """ Return the summary of a posting as plain data. """
+    return {"accounts": accounts, "interest_cents": interest, "interest_refused": interest_refused,
+            "fee_cents": charged * fee, "fees_charged": charged, "fees_refused": refused}
+
+def post_store(store, schedule):
+    """ Post schedule to every account of a bank_store.AccountStore. The balances are replaced all at once, after
+    everything has been computed. Returns the summary. """
+    if numpy is None:
+        posted, result = post_cents_loop(store.cents, schedule)
+        store.cents[:] = posted
+        return result
+    balances = numpy.frombuffer(store.cents, dtype=numpy.int64)
+    try:
+        posted, result = post_cents(balances, schedule)
+        balances[:] = posted
+    finally:
+        # The store's arrays cannot grow while a view of them exists
+        del balances
+    return result
+
+def pack_store(store, seq, source = None):
+    """ Return the contents of a snapshot of every account in store, as bank_snapshot.pack_records would, built with
+    whole-array operations. Returns None if NumPy is not installed or some PIN is hashed; pack_records does those. """
+    if numpy is None or store.pin_hashes:
+        return None
+    ids = numpy.frombuffer(store.ids, dtype=numpy.int32)
+    pins = numpy.frombuffer(store.pins, dtype=numpy.uint16)
+    order = numpy.argsort(ids, kind="stable")   # packed ids sort the way account numbers do
+    ids, pins = ids[order], pins[order]
+    # One row of bytes per record, laid out as bank_snapshot.RECORD: account number, PIN, balance
+    records = numpy.zeros((len(ids), bank_snapshot.RECORD.size), dtype=numpy.uint8)
+    letters, digits = numpy.divmod(ids, 100000)
+    records[:, 0] = ord("a") + letters // 26
+    records[:, 1] = ord("a") + letters % 26
+    records[:, 2] = ord("-")
+    for place in range(5):
+        records[:, 7 - place] = ord("0") + digits // 10 ** place % 10
+    for place in range(4):
+        records[:, 11 - place] = ord("0") + pins // 10 ** place % 10
+    # An account without a valid PIN is stored with an empty PIN field
+    records[pins == bank_store.NO_PIN, 8:12] = 0
+    cents = numpy.frombuffer(store.cents, dtype=numpy.int64)[order].astype("<i8")
+    records[:, 12:] = cents.view(numpy.uint8).reshape(-1, 8)
+    return bank_snapshot.pack_header(bank_snapshot.RECORD.size, len(records), seq, source) + records.tobytes()
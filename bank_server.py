@@ -3,17 +3,74 @@
 # Bank Server application
 # Jimmy da Geek
 
+import argparse
+import base64
+import collections
+import concurrent.futures
+import functools
+import itertools
+import json
+import os
+import queue
+import resource
+import select
+import signal
 import socket
 import selectors
+import stat
+import struct
 import sys
-import re
-import types
+import time
+import zlib
+
+import bank_accountfile
+import bank_admission
+from bank_accountfile import acctNumberIsValid, acctPinIsValid, pinIsStorable
+import bank_history
+import bank_journal
+import bank_metrics
+import bank_pins
+import bank_posting
+import bank_snapshot
+import bank_store
+import bank_timers
+import bank_trace
+import bank_wire
 
 
 ALL_ACCOUNTS = dict()   # initialize an empty dictionary
 ACCT_FILE = "accounts.txt"
+JOURNAL_FILE = "accounts.journal"
+SNAPSHOT_FILE = "accounts.snap"
+HISTORY_FILE = "accounts.hist"
+ADMIN_SOCKET = "bank_admin.sock"
+PROFILE_FILE = "bank_server.prof"
+journal = None          # the bank_journal.Journal, or None when journaling is disabled
+history = None          # the bank_history.History, or None when transaction history is disabled
+shard_id = 0            # the account partition this process owns when running with --workers > 1
+shard_count = 1         # number of worker processes the accounts are partitioned across
+shard_inboxes = []      # a ShardOutbox for every worker's handoff socket, indexed by shard
+shard_inbox = None      # this worker's receiving end, on which other workers hand over connections
 sel = selectors.DefaultSelector()
-client_dict = dict()
+metrics = bank_metrics.Metrics()
+log = bank_metrics.log
+admin_path = None       # the local admin socket's path, or None when it is disabled
+RECV_SIZE = 4096        # bytes read from a client socket per readiness event
+MAX_FRAME_LEN = 4096    # largest message accepted in framed mode; a tagged BATCH of MAX_BATCH_OPS transfers fits
+MAX_LENGTH_DIGITS = 4   # digits in the length prefix of the largest frame
+MAX_BATCH_OPS = 100     # most operations a single BATCH request may carry
+MAX_CHANNELS = 256      # most logical sessions a single connection may multiplex
+MAX_HELD = 32           # most requests a session may send behind a login that waits for its PIN check
+OUTB_HIGH_WATER = 65536 # stop reading from a client while this many reply bytes wait for it to catch up
+IDLE_TIMEOUT = 300.0    # seconds a logged-in session may sit silent before it is disconnected
+LOGIN_TIMEOUT = 60.0    # seconds a connection may sit silent without being logged in
+TIMER_TICK = 1.0        # resolution of the idle timers, in seconds
+FD_RESERVE = 64         # descriptors kept back from clients for journal, snapshot, admin and handoff sockets
+RELOAD_INTERVAL = 5.0   # seconds between checks of the account file for changes
+RELOAD_SLICE = 500      # account file records applied per event loop iteration during a reload
+HIST_PAGE = 10          # history entries returned by HIST when the client does not say how many
+HIST_PAGE_MAX = 20      # most history entries a single HIST reply may carry
+MAX_AMOUNT_DIGITS = 17  # digits in the largest amount whose value in cents fits bank_store.MAX_CENTS
 
 
 ##########################################################
@@ -24,22 +81,6 @@ client_dict = dict()
 #                                                        #
 ##########################################################
 
-def acctNumberIsValid(ac_num):
-    """Return True if ac_num represents a valid account number. This does NOT test whether the account actually exists, only
-    whether the value of ac_num is properly formatted to be used as an account number.  A valid account number must be a string,
-    lenth = 8, and match the format AA-NNNNN where AA are two alphabetic characters and NNNNN are five numeric characters."""
-    return isinstance(ac_num, str) and \
-        len(ac_num) == 8 and \
-        ac_num[2] == '-' and \
-        ac_num[:2].isalpha() and \
-        ac_num[3:8].isdigit()
-
-def acctPinIsValid(pin):
-    """Return True if pin represents a valid PIN number. A valid PIN number is a four-character string of only numeric characters."""
-    return (isinstance(pin, str) and \
-        len(pin) == 4 and \
-        pin.isdigit())
-
 def amountIsValid(amount):
     """Return True if amount represents a valid amount for banking transactins. For an amount to be valid it must be a positive float()
     value with at most two decimal places."""
@@ -48,16 +89,16 @@ def amountIsValid(amount):
 class BankAccount:
     """BankAccount instances are used to encapsulate various details about individual bank accounts."""
     acct_number = ''        # a unique account number
-    acct_pin = ''           # a four-digit PIN code represented as a string
+    acct_pin = ''           # a four-digit PIN code represented as a string, or a hash of one
     acct_balance = 0.0      # a float value of no more than two decimal places
     
     def __init__(self, ac_num = "zz-00000", ac_pin = "0000", bal = 0.0):
         """ Initialize the state variables of a new BankAccount instance. """
         if acctNumberIsValid(ac_num):
             self.acct_number = ac_num
-        if acctPinIsValid(ac_pin):
+        if pinIsStorable(ac_pin):
             self.acct_pin = ac_pin
-        if amountIsValid(bal):
+        if amountIsValid(bal) and bal * 100 <= bank_store.MAX_CENTS:
             self.acct_balance = bal
 
     def deposit(self, amount):
@@ -67,6 +108,9 @@ class BankAccount:
         result_code = "020"
         if not amountIsValid(amount):
             result_code = "021"
+        elif round((self.acct_balance + amount) * 100) > bank_store.MAX_CENTS:
+            # the new balance could not be stored in integer cents
+            result_code = "021"
         else:
             # valid amount, so add it to balance and set succes_code 1
             self.acct_balance += amount
@@ -91,8 +135,9 @@ class BankAccount:
 def get_acct(acct_num):
     """ Lookup acct_num in the ALL_ACCOUNTS database and return the account object if it's found.
         Return False if the acct_num is invalid. """
-    if acctNumberIsValid(acct_num) and (acct_num in ALL_ACCOUNTS):
-        return ALL_ACCOUNTS[acct_num]
+    if acctNumberIsValid(acct_num):
+        # a single get() rather than 'in' followed by [] halves the lookups for the account stores
+        return ALL_ACCOUNTS.get(acct_num, False)
     else:
         return False
 
@@ -101,23 +146,23 @@ def load_account(num_str, pin_str, bal_str):
     try:
         # it is possible that bal_str does not represent a float, so be sure to catch that error.
         bal = float(bal_str)
-        if acctNumberIsValid(num_str):
+        if acctNumberIsValid(num_str) and owns_account(num_str):
             if get_acct(num_str):
-                print(f"Duplicate account detected: {num_str} - ignored")
+                log.warning("Duplicate account detected: %s - ignored", num_str)
                 return False
             # We have a valid new account number not previously loaded
             new_acct = BankAccount(num_str, pin_str, bal)
             # Add the new account instance to the in-memory database
             ALL_ACCOUNTS[num_str] = new_acct
-            print(f"loaded account '{num_str}'")
+            log.debug("loaded account '%s'", num_str)
             return True
     except ValueError:
-        print(f"error loading acct '{num_str}': balance value not a float")
+        log.warning("error loading acct '%s': balance value not a float", num_str)
     return False
     
 def load_all_accounts(acct_file = "accounts.txt"):
     """ Load all accounts into the in-memory database, reading from a file in the same directory as the server application. """
-    print(f"loading account data from file: {acct_file}")
+    log.info("loading account data from file: %s", acct_file)
     with open(acct_file, "r") as f:
         while True:
             line = f.readline()
@@ -130,12 +175,1054 @@ def load_all_accounts(acct_file = "accounts.txt"):
             # convert all alpha characters to lowercase and remove whitespace, then split on comma
             acct_data = line.lower().replace(" ", "").split(',')
             if len(acct_data) != 3:
-                print("ERROR: invalid entry in account file: '{line}' - IGNORED")
+                log.warning("ERROR: invalid entry in account file: '%s' - IGNORED", line.rstrip("\n"))
                 continue
             load_account(acct_data[0], acct_data[1], acct_data[2])
-    print("finished loading account data")
+    log.info("finished loading account data")
     return True
 
+##########################################################
+#                                                        #
+# Bank Server Durability                                 #
+#                                                        #
+# Balance changes are journaled and group-committed once #
+# per event-loop batch (see bank_journal.py).            #
+#                                                        #
+##########################################################
+
+def record_balance(*accts):
+    """ Journal the current balances of accts as one atomic change, if journaling is enabled.
+    The change becomes durable at the next commit_batch(). """
+    if journal is not None:
+        journal.append([(acct.acct_number, acct.acct_balance) for acct in accts])
+
+def replay_journal(journal_file, after_seq):
+    """ Reapply every journaled balance newer than after_seq to the in-memory database, starting with the records of
+    a journal that was rotated for a snapshot that never got written. Returns the last sequence number seen and the
+    byte length of the intact part of the journal. """
+    records, _ = bank_journal.read_journal(bank_journal.rotated_path(journal_file), after_seq)
+    newer, valid_length = bank_journal.read_journal(journal_file, records[-1][0] if records else after_seq)
+    records += newer
+    last_seq = after_seq
+    for seq, changes in records:
+        for acct_num, balance in changes:
+            acct = get_acct(acct_num)
+            if acct:
+                acct.acct_balance = balance
+        last_seq = seq
+    log.info("replayed %d journal records", len(records))
+    return last_seq, valid_length
+
+def make_account(acct_num, pin, cents):
+    """ Build the BankAccount for a snapshot record. """
+    return BankAccount(acct_num, pin, cents / 100)
+
+def use_account_store(capacity = 1024):
+    """ Replace the ALL_ACCOUNTS dictionary with a compact array-backed store (see bank_store.py). """
+    global ALL_ACCOUNTS
+    ALL_ACCOUNTS = bank_store.AccountStore(capacity)
+
+def load_snapshot(snapshot_file):
+    """ Serve accounts from a memory-mapped binary snapshot (see bank_snapshot.py). With the dictionary store,
+    records only become BankAccount objects the first time they are used; an array-backed store is filled
+    from the snapshot up front. Returns the bank_snapshot.Snapshot. """
+    global ALL_ACCOUNTS
+    snapshot = bank_snapshot.Snapshot(snapshot_file)
+    if isinstance(ALL_ACCOUNTS, bank_store.AccountStore):
+        for acct_num, pin, cents in snapshot:
+            if owns_account(acct_num):
+                ALL_ACCOUNTS.add(acct_num, pin, cents)
+        log.info("loaded %d accounts from snapshot: %s", snapshot.count, snapshot_file)
+    else:
+        ALL_ACCOUNTS = bank_snapshot.SnapshotAccounts(snapshot, make_account)
+        log.info("mapped %d accounts from snapshot: %s", snapshot.count, snapshot_file)
+    return snapshot
+
+def load_accounts(acct_file, snapshot_file):
+    """ Load the accounts from the snapshot if there is one (a worker's own compacted snapshot first, then the
+    shared one), otherwise from the text account file. Accounts from a snapshot are then brought in line with the
+    watched account file (see apply_account_file). Returns the journal sequence number the loaded state covers, and
+    True if the account file changed the accounts. """
+    global reload_applied
+    for candidate in (shard_file(snapshot_file), snapshot_file):
+        if os.path.exists(candidate):
+            snapshot = load_snapshot(candidate)
+            return snapshot.journal_seq, apply_account_file(snapshot)
+    load_all_accounts(acct_file)
+    # The file was stamped before it was read, so later edits are never taken to be in the accounts
+    reload_applied = reload_stamp
+    return 0, False
+
+def open_journal(journal_file, snapshot_file, last_seq):
+    """ Opens the journal for records after last_seq without replaying it, for accounts that are already current. """
+    global journal
+    journal = bank_journal.Journal(shard_file(journal_file), shard_file(snapshot_file), last_seq)
+
+def load_durable_state(acct_file, journal_file, snapshot_file):
+    """ Load the accounts from the latest snapshot (or from acct_file if no snapshot has been taken yet),
+    replay the journal on top of them and open the journal for new records. """
+    global journal
+    # Accounts the account file added are in place before their journaled balances are replayed
+    snapshot_seq, edited = load_accounts(acct_file, snapshot_file)
+    last_seq, valid_length = replay_journal(shard_file(journal_file), snapshot_seq)
+    journal = bank_journal.Journal(shard_file(journal_file), shard_file(snapshot_file), last_seq, valid_length)
+    if edited:
+        # As after a reload, only the next snapshot makes the new account set durable
+        journal.request_compaction()
+
+def commit_batch():
+    """ Group commit: make every change from the current event-loop batch durable with one fsync, and
+    compact the journal into a new snapshot, in the background, when it has grown long enough. """
+    started = time.perf_counter()
+    if journal is not None:
+        committed = journal.commit()
+        if committed:
+            metrics.stages["commit"].record(time.perf_counter() - started)
+        finish_compaction()
+        if not journal.compacting() and journal.needs_compaction(len(ALL_ACCOUNTS)):
+            start_compaction()
+    if untimed_commits:
+        trace_commit(time.perf_counter() - started)
+    if pending_pushes:
+        deliver_pushes()
+
+def pack_snapshot(seq):
+    """ Returns the contents of a snapshot of the accounts this server owns, stamped with journal sequence seq. """
+    return snapshot_packer()(seq)
+
+def snapshot_packer():
+    """ Returns a function that packs pack_snapshot's snapshot of the accounts as they are now, given the journal
+    sequence number. It packs a copy, so it can run on another thread while the loop carries on changing the
+    accounts: an AccountStore is copied array by array and account objects as records, while the records a
+    SnapshotAccounts has not materialized are read from its snapshot, which never changes. """
+    source = account_file_source()
+    if isinstance(ALL_ACCOUNTS, bank_store.AccountStore):
+        store = ALL_ACCOUNTS.copy()
+        return lambda seq: bank_posting.pack_store(store, seq, source) or \
+            bank_snapshot.pack_records(seq, bank_snapshot.account_records(store.values()), source)
+    records = list(bank_snapshot.account_records(
+        acct for acct in dict.values(ALL_ACCOUNTS) if owns_account(acct.acct_number)))
+    if isinstance(ALL_ACCOUNTS, bank_snapshot.SnapshotAccounts):
+        snapshot, skipped = ALL_ACCOUNTS.snapshot, set(dict.keys(ALL_ACCOUNTS)) | ALL_ACCOUNTS.removed
+        records = itertools.chain(records, (record for record in snapshot
+                                            if record[0] not in skipped and owns_account(record[0])))
+    return lambda seq: bank_snapshot.pack_records(seq, records, source)
+
+def start_compaction():
+    """ Has a thread replace the snapshot with the accounts this server owns, as they are now, while the loop
+    carries on (see bank_journal.Journal.start_compaction). Should the thread not start, the error is logged and the
+    journal kept until the next compaction. """
+    try:
+        journal.start_compaction(snapshot_packer())
+    except OSError as e:
+        log.error("Could not start compacting the journal into %s: %s", journal.snapshot_path, e)
+        journal.defer_compaction()
+
+def finish_compaction(block = False):
+    """ Collects the thread writing a background snapshot once it has finished, waiting for it if block. Should the
+    snapshot not have been written, the error is logged and the journal kept until the next compaction, so nothing
+    is lost. """
+    if journal is None:
+        return
+    try:
+        journal.finish_compaction(block)
+    except OSError as e:
+        log.error("Could not compact the journal into %s: %s", journal.snapshot_path, e)
+        journal.defer_compaction()
+
+def compact_journal():
+    """ Replaces the snapshot with the accounts this server owns and empties the journal, before the loop carries
+    on. Should the snapshot not be writable, the error is logged and the journal kept until the next compaction.
+    Returns that error, or None once the snapshot is written. """
+    # A background snapshot finishing later would replace this newer one
+    finish_compaction(block=True)
+    try:
+        journal.compact_packed(pack_snapshot(journal.seq))
+    except (OSError, ValueError) as e:
+        log.error("Could not compact the journal into %s: %s", journal.snapshot_path, e)
+        journal.defer_compaction()
+        return e
+    return None
+
+##########################################################
+#                                                        #
+# Bank Server Transaction History                        #
+#                                                        #
+# The outcome of every DEP, WD, TRANSFER and BATCH is    #
+# added to the account's history, which the HIST request #
+# pages through (see bank_history.py).                   #
+#                                                        #
+##########################################################
+
+def open_history(history_file, depth):
+    """ Start keeping transaction histories, depth entries per account in memory and the rest in history_file.
+    A depth of 0 leaves history disabled. """
+    global history
+    if depth > 0:
+        history = bank_history.History(shard_file(history_file), depth)
+
+def record_history(acct, verb, amount, code, balance = None):
+    """ Adds an entry to acct's history, if history is enabled.
+    :param amount: The request's amount in dollars
+    :param code: The result code sent to the client
+    :param balance: The balance the request left, if not the account's current balance
+    """
+    if history is not None:
+        balance = acct.acct_balance if balance is None else balance
+        history.append(acct.acct_number, time.time(), verb, round(amount * 100), int(code), round(balance * 100))
+
+def record_transfer(src, dst_num, amount, result):
+    """ Adds a TRANSFER request's outcome to the history of the sending account and, if it succeeded, of the
+    receiving one. A failed transfer may have debited the sender before it failed, so it is recorded only once it
+    has been rolled back. """
+    record_history(src, "TRANSFER", amount, result)
+    if result == "020":
+        record_history(get_acct(dst_num), "TRANSFER-IN", amount, result)
+
+def format_history(total, entries):
+    """ Returns the HIST reply for a page of entries, as returned by bank_history.History.page. """
+    return ";".join([f"020 {total}"] + [f"{int(when)} {verb} {amount / 100:.2f} {code:03d} {balance / 100:.2f}"
+                                         for when, verb, amount, code, balance in entries])
+
+##########################################################
+#                                                        #
+# Bank Server Sharding                                   #
+#                                                        #
+# With --workers N, N processes each own the accounts    #
+# that hash to them. A connection that logs in to an     #
+# account owned elsewhere is handed over, socket and     #
+# all, to the owning worker.                             #
+#                                                        #
+##########################################################
+
+HANDOFF = "handoff"                 # handler result: the request belongs to another worker
+SHARD_INBOX = "shard-inbox"         # selector data marking this worker's handoff socket
+HANDOFF_HEADER = struct.Struct("!??I")  # framed and binary flags, length of the unsent replies that follow
+HANDOFF_MAX = 65536                 # largest connection state that can be handed over
+
+def shard_of(acct_num):
+    """ Return the worker that owns acct_num. """
+    return zlib.crc32(acct_num.encode("utf-8")) % shard_count
+
+def owns_account(acct_num):
+    """ Return True if this process owns acct_num (always, unless the server is sharded). """
+    return shard_count == 1 or shard_of(acct_num) == shard_id
+
+def shard_file(path):
+    """ Return this worker's private variant of a state file path (the path itself unless the server is sharded). """
+    return path if shard_count == 1 else f"{path}.{shard_id}"
+
+class ShardOutbox:
+    """ The (non-blocking) sending end of a worker's handoff socket, and the handoffs waiting for it to have room. """
+    __slots__ = ("sock", "waiting")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.waiting = collections.deque()  # (connection state, client socket) pairs, oldest first
+
+def hand_off(key, messages):
+    """ Passes a connection to the worker that owns the account it is logging in to, along with its unsent
+    replies and every request not processed yet, starting with the LOG itself.
+    :param key: A registered object
+    :param messages: The unprocessed messages, the first being the LOG that triggered the handoff
+    """
+    session = key.data
+    if session.binary:
+        owner = shard_of(bank_wire.unpack_acct(bank_wire.REQUEST.unpack(messages[0])[1]))
+    else:
+        owner = shard_of(messages[0].split(" ")[1])
+    pending = b"".join(encode_message(session, msg) for msg in messages)
+    state = HANDOFF_HEADER.pack(session.framed, session.binary, len(session.outb)) + session.outb + pending + session.inb
+    if len(state) > HANDOFF_MAX:
+        # Nothing legitimate builds up this much state before logging in
+        queue_reply(session, "050")
+        session.closing = True
+        update_interest(key)
+        return
+    # The connection is no longer served here; anything its client sends meanwhile waits in the socket for the owner
+    sessions.remove(session)
+    sel.unregister(key.fileobj)
+    outbox = shard_inboxes[owner]
+    outbox.waiting.append((state, key.fileobj))
+    if len(outbox.waiting) == 1:
+        send_handoffs(outbox)
+
+def send_handoffs(outbox):
+    """ Sends the handoffs waiting in outbox, in order, until its socket is full. A worker blocking on a full socket
+    could deadlock with one blocked handing back to it, so the rest wait for EVENT_WRITE on the socket instead. """
+    while outbox.waiting:
+        state, client_conn = outbox.waiting[0]
+        try:
+            socket.send_fds(outbox.sock, [state], [client_conn.fileno()])
+        except BlockingIOError:
+            break
+        except OSError as e:
+            # The owning worker is gone; its clients cannot be served anywhere
+            log.error("Could not hand over a connection: %s", e)
+        outbox.waiting.popleft()
+        # The owning worker now holds its own copy of the descriptor; forget ours
+        client_conn.close()
+    registered = outbox.sock in sel.get_map()
+    if outbox.waiting and not registered:
+        sel.register(outbox.sock, selectors.EVENT_WRITE, data=outbox)
+    elif not outbox.waiting and registered:
+        sel.unregister(outbox.sock)
+
+def receive_handoff(inbox):
+    """ Adopts a connection handed over by another worker and processes the requests that came with it. """
+    try:
+        state, fds, _, _ = socket.recv_fds(inbox, HANDOFF_MAX, 1)
+    except BlockingIOError:
+        return
+    client_conn = socket.socket(fileno=fds[0])
+    client_conn.setblocking(False)
+    try:
+        client_addy = client_conn.getpeername()
+    except OSError:
+        client_addy = None
+    session = Session(client_conn, client_addy)
+    framed, binary, outb_len = HANDOFF_HEADER.unpack_from(state)
+    body = state[HANDOFF_HEADER.size:]
+    session.framed = framed
+    session.binary = binary
+    session.outb += body[:outb_len]
+    session.inb += body[outb_len:]
+    sessions.add(session)
+    sel.register(client_conn, selectors.EVENT_READ, data=session)
+    process_requests(sel.get_key(client_conn))
+
+def run_shard(args, index, pairs):
+    """ Body of worker process index: keep only this worker's handoff sockets, then load its partition and serve. Never returns. """
+    global sel, shard_id, shard_inboxes, shard_inbox
+    # The parent's selector must not be shared with the other workers
+    sel = selectors.DefaultSelector()
+    shard_id = index
+    shard_inboxes = [ShardOutbox(send_end) for send_end, _ in pairs]
+    for outbox in shard_inboxes:
+        outbox.sock.setblocking(False)
+    for i, (_, recv_end) in enumerate(pairs):
+        if i != index:
+            recv_end.close()
+    shard_inbox = pairs[index][1]
+    shard_inbox.setblocking(False)
+    # The parent stops its workers with SIGTERM; unwind through the finally below rather than dying on the spot
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        start_server(args)
+    finally:
+        # A worker must never fall back into the parent's code, even if the server loop exits with an error;
+        # os._exit skips the interpreter's shutdown, so write out buffered log records first
+        bank_metrics.flush_logs()
+        os._exit(1)
+
+def run_sharded_server(args):
+    """ Forks args.workers worker processes that each own a partition of the accounts, and waits for them. """
+    global shard_count
+    shard_count = args.workers
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET) for _ in range(shard_count)]
+    # Records still buffered at fork time would otherwise be written by every worker
+    bank_metrics.flush_logs()
+    workers = []
+    for index in range(shard_count):
+        pid = os.fork()
+        if pid == 0:
+            run_shard(args, index, pairs)
+        workers.append(pid)
+    for send_end, recv_end in pairs:
+        send_end.close()
+        recv_end.close()
+    try:
+        for pid in workers:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+##########################################################
+#                                                        #
+# Bank Server PIN Verification                           #
+#                                                        #
+# Hashed PINs are deliberately slow to check, so logins  #
+# to such accounts are verified in a thread pool and     #
+# answered when the check completes, on the event loop.  #
+#                                                        #
+##########################################################
+
+PIN_CHECK = "pin-check"             # handler result: the login's reply waits for a PIN hash check
+LOOP_WAKEUP = "loop-wakeup"         # selector data marking the socket that wakes the loop for loop_calls
+pin_pool = None                     # ThreadPoolExecutor checking PIN hashes, or None to check them inline
+loop_calls = queue.SimpleQueue()    # (func, args) sent from other threads to run on the selectors loop
+loop_wakeup = None                  # (receiving, sending) socket pair that makes the selectors loop run loop_calls
+
+def start_pin_pool(workers):
+    """ Creates the pool of worker threads that check PIN hashes; with 0 workers, hashes are checked inline. """
+    global pin_pool
+    if workers > 0:
+        pin_pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="pin-check")
+
+def start_pin_check(session, acct_num, stored_pin, acct_pin):
+    """ Checks acct_pin against a hashed stored PIN in the pool; finish_pin_check completes the login on the loop.
+    :param session: The Session, or the Channel of a multiplexed logical session, that is logging in
+    """
+    started = time.perf_counter()
+    future = pin_pool.submit(bank_pins.verify_pin, stored_pin, acct_pin)
+    future.add_done_callback(
+        lambda done: engine.call_soon_threadsafe(finish_pin_check, session, acct_num, acct_pin,
+                                          done.exception() is None and done.result(), started))
+
+def finish_pin_check(session, acct_num, acct_pin, pin_ok, started):
+    """ Completes a login whose PIN has been checked: queues its reply and carries on with the requests that
+    arrived behind it. Runs on the event loop. """
+    connection = session.session if isinstance(session, Channel) else session
+    if sessions.by_fd.get(connection.fd) is not connection:
+        # The client hung up while its PIN was being checked
+        return
+    if isinstance(session, Channel) and connection.channels.get(session.sid) is not session:
+        # The logical session was ended meanwhile (its account was removed by a reload)
+        return
+    # The account may have been claimed by another session in the meantime; validate_user_info rechecks that
+    reply = complete_login(session, acct_num, acct_pin, pin_ok)
+    metrics.record_request("LOG", reply, time.perf_counter() - started)
+    session.verifying = False
+    if isinstance(session, Channel):
+        reply = channel_reply(session, reply)
+    queue_reply(connection, reply)
+    engine.resume_requests(connection, session)
+
+def held_session(data, msg):
+    """ Returns the Session or Channel that msg is for if a login of that one is waiting for its PIN check, else
+    None. Its requests wait behind the login; the other sessions of the connection carry on.
+    :param data: The Session of the connection msg arrived on
+    """
+    if isinstance(msg, str) and msg.startswith("@"):
+        target = data.channels.get(msg.partition(" ")[0][1:])
+    else:
+        target = data
+    return target if target is not None and target.verifying else None
+
+def hold_request(target, msg):
+    """ Keeps msg until target's login has completed. Returns None, or the reply that ends target if it already has
+    MAX_HELD requests waiting: an ATM waits for its login's reply. """
+    if len(target.held) < MAX_HELD:
+        target.held.append(msg)
+        return None
+    return channel_reply(target, "050") if isinstance(target, Channel) else "050"
+
+def run_loop_calls(wakeup):
+    """ Runs every call queued by SelectorsEngine.call_soon_threadsafe. """
+    try:
+        while wakeup.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+    while True:
+        try:
+            func, args = loop_calls.get_nowait()
+        except queue.Empty:
+            return
+        func(*args)
+
+##########################################################
+#                                                        #
+# Bank Server Connection Limits                          #
+#                                                        #
+# Connections that stay silent too long are evicted by a #
+# timer wheel, so abandoned ATMs release their accounts  #
+# and descriptors, and no more than max_connections      #
+# clients are served at once.                            #
+#                                                        #
+##########################################################
+
+idle_timeout = IDLE_TIMEOUT     # seconds of silence before a logged-in session is evicted; 0 never evicts
+login_timeout = LOGIN_TIMEOUT   # seconds of silence before a session that is not logged in is evicted; 0 never evicts
+max_connections = 0             # most client connections served at once; 0 for no limit
+idle_timers = None              # bank_timers.TimerWheel holding one timer per session, or None if nothing is evicted
+
+def start_idle_timers():
+    """ Creates the timer wheel for idle sessions, unless both timeouts are disabled. """
+    global idle_timers
+    if idle_timeout or login_timeout:
+        idle_timers = bank_timers.TimerWheel(TIMER_TICK, time.monotonic())
+
+def default_max_connections():
+    """ Return the connection limit that keeps the server within its open file limit. """
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return 0
+    return max(1, soft_limit - FD_RESERVE)
+
+def idle_deadline(session):
+    """ Return the time at which a silent session is to be evicted, or None if it never is. A connection that is
+    logged in, itself or through a logical session, gets idle_timeout; any other gets login_timeout. """
+    logged_in = session.acct_num is not None or session.channels
+    timeout = idle_timeout if logged_in else login_timeout
+    return session.last_active + timeout if timeout else None
+
+def watch_idle(session):
+    """ Starts the idle timer of a new session. """
+    if idle_timers is not None:
+        deadline = idle_deadline(session)
+        if deadline is not None:
+            idle_timers.schedule(session, deadline)
+
+def evict_idle_sessions(now):
+    """ Disconnects the sessions that have been silent past their deadline. Each session's timer is only set once;
+    when it fires early because the session has been active since, it is set again for the new deadline. """
+    if idle_timers is None:
+        return
+    for session in idle_timers.advance(now):
+        deadline = idle_deadline(session)
+        if deadline is None:
+            continue
+        if deadline > now:
+            idle_timers.schedule(session, deadline)
+            continue
+        metrics.evicted += 1
+        log.info("Evicting idle session from %s (account %s)", session.addr, session.acct_num)
+        engine.evict_session(session)
+
+##########################################################
+#                                                        #
+# Bank Server Admission Control                          #
+#                                                        #
+# Requests beyond a peer's or an account's rate limit,   #
+# or that arrive while the loop is lagging, are answered #
+# "060 <ms>" instead of being carried out (see           #
+# bank_admission.py).                                    #
+#                                                        #
+##########################################################
+
+admission = None                # the bank_admission.Admission, or None when every request is admitted
+
+def start_admission(args):
+    """ Starts admission control if any limit is configured. """
+    global admission
+    if args.peer_rate > 0 or args.account_rate > 0 or args.overload_lag > 0:
+        admission = bank_admission.Admission(args.peer_rate, args.peer_burst, args.account_rate,
+                                             args.account_burst, args.overload_lag)
+
+def busy_delay(session, acct_num):
+    """ Returns 0 if a request may be carried out now, else the milliseconds after which the client may retry it.
+    :param session: The Session or Channel the request arrived on
+    :param acct_num: The account the request is for: the session's own, or the one a LOG names
+    """
+    addr = session.session.addr if isinstance(session, Channel) else session.addr
+    return admission.admit(addr[0] if addr else None, acct_num, time.monotonic())
+
+##########################################################
+#                                                        #
+# Bank Server Request Tracing                            #
+#                                                        #
+# Every stage of a request (read, parse, handle, commit, #
+# send) is timed into the STATS report, requests slower  #
+# than slow_request are logged with that breakdown, and  #
+# the loop can be profiled on demand.                    #
+#                                                        #
+##########################################################
+
+slow_request = 0.0          # seconds from a request's read to its reply's send beyond which it is logged; 0 never
+untimed_commits = []        # traces of the requests handled in this batch, waiting for its commit time
+profiler = bank_metrics.Profiler()
+profile_file = PROFILE_FILE # where a profile stopped by SIGUSR1 is written
+
+def request_label(msg):
+    """ Returns how a request is named in the slow request log: its request code, with any session id tag. The
+    rest (amounts, PINs) is left out. """
+    if isinstance(msg, bytes):
+        entry = BINARY_HANDLERS.get(msg[0])
+        return f"{entry[0] if entry else 'other'} (binary)"
+    if msg is None:
+        return "malformed"
+    words = msg.split(" ", 2)
+    return " ".join(words[:2]) if msg.startswith("@") else words[0]
+
+def trace_request(session, msg, started, read, parse, handle):
+    """ Keeps the timings of a request's first stages until its reply has been sent, if slow requests are logged.
+    :param session: The Session of the connection the request arrived on
+    :param started: The time.perf_counter() at which the read that brought the request in began
+    """
+    if slow_request:
+        trace = [request_label(msg), started, read, parse, handle, 0.0]
+        session.traces.append(trace)
+        untimed_commits.append(trace)
+
+def trace_commit(seconds):
+    """ Gives the requests handled in this batch the time its commit took. """
+    for trace in untimed_commits:
+        trace[5] = seconds
+    untimed_commits.clear()
+
+def trace_sent(session, seconds):
+    """ Records a send to a client. Once all of its replies are out, logs the requests among them that were slow,
+    with the time each stage took; "waiting" is the time spent waiting for the event loop in between. """
+    metrics.stages["send"].record(seconds)
+    if session.outb or not session.traces:
+        return
+    now = time.perf_counter()
+    for label, started, read, parse, handle, commit in session.traces:
+        total = now - started
+        if slow_request and total >= slow_request:
+            log.warning("Slow request %s from %s (account %s): %.2f ms; read %.2f, parse %.2f, handle %.2f, "
+                        "commit %.2f, send %.2f, waiting %.2f", label, session.addr, session.acct_num, total * 1000,
+                        read * 1000, parse * 1000, handle * 1000, commit * 1000, seconds * 1000,
+                        (total - read - parse - handle - commit - seconds) * 1000)
+    session.traces.clear()
+
+def toggle_profiler(signum, frame):
+    """ SIGUSR1 handler: starts the profiler, or stops it and writes the profile to profile_file. """
+    if profiler.start():
+        log.info("Profiling started")
+        return
+    try:
+        summary = profiler.stop(shard_file(profile_file))
+    except OSError as e:
+        log.error("Could not write the profile: %s", e)
+        return
+    log.info("Profiling stopped, %s", summary.splitlines()[0])
+
+def admin_profile(args):
+    """ PROFILE [START | STOP [FILE]]: starts the profiler, or stops it, writes the profile to FILE (by default
+    --profile-file) and replies with a summary of it. On its own, tells whether the profiler is running. """
+    action = args[0].upper() if args else ""
+    if action == "START" and len(args) == 1:
+        return "profiling started" if profiler.start() else "profiler already running"
+    if action == "STOP" and len(args) <= 2:
+        try:
+            summary = profiler.stop(args[1] if len(args) == 2 else shard_file(profile_file))
+        except OSError as e:
+            return f"could not write the profile: {e}"
+        return "profiler not running" if summary is None else summary
+    if not args:
+        return "profiler running" if profiler.running() else "profiler not running"
+    return "usage: PROFILE [START | STOP [FILE]]"
+
+def admin_slow(args):
+    """ SLOW [SECONDS]: sets the time beyond which requests are logged as slow (0 stops logging them), and replies
+    with the threshold in force. """
+    global slow_request
+    if args:
+        try:
+            threshold = float(args[0])
+        except ValueError:
+            threshold = -1.0
+        if len(args) != 1 or not threshold >= 0:
+            return "usage: SLOW [SECONDS]"
+        slow_request = threshold
+    return f"requests slower than {slow_request:g} s are logged" if slow_request else "slow requests are not logged"
+
+##########################################################
+#                                                        #
+# Bank Server Account Reload                             #
+#                                                        #
+# Changes to the account file are picked up while the    #
+# server runs: new accounts are added, PIN changes taken #
+# and deleted accounts removed, a slice at a time        #
+# between event loop iterations. Balances of accounts    #
+# already loaded are never overwritten.                  #
+#                                                        #
+##########################################################
+
+reload_file = None          # the account file watched for changes, or None when hot reload is disabled
+reload_interval = RELOAD_INTERVAL
+reload_stamp = None         # (inode, size, mtime) of the account file as last loaded
+reload_applied = None       # reload_stamp of the account file the accounts are in line with; None while not known
+reload_checked = 0.0        # time.monotonic() of the last check for changes
+reload_steps = None         # generator applying the reload in progress, one slice per step
+
+def watch_account_file(acct_file, interval):
+    """ Starts watching acct_file for changes every interval seconds; 0 leaves hot reload disabled. """
+    global reload_file, reload_interval, reload_stamp, reload_checked
+    if interval > 0:
+        reload_file, reload_interval = acct_file, interval
+        reload_stamp = account_file_stamp()
+        reload_checked = time.monotonic()
+
+def account_file_stamp():
+    """ Returns what identifies the current contents of the account file, or None if it cannot be read. """
+    try:
+        st = os.stat(reload_file)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+def account_file_source():
+    """ Returns the (size, mtime) of the account file the accounts are in line with, as snapshots record it, or None
+    if that is not known. """
+    return reload_applied[1:] if reload_applied is not None else None
+
+def adopt_source(snapshot):
+    """ Returns True, and takes the accounts to be in line with the watched account file, if snapshot says its
+    accounts are in line with the file as it is now. """
+    global reload_applied
+    if reload_stamp is None or snapshot.source != reload_stamp[1:]:
+        return False
+    reload_applied = reload_stamp
+    return True
+
+def apply_account_file(snapshot):
+    """ Brings accounts just loaded from snapshot in line with the watched account file, all at once, before any
+    request is served: the watch only notices changes made while the server runs, not those made while it was down.
+    Nothing is read if the file has not changed since the snapshot's accounts were; otherwise only the accounts the
+    file adds or changes are looked up. Returns True if the accounts changed. """
+    global reload_applied
+    if reload_file is None or adopt_source(snapshot):
+        return False
+    steps = reload_accounts(reload_file, snapshot.pins())
+    try:
+        while True:
+            next(steps)
+    except StopIteration as done:
+        reload_applied = reload_stamp
+        return done.value
+    except (OSError, ValueError) as e:
+        log.error("Applying %s failed: %s", reload_file, e)
+        return False
+
+def start_reload():
+    """ Starts reloading the account file unless a reload is already under way. Returns True if one was started. """
+    global reload_steps, reload_stamp, reload_applied
+    if reload_file is None or reload_steps is not None:
+        return False
+    reload_stamp = account_file_stamp()
+    # Snapshots taken while the reload is part way through must not claim to be in line with either version
+    reload_applied = None
+    reload_steps = reload_accounts(reload_file)
+    return True
+
+def step_reload(now):
+    """ Called once per event loop iteration: starts a reload when the account file has changed, and applies the
+    next slice of a reload in progress. Returns True while a reload is in progress. """
+    global reload_steps, reload_checked, reload_applied
+    if reload_file is None:
+        return False
+    if reload_steps is None and now - reload_checked >= reload_interval:
+        reload_checked = now
+        stamp = account_file_stamp()
+        if stamp is not None and stamp != reload_stamp:
+            start_reload()
+    if reload_steps is None:
+        return False
+    try:
+        next(reload_steps)
+    except StopIteration:
+        reload_steps = None
+        reload_applied = reload_stamp
+    except (OSError, ValueError) as e:
+        log.error("Reloading %s failed: %s", reload_file, e)
+        reload_steps = None
+    return reload_steps is not None
+
+def reload_accounts(acct_file, loaded = None):
+    """ Generator that brings ALL_ACCOUNTS in line with acct_file, yielding after every RELOAD_SLICE records. It
+    reads the file with the same rules as the loader, then removes the accounts the file no longer lists. Returns
+    True if the accounts changed.
+    :param loaded: {acct_num: pin} of every account ALL_ACCOUNTS holds, if known. Accounts the file lists with the
+                   same PIN are then not looked up, since one still only in a snapshot would be built just to be
+                   compared, and unlisted accounts are found without going through ALL_ACCOUNTS.
+    """
+    started = time.perf_counter()
+    listed = set()
+    added = changed = removed = 0
+    for count, (acct_num, pin, cents) in enumerate(bank_accountfile.read_account_file(acct_file), 1):
+        if owns_account(acct_num):
+            listed.add(acct_num)
+            if loaded is None or loaded.get(acct_num) != pin:
+                acct = get_acct(acct_num)
+                if not acct:
+                    ALL_ACCOUNTS[acct_num] = BankAccount(acct_num, pin, cents / 100)
+                    added += 1
+                elif acct.acct_pin != pin:
+                    acct.acct_pin = pin
+                    changed += 1
+        if count % RELOAD_SLICE == 0:
+            yield
+    if not listed:
+        # Most likely the file is being rewritten in place; removing every account would be the wrong reading
+        log.warning("Account file %s lists no accounts; nothing removed", acct_file)
+    else:
+        unlisted = []
+        for count, acct_num in enumerate(ALL_ACCOUNTS if loaded is None else loaded, 1):
+            if acct_num not in listed and owns_account(acct_num):
+                unlisted.append(acct_num)
+            if count % RELOAD_SLICE == 0:
+                yield
+        for count, acct_num in enumerate(unlisted, 1):
+            release_account(acct_num)
+            del ALL_ACCOUNTS[acct_num]
+            removed += 1
+            if count % RELOAD_SLICE == 0:
+                yield
+    if journal is not None and (added or changed or removed):
+        # The journal only records balances, so the next snapshot is what makes the new account set durable
+        journal.request_compaction()
+    log.info("Reloaded %s in %.2f s: %d accounts added, %d PINs changed, %d accounts removed",
+             acct_file, time.perf_counter() - started, added, changed, removed)
+    return bool(added or changed or removed)
+
+def release_account(acct_num):
+    """ Ends the session logged in to an account that is being removed: a logical session is logged out, a
+    connection of its own is closed. """
+    holder = sessions.by_acct.get(acct_num)
+    if isinstance(holder, Channel):
+        sessions.unbind(holder)
+        holder.session.channels.pop(holder.sid, None)
+    elif holder is not None:
+        log_out(holder)
+        engine.evict_session(holder)
+    if history is not None:
+        history.forget(acct_num)
+
+def admin_reload(args):
+    """ RELOAD: re-reads the account file now rather than at the next check. """
+    if reload_file is None:
+        return "hot reload is disabled"
+    return "reload started" if start_reload() else "reload already in progress"
+
+##########################################################
+#                                                        #
+# Bank Server End-of-Day Posting                         #
+#                                                        #
+# The POST admin command credits interest and charges    #
+# fees on every account in one step between requests    #
+# (see bank_posting.py), then snapshots the result.      #
+#                                                        #
+##########################################################
+
+def post_all(schedule):
+    """ Applies a bank_posting.Schedule to every account this server owns and makes the result durable with a new
+    snapshot, all before any other request is handled. Returns the posting's summary. Raises OSError, with every
+    balance as it was, if that snapshot cannot be written. """
+    started = time.perf_counter()
+    watched = {acct_num: get_acct(acct_num).acct_balance for acct_num, holder in sessions.by_acct.items()
+               if holder.watching}
+    if journal is not None:
+        # Everything journaled so far goes into the snapshot, which must not race ahead of the journal
+        journal.commit()
+    undo = {}
+    if isinstance(ALL_ACCOUNTS, bank_store.AccountStore):
+        cents = ALL_ACCOUNTS.cents[:]
+        result = bank_posting.post_store(ALL_ACCOUNTS, schedule)
+    else:
+        result = post_accounts(schedule, undo)
+    if journal is not None:
+        # The posted balances are not journaled: the snapshot is what commits them, so it is written right away
+        error = compact_journal()
+        if error is not None:
+            # A posting nothing records would be lost on restart, so it is taken back
+            if isinstance(ALL_ACCOUNTS, bank_store.AccountStore):
+                ALL_ACCOUNTS.cents[:] = cents
+            roll_back(undo)
+            raise OSError(f"the snapshot could not be written ({error}); nothing was posted")
+    push_balance_changes([acct for acct in map(get_acct, watched) if acct.acct_balance != watched[acct.acct_number]])
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    log.info("Posted to %d accounts in %.2f s: %d cents interest, %d interest refused, %d fees charged, "
+             "%d fees refused", result["accounts"], result["seconds"], result["interest_cents"],
+             result["interest_refused"], result["fees_charged"], result["fees_refused"])
+    return result
+
+def post_accounts(schedule, undo):
+    """ post_all for account dictionaries: the balances are gathered into one column, posted, and written back to
+    the accounts whose balance changed, remembering their prior balances in undo. Accounts still only in a snapshot
+    are built for that. """
+    acct_nums, balances = [], []
+    for acct in ALL_ACCOUNTS.values():
+        if owns_account(acct.acct_number):
+            acct_nums.append(acct.acct_number)
+            balances.append(round(acct.acct_balance * 100))
+    posted, result = bank_posting.post_cents(balances, schedule)
+    for acct_num, before, after in zip(acct_nums, balances, posted.tolist()):
+        if after != before:
+            acct = ALL_ACCOUNTS[acct_num]
+            undo[acct_num] = (acct, acct.acct_balance)
+            acct.acct_balance = after / 100
+    return result
+
+def admin_post(args):
+    """ POST [rate=FRACTION] [fee=DOLLARS] [waive=DOLLARS]: posts interest and a fee (waived from the given balance
+    on) to every account now; replies with a summary as JSON. """
+    try:
+        schedule = bank_posting.parse_schedule(args)
+    except ValueError as e:
+        return f"bad schedule: {e}"
+    try:
+        return json.dumps(post_all(schedule), indent=2)
+    except OSError as e:
+        return f"could not post: {e}"
+
+##########################################################
+#                                                        #
+# Bank Server Traffic Capture                            #
+#                                                        #
+# With --capture the bytes of every client connection    #
+# are recorded as they cross the socket, for replay by   #
+# bank_trace.py.                                         #
+#                                                        #
+##########################################################
+
+capture = None                      # the bank_trace.TraceWriter, or None when traffic is not being captured
+connection_ids = itertools.count(1) # ids naming connections in the trace
+
+def start_capture(trace_file):
+    """ Starts recording client traffic to trace_file, if one is given. """
+    global capture
+    if trace_file:
+        capture = bank_trace.TraceWriter(trace_file)
+        log.info("Capturing client traffic to %s", trace_file)
+
+def stop_capture():
+    """ Writes out the rest of the trace, if traffic is being captured. """
+    if capture is not None:
+        capture.close()
+
+##########################################################
+#                                                        #
+# Bank Server Binary Protocol                            #
+#                                                        #
+# Clients that negotiate it send fixed-width request     #
+# frames with amounts in cents (see bank_wire.py). The   #
+# frequent requests are answered straight from the       #
+# account core; the others reuse the text handlers.      #
+#                                                        #
+##########################################################
+
+def negotiate_binary(data):
+    """ Switches a new connection that opened with HELLO to the binary protocol and answers with the server's
+    HELLO. Raises ValueError, which ends the connection with 050, if the client speaks another version.
+    :param data: The Session attached to a registered object
+    """
+    if len(data.inb) < len(bank_wire.HELLO):
+        return
+    version = data.inb[1]
+    del data.inb[:len(bank_wire.HELLO)]
+    data.framed = data.binary = True
+    data.outb += bank_wire.HELLO
+    if version != bank_wire.VERSION:
+        raise ValueError(f"binary protocol version {version} is not supported")
+
+def split_binary_frames(data):
+    """ Removes every complete request frame from data.inb and returns them, in order.
+    :param data: The Session attached to a registered object
+    """
+    size = bank_wire.REQUEST.size
+    end = len(data.inb) - len(data.inb) % size
+    frames = [bytes(data.inb[pos:pos + size]) for pos in range(0, end, size)]
+    del data.inb[:end]
+    return frames
+
+def binary_reply(reply):
+    """ Returns the binary reply frame for a text reply: a result code, a result code and a balance (040 and 070),
+    060 and its retry delay, or a bare balance, which is sent as 020. """
+    code, _, balance = reply.partition(" ")
+    if code == "060":
+        # The busy reply carries the retry delay in milliseconds, not an amount
+        return bank_wire.REPLY.pack(60, int(balance))
+    if len(code) != 3 or not code.isdigit():
+        code, balance = "020", reply
+    return bank_wire.REPLY.pack(int(code), bank_wire.to_cents(balance) if balance else 0)
+
+def balance_frame(acct):
+    """ Returns the binary reply carrying an account's balance. """
+    return bank_wire.REPLY.pack(20, round(acct.acct_balance * 100))
+
+def binary_login(session, acct_id, pin):
+    """ LOG: the account id and the PIN as a number, handled by handle_login. """
+    acct_num = bank_wire.unpack_acct(acct_id)
+    if acct_num is None or not 0 <= pin <= 9999:
+        return "050"
+    return handle_login(session, [acct_num, f"{pin:04d}"])
+
+def binary_balance(session, acct_id, value):
+    """ BAL: the session's balance in cents. """
+    return balance_frame(get_acct(session.acct_num))
+
+def binary_deposit(session, acct_id, cents):
+    """ DEP: deposits cents to the session's account and returns the new balance, or an error code. """
+    if not amount_fits(cents / 100):
+        return "030"
+    acct, result, _ = get_acct(session.acct_num).deposit(cents / 100)
+    record_history(acct, "DEP", cents / 100, ACCOUNT_RESULT_CODES[result])
+    if result != "020":
+        return ACCOUNT_RESULT_CODES[result]
+    record_balance(acct)
+    return balance_frame(acct)
+
+def binary_withdraw(session, acct_id, cents):
+    """ WD: withdraws cents from the session's account and returns the new balance, or an error code. """
+    if not amount_fits(cents / 100):
+        return "030"
+    acct, result, _ = get_acct(session.acct_num).withdraw(cents / 100)
+    record_history(acct, "WD", cents / 100, ACCOUNT_RESULT_CODES[result])
+    if result != "020":
+        return ACCOUNT_RESULT_CODES[result]
+    record_balance(acct)
+    return balance_frame(acct)
+
+def binary_transfer(session, acct_id, cents):
+    """ TRANSFER: moves cents from the session's account to account acct_id, atomically, and returns the new
+    balance, or an error code. """
+    dst_num = bank_wire.unpack_acct(acct_id)
+    if dst_num is None:
+        return "050"
+    if not amount_fits(cents / 100):
+        return "030"
+    src = get_acct(session.acct_num)
+    undo = {}
+    result = transfer_funds(src, dst_num, cents / 100, undo)
+    if result != "020":
+        roll_back(undo)
+        record_transfer(src, dst_num, cents / 100, result)
+        return result
+    record_transfer(src, dst_num, cents / 100, result)
+    changed = [acct for acct, _ in undo.values()]
+    record_balance(*changed)
+    push_balance_changes(changed, session)
+    return balance_frame(src)
+
+def binary_watch(session, acct_id, value):
+    return handle_watch(session, [])
+
+def binary_watch_off(session, acct_id, value):
+    return handle_watch(session, ["OFF"])
+
+def binary_exit(session, acct_id, value):
+    return handle_exit(session, [])
+
+# Maps each binary opcode to its request code (for metrics), its handler and whether it needs a logged-in session
+BINARY_HANDLERS = {
+    bank_wire.OP_LOG: ("LOG", binary_login, False),
+    bank_wire.OP_BAL: ("BAL", binary_balance, True),
+    bank_wire.OP_DEP: ("DEP", binary_deposit, True),
+    bank_wire.OP_WD: ("WD", binary_withdraw, True),
+    bank_wire.OP_TRANSFER: ("TRANSFER", binary_transfer, True),
+    bank_wire.OP_WATCH: ("WATCH", binary_watch, True),
+    bank_wire.OP_WATCH_OFF: ("WATCH", binary_watch_off, True),
+    bank_wire.OP_EXIT: ("EXIT", binary_exit, False),
+}
+
+def process_binary_msg(frame, session):
+    """ Processes one binary request frame, like process_msg does a text message.
+    :return: A binary reply frame, a text reply (sent as its binary equivalent by queue_reply), or None
+    """
+    start = time.perf_counter()
+    opcode, acct_id, value = bank_wire.REQUEST.unpack(frame)
+    entry = BINARY_HANDLERS.get(opcode)
+    if entry is None:
+        request_code = "other"
+        reply = "050"
+    else:
+        request_code, handler, needs_login = entry
+        if needs_login and session.acct_num is None:
+            reply = "050"
+        else:
+            delay = 0
+            if admission is not None and handler is not binary_exit:
+                login_acct = bank_wire.unpack_acct(acct_id) if handler is binary_login else None
+                delay = busy_delay(session, login_acct or session.acct_num)
+            reply = f"060 {delay}" if delay else handler(session, acct_id, value)
+    if reply is not HANDOFF and reply is not PIN_CHECK:
+        metrics.record_request(request_code, reply, time.perf_counter() - start)
+    return reply
+
 ##########################################################
 #                                                        #
 # Bank Server Network Operations                         #
@@ -144,16 +1231,116 @@ def load_all_accounts(acct_file = "accounts.txt"):
 #                                                        #
 ##########################################################
 
-def validate_user_info(acct_num, acct_pin, key):
-    """ Validates the account information is received in the correct format. Validates the account number and account pin in the correct format. """
+class Session:
+    """ Session instances hold the state of one client connection: its socket, the account it is logged in to
+    (None until a successful LOG), its read and write buffers and its activity timestamps. """
+    __slots__ = ("conn", "fd", "conn_id", "addr", "acct_num", "watching", "inb", "outb", "framed", "binary", "closing",
+                 "verifying", "held", "channels", "connected_at", "last_active", "traces")
+
+    def __init__(self, conn, addr):
+        """ Initialize the state of a freshly accepted connection. """
+        self.conn = conn
+        self.fd = conn.fileno()
+        self.conn_id = next(connection_ids)
+        self.addr = addr
+        self.acct_num = None
+        # True while the client has asked (WATCH) to be told about balance changes made by other sessions
+        self.watching = False
+        self.inb = bytearray()
+        self.outb = bytearray()
+        # framed stays None until the first bytes from the client reveal which protocol mode it speaks
+        self.framed = None
+        # True once the client has negotiated the binary protocol (see bank_wire.py); binary connections are framed
+        self.binary = False
+        self.closing = False
+        # True while a login of the connection's own session waits for its PIN check; the requests it sends
+        # meanwhile wait in held, while its logical sessions carry on
+        self.verifying = False
+        self.held = []
+        # Logical sessions multiplexed over this connection, by session id
+        self.channels = dict()
+        self.connected_at = self.last_active = time.monotonic()
+        # Stage timings of requests whose replies have not been sent yet, while slow requests are logged
+        self.traces = []
+
+class Channel:
+    """ A logical ATM session multiplexed over a client connection. Requests tagged with its session id
+    ("@sid request", see abnf.txt) are handled with the Channel standing in for the connection's Session, so a
+    concentrator can keep many customers logged in over one socket. """
+    __slots__ = ("session", "sid", "acct_num", "watching", "closing", "verifying", "held")
+
+    def __init__(self, session, sid):
+        """ Initialize a logical session that has not logged in yet. """
+        self.session = session
+        self.sid = sid
+        self.acct_num = None
+        self.watching = False
+        self.closing = False
+        # As for a Session: a login waiting for its PIN check, and the requests waiting behind it
+        self.verifying = False
+        self.held = []
+
+class SessionRegistry:
+    """ Indexes the live sessions by socket file descriptor and by logged-in account number, so that every
+    lookup, login, logout and teardown is a constant-time dictionary operation. """
+
+    def __init__(self):
+        """ Initialize an empty registry. """
+        self.by_fd = dict()
+        self.by_acct = dict()
+
+    def add(self, session):
+        """ Registers a newly accepted session and starts its idle timer. """
+        self.by_fd[session.fd] = session
+        watch_idle(session)
+
+    def bind(self, session, acct_num):
+        """ Logs session in to acct_num. Returns False if another session already holds the account. """
+        holder = self.by_acct.get(acct_num)
+        if holder is not None and holder is not session:
+            return False
+        self.unbind(session)
+        self.by_acct[acct_num] = session
+        session.acct_num = acct_num
+        return True
+
+    def unbind(self, session):
+        """ Logs session out of its account, if it is logged in, ending any WATCH subscription. """
+        if session.acct_num is not None:
+            self.by_acct.pop(session.acct_num, None)
+            session.acct_num = None
+        session.watching = False
+
+    def remove(self, session):
+        """ Forgets a session that is being torn down, logging out every logical session it carried. """
+        self.unbind(session)
+        for channel in session.channels.values():
+            self.unbind(channel)
+        session.channels.clear()
+        self.by_fd.pop(session.fd, None)
+        if idle_timers is not None:
+            idle_timers.cancel(session)
+
+    def __len__(self):
+        """ Return the number of live sessions. """
+        return len(self.by_fd)
+
+sessions = SessionRegistry()
+
+def validate_user_info(acct_num, acct_pin, session, pin_ok = None):
+    """ Validates the account information is received in the correct format. Validates the account number and account pin in the correct format.
+    pin_ok is the outcome of a PIN check already made off the event loop; if it is None the PIN is checked here. """
     
     account = get_acct(acct_num)
     
-    if (client_duplicate_log(key, acct_num) == False):
+    if (client_duplicate_log(session, acct_num) == False):
 
         if (account != False):
-            if (account.acct_pin == acct_pin):
-                #client_acct_num.append(account.acct_number)
+            if pin_ok is None:
+                pin_ok = bank_pins.verify_pin(account.acct_pin, acct_pin)
+            if (pin_ok):
+                # Only a successful login claims the account for this session
+                connect_obj(session, acct_num)
                 return "040"
             else:
                 #Account number and PIN do not match.
@@ -167,11 +1354,29 @@ def validate_user_info(acct_num, acct_pin, key):
 
 
 def accept_wrapper(sock):
-    client_conn, client_addy = sock.accept()
-    print(f"Accepted connection from {client_conn} at {client_addy}.")
-    client_conn.setblocking(False)
-    data = types.SimpleNamespace(addr = client_addy, inb=b"", outb =b"")
-    sel.register(client_conn, selectors.EVENT_READ , data=data)
+    """ Accepts every connection waiting in the listen backlog, turning away those beyond max_connections. """
+    while True:
+        try:
+            client_conn, client_addy = sock.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Typically out of descriptors; the rest of the backlog waits for a later event
+            log.warning("Could not accept a connection: %s", e)
+            return
+        if max_connections and len(sessions) >= max_connections:
+            metrics.refused += 1
+            log.debug("Refused connection from %s: %d connections open.", client_addy, len(sessions))
+            client_conn.close()
+            continue
+        metrics.accepted += 1
+        log.debug("Accepted connection from %s on fd %d.", client_addy, client_conn.fileno())
+        client_conn.setblocking(False)
+        session = Session(client_conn, client_addy)
+        sessions.add(session)
+        sel.register(client_conn, selectors.EVENT_READ , data=session)
+        if capture is not None:
+            capture.record(session.conn_id, bank_trace.OPEN)
    
 
 def bal_req(acct_num):
@@ -181,14 +1386,15 @@ def bal_req(acct_num):
         return client_bal
 
 def deposit_req(acct_num, client_deposit):
-        bal_req(acct_num)
         client_acct = get_acct(acct_num)
         # Validates client deposit amount
         if (client_deposit.isnumeric()):
             if (client_acct):
                 client_acct, result, new_bal = (client_acct.deposit(float(client_deposit)))
+                record_history(client_acct, "DEP", float(client_deposit), ACCOUNT_RESULT_CODES[result])
                 # Deposit amount validated; success
                 if (result == "020"):
+                    record_balance(client_acct)
                     return str(new_bal)
                 # Deposit amount validated; failure
                 elif(result == "021"):
@@ -200,13 +1406,14 @@ def deposit_req(acct_num, client_deposit):
 
 
 def withdrawl_req(acct_num, client_withdraw):
-        bal_req(acct_num)
         client_acct = get_acct(acct_num)
         if (client_withdraw.isnumeric()):
             if (client_acct):
                 client_acct, result, new_bal = (client_acct.withdraw(float(client_withdraw)))
+                record_history(client_acct, "WD", float(client_withdraw), ACCOUNT_RESULT_CODES[result])
                 # Withdrawal amount validated; success
                 if (result == "020"):
+                    record_balance(client_acct)
                     return str(new_bal)
                 # Withdrawal amount validated; failure
                 elif(result == "021"):
@@ -221,59 +1428,339 @@ def withdrawl_req(acct_num, client_withdraw):
             return "030"
 
 
-def process_msg(msg, key):
-    """ Processes differnt messages from the client
-    :param key: A registered object
-    :param message: A message from the client
-    """ 
-    client_conn = key.fileobj
+# Maps BankAccount result codes onto the codes sent to clients
+ACCOUNT_RESULT_CODES = {"020": "020", "021": "030", "022": "031"}
 
-    #Regexes
-    login_reg = r"[L][O][G]\s[a-z]{2}-\d{5}\s\d{4}"
-    bal_code = "BAL"
-    withdrw_reg = r"[W][D]\s\d+"
-    dep_reg = r"[D][E][P]\s\d+"
-    exit_code = "EXIT"
-    
-    #Login
-    if (re.search(login_reg, msg)):
-        msg = msg.split(" ")
-        acct_num = msg[1]
-        acct_pin = msg[2]
-        validation = validate_user_info(acct_num, acct_pin, key)
-        if (validation == "043"):
-            data = key.data
-            print(f"Closing connection to {data.addr}")
-            sel.unregister(client_conn)
-            client_conn.close()  
-        else:
-            return validation
-    # Balance
-    elif (msg == bal_code):
-        client_acct_num = list(client_dict.keys())[list(client_dict.values()).index(client_conn)]
-        return bal_req(client_acct_num)
-    # Withdraw
-    elif (re.search(withdrw_reg, msg)):
-        msg = msg.split(" ")
-        amt = msg[1]
-        client_acct_num = list(client_dict.keys())[list(client_dict.values()).index(client_conn)]
-        new_bal = withdrawl_req(client_acct_num, amt)
-        return new_bal
-    # Deposit
-    elif (re.search(dep_reg, msg)):
-        msg = msg.split(" ")
-        amt = msg[1]
-        client_acct_num = list(client_dict.keys())[list(client_dict.values()).index(client_conn)]
-        new_bal = deposit_req(client_acct_num, amt)
-        return new_bal
-
-    # Exit 
-    elif(msg == exit_code):
-        close_conn(key)
-   
+def remember_balance(undo, acct):
+    """ Records the balance acct had before the current all-or-nothing request first touched it.
+    :param undo: A dictionary of acct_num -> (account, original balance)
+    """
+    if acct.acct_number not in undo:
+        undo[acct.acct_number] = (acct, acct.acct_balance)
+
+def roll_back(undo):
+    """ Restores every account touched by a failed all-or-nothing request to its original balance. """
+    for acct, balance in undo.values():
+        acct.acct_balance = balance
+
+def transfer_funds(src, dst_num, amount, undo):
+    """ Moves amount (in dollars) from account src to account dst_num, remembering prior balances in undo.
+    Returns 020 on success, 030 for a bad amount, 031 for insufficient funds, 032 if the destination does not
+    exist or is the source itself, and 033 if another worker owns the destination. """
+    if not amountIsValid(amount):
+        return "030"
+    if not owns_account(dst_num):
+        # Moving money between workers cannot be made atomic without a cross-worker protocol
+        return "033"
+    dst = get_acct(dst_num)
+    if not dst or dst_num == src.acct_number:
+        return "032"
+    remember_balance(undo, src)
+    _, result, _ = src.withdraw(amount)
+    if result != "020":
+        return ACCOUNT_RESULT_CODES[result]
+    remember_balance(undo, dst)
+    _, result, _ = dst.deposit(amount)
+    # The destination's balance may have no room left; the caller rolls the withdrawal back
+    return ACCOUNT_RESULT_CODES[result]
+
+def batch_operation(src, op, undo, trail):
+    """ Applies one DEP, WD or TRANSFER operation of a BATCH to account src, remembering prior balances in undo
+    and the history entries of a successful operation in trail, as record_history arguments.
+    Returns the operation's result code; 034 means the operation itself is malformed. """
+    op_args = op.split(" ")
+    if op_args[0] == "TRANSFER" and len(op_args) == 3:
+        if not amount_token_is_valid(op_args[2]):
+            return "030"
+        result = transfer_funds(src, op_args[1], float(op_args[2]), undo)
+        if result == "020":
+            dst = get_acct(op_args[1])
+            trail.append((src, "TRANSFER", float(op_args[2]), result, src.acct_balance))
+            trail.append((dst, "TRANSFER-IN", float(op_args[2]), result, dst.acct_balance))
+        return result
+    if op_args[0] not in ("DEP", "WD") or len(op_args) != 2:
+        return "034"
+    if not amount_token_is_valid(op_args[1]):
+        return "030"
+    remember_balance(undo, src)
+    if op_args[0] == "DEP":
+        _, result, balance = src.deposit(float(op_args[1]))
+    else:
+        _, result, balance = src.withdraw(float(op_args[1]))
+    if result == "020":
+        trail.append((src, op_args[0], float(op_args[1]), result, balance))
+    return ACCOUNT_RESULT_CODES[result]
+
+def amount_token_is_valid(token):
+    """ Return True if token is a whole-dollar amount written with ASCII digits only, whose value in cents fits the
+    64-bit integers balances are stored in. """
+    return token.isascii() and token.isdigit() and len(token) <= MAX_AMOUNT_DIGITS and amount_fits(float(token))
+
+def amount_fits(amount):
+    """ Return True if amount (in dollars) is, in cents, within bank_store.MAX_CENTS. """
+    return round(amount * 100) <= bank_store.MAX_CENTS
+
+def handle_login(session, args):
+    """ LOG acct-num pin: validates the credentials and binds the account to the session on success. """
+    if len(args) != 2 or not acctNumberIsValid(args[0]) or not acctPinIsValid(args[1]):
+        return "050"
+    if not owns_account(args[0]):
+        connection = session.session if isinstance(session, Channel) else session
+        if connection.channels:
+            # Only whole connections can move between workers, and this one carries other customers' sessions;
+            # refused before anything changes, so the session stays logged in
+            return "033"
+        # Another worker owns this account; the connection moves there, starting with this request
+        log_out(session)
+        return HANDOFF
+    account = get_acct(args[0])
+    if pin_pool is not None and account and bank_pins.is_pin_hash(account.acct_pin) and \
+            not client_duplicate_log(session, args[0]):
+        session.verifying = True
+        start_pin_check(session, args[0], account.acct_pin, args[1])
+        return PIN_CHECK
+    return complete_login(session, args[0], args[1])
+
+def complete_login(session, acct_num, acct_pin, pin_ok = None):
+    """ Validates a login (see validate_user_info) and returns its reply: 040, with the starting balance on a framed
+    connection, or an error code. """
+    validation = validate_user_info(acct_num, acct_pin, session, pin_ok)
+    connection = session.session if isinstance(session, Channel) else session
+    if (validation == "043"):
+        # Account already in use elsewhere; tell the client, then drop it once the reply is flushed
+        session.closing = True
+    elif (validation == "040" and connection.framed):
+        # The starting balance comes with the login, so the client need not ask for it; legacy ATMs expect a bare 040
+        return f"040 {bal_req(acct_num)}"
+    return validation
+
+def handle_balance(session, args):
+    """ BAL: returns the balance of the session's account. """
+    if args:
+        return "050"
+    return bal_req(session.acct_num)
+
+def handle_withdraw(session, args):
+    """ WD amount: withdraws from the session's account and returns the new balance or an error code. """
+    if len(args) != 1:
+        return "050"
+    if not amount_token_is_valid(args[0]):
+        return "030"
+    return withdrawl_req(session.acct_num, args[0])
+
+def handle_deposit(session, args):
+    """ DEP amount: deposits to the session's account and returns the new balance or an error code. """
+    if len(args) != 1:
+        return "050"
+    if not amount_token_is_valid(args[0]):
+        return "030"
+    return deposit_req(session.acct_num, args[0])
+
+def handle_transfer(session, args):
+    """ TRANSFER acct-num amount: moves money from the session's account to another account, atomically.
+    Returns the session account's new balance or an error code. """
+    if len(args) != 2 or not acctNumberIsValid(args[0]):
+        return "050"
+    if not amount_token_is_valid(args[1]):
+        return "030"
+    src = get_acct(session.acct_num)
+    undo = {}
+    result = transfer_funds(src, args[0], float(args[1]), undo)
+    if result != "020":
+        roll_back(undo)
+        record_transfer(src, args[0], float(args[1]), result)
+        return result
+    record_transfer(src, args[0], float(args[1]), result)
+    changed = [acct for acct, _ in undo.values()]
+    record_balance(*changed)
+    push_balance_changes(changed, session)
+    return str(round(src.acct_balance, 2))
+
+def handle_batch(session, args):
+    """ BATCH op *(";" op): applies DEP, WD and TRANSFER operations to the session's account all-or-nothing.
+    Returns 020 (all applied) or 035 (none applied), one result code per operation (036 for operations not
+    attempted after a failure) and the session account's resulting balance. """
+    ops = " ".join(args).split(";") if args else []
+    if not ops or len(ops) > MAX_BATCH_OPS:
+        return "050"
+    src = get_acct(session.acct_num)
+    undo = {}
+    trail = []
+    codes = []
+    for op in ops:
+        codes.append(batch_operation(src, op.strip(), undo, trail))
+        if codes[-1] != "020":
+            break
+    if codes[-1] == "020":
+        changed = [acct for acct, _ in undo.values()]
+        record_balance(*changed)
+        push_balance_changes(changed, session)
+        for entry in trail:
+            record_history(*entry)
+        batch_code = "020"
     else:
+        roll_back(undo)
+        # None of the operations took effect, so the history shows the batch as one failed request
+        record_history(src, "BATCH", 0.0, "035")
+        batch_code = "035"
+        codes += ["036"] * (len(ops) - len(codes))
+    return " ".join([batch_code] + codes + [str(round(src.acct_balance, 2))])
+
+def handle_watch(session, args):
+    """ WATCH [OFF]: starts (or stops) pushing the session's account balance to it whenever another session
+    changes it, e.g. by a transfer into the account. Returns the current balance. Framed connections only,
+    since a legacy client cannot tell a pushed message from a reply. """
+    connection = session.session if isinstance(session, Channel) else session
+    if args not in ([], ["OFF"]) or not connection.framed:
+        return "050"
+    session.watching = not args
+    return bal_req(session.acct_num)
+
+def handle_history(session, args):
+    """ HIST [start [count]]: returns a page of the session account's transaction history, newest first: 020 and
+    the number of entries the history holds, then up to count entries (HIST_PAGE by default) beginning start
+    entries back from the newest. Each entry is its time, verb, amount, result code and resulting balance. """
+    if len(args) > 2 or not all(amount_token_is_valid(arg) for arg in args):
+        return "050"
+    start = int(args[0]) if args else 0
+    count = int(args[1]) if len(args) == 2 else HIST_PAGE
+    if not 0 < count <= HIST_PAGE_MAX:
+        return "050"
+    if history is None:
+        return format_history(0, [])
+    return format_history(*history.page(session.acct_num, start, count))
+
+def handle_exit(session, args):
+    """ EXIT: logs out now; the connection is closed once earlier replies have been flushed. """
+    if args:
+        return "050"
+    log_out(session)
+    session.closing = True
+
+# Maps each request code to its handler and whether the handler needs a logged-in session
+REQUEST_HANDLERS = {
+    "LOG": (handle_login, False),
+    "BAL": (handle_balance, True),
+    "WD": (handle_withdraw, True),
+    "DEP": (handle_deposit, True),
+    "TRANSFER": (handle_transfer, True),
+    "BATCH": (handle_batch, True),
+    "WATCH": (handle_watch, True),
+    "HIST": (handle_history, True),
+    "EXIT": (handle_exit, False),
+}
+
+def process_msg(msg, session):
+    """ Processes differnt messages from the client by looking up the request code in REQUEST_HANDLERS
+    :param session: The Session the message arrived on
+    :param message: A message from the client
+    :return: The reply string, or None if the request has no reply
+    """ 
+    if isinstance(msg, bytes):
+        return process_binary_msg(msg, session)
+    if msg.startswith("@") and isinstance(session, Session):
+        return process_channel_msg(msg, session)
+    start = time.perf_counter()
+    request_code, _, arg_str = msg.partition(" ")
+    entry = REQUEST_HANDLERS.get(request_code)
+    if entry is None:
         #not recognised
+        request_code = "other"
+        reply = "050"
+    else:
+        handler, needs_login = entry
+        args = arg_str.split(" ") if arg_str else []
+        # Requests other than LOG and EXIT from a client that never logged in are treated as a rogue client
+        if needs_login and session.acct_num is None:
+            reply = "050"
+        else:
+            delay = 0
+            if admission is not None and handler is not handle_exit:
+                # A login counts against the account it names
+                login_acct = args[0] if handler is handle_login and args and acctNumberIsValid(args[0]) else None
+                delay = busy_delay(session, login_acct or session.acct_num)
+            reply = f"060 {delay}" if delay else handler(session, args)
+    if reply is not HANDOFF and reply is not PIN_CHECK:
+        # A handed-off request is counted by the worker that processes it, and a login waiting for its PIN
+        # check by finish_pin_check
+        metrics.record_request(request_code, reply, time.perf_counter() - start)
+    return reply
+
+def process_channel_msg(msg, session):
+    """ Processes a message addressed to one of the logical sessions multiplexed over a connection.
+    The logical session is created by its first message and ends when it exits, is refused a login
+    (043) or sends a rogue request (050); the connection and its other sessions carry on.
+    :param msg: A message of the form "@sid request"
+    :param session: The Session of the connection the message arrived on
+    :return: The reply tagged with the same session id, None if the request has no reply, or 050 for a bad tag
+    """
+    tag, _, request = msg.partition(" ")
+    sid = tag[1:]
+    if not sid.isdigit() or len(sid) > 9:
         return "050"
+    channel = session.channels.get(sid)
+    if channel is None:
+        if len(session.channels) >= MAX_CHANNELS:
+            return "050"
+        channel = session.channels[sid] = Channel(session, sid)
+    reply = process_msg(request, channel)
+    if reply is PIN_CHECK:
+        return reply
+    return channel_reply(channel, reply)
+
+def channel_reply(channel, reply):
+    """ Ends a logical session if its request requires it, and returns its reply tagged with its session id.
+    :param channel: The Channel the request was addressed to
+    :param reply: The untagged reply, or None if the request has no reply
+    """
+    if reply == "050":
+        channel.closing = True
+    if channel.closing:
+        sessions.unbind(channel)
+        channel.session.channels.pop(channel.sid, None)
+    if reply is None:
+        return None
+    return f"@{channel.sid} {reply}"
+
+def push_balance_changes(accts, origin = None):
+    """ Pushes "070 balance" to every WATCHing session logged in to one of accts, except origin: the session whose
+    request made the change already gets the new balance in its reply.
+    :param accts: The accounts whose balances just changed
+    :param origin: The Session or Channel that made the change, if any
+    """
+    for acct in accts:
+        holder = sessions.by_acct.get(acct.acct_number)
+        if holder is not None and holder is not origin and holder.watching:
+            push_message(holder, f"070 {acct.acct_balance:.2f}")
+
+pending_pushes = []     # (Session, message) pushed during the current batch, queued once it is committed
+
+def push_message(session, msg):
+    """ Queues an unsolicited message for a session, to be sent once the current batch has been committed (see
+    deliver_pushes). Its connection may be flushed before the commit, so the message cannot go in its outb yet.
+    :param session: A Session, or the Channel of a multiplexed logical session
+    """
+    if isinstance(session, Channel):
+        session, msg = session.session, f"@{session.sid} {msg}"
+    if session.closing:
+        return
+    pending_pushes.append((session, msg))
+
+def deliver_pushes():
+    """ Queues the messages pushed during the batch just committed and makes their connections send them. """
+    global pending_pushes
+    pushes, pending_pushes = pending_pushes, []
+    for session, msg in pushes:
+        # The connection may have closed since, and its descriptor been reused
+        if not session.closing and sessions.by_fd.get(session.fd) is session:
+            queue_reply(session, msg)
+            engine.wake_writer(session)
+
+def log_out(session):
+    """ Releases the account bound to a session, if there is one.
+    :param session: A Session
+    """
+    sessions.unbind(session)
 
 def close_conn(key) :
     """ Closes a client connection.
@@ -281,95 +1768,668 @@ def close_conn(key) :
     """  
     client_conn = key.fileobj
     data = key.data
-    # Gets acct_num related to a connection
-    client_acct_num = list(client_dict.keys())[list(client_dict.values()).index(client_conn)]
-    # Removes it from list of connected clients
-    client_dict.pop(client_acct_num)
-    print(f"Closing connection to {data.addr}")
+    # Removes it from the registry of connected clients
+    sessions.remove(data)
+    metrics.closed += 1
+    log.debug("Closing connection to %s", data.addr)
+    if capture is not None:
+        capture.record(data.conn_id, bank_trace.CLOSE)
     sel.unregister(client_conn)
     client_conn.close()  
 
-def transaction(key):
-    """ Receives, processes and sends messages between clients.
+def split_frames(data):
+    """ Removes every complete frame from data.inb and returns their payloads, in order.
+    A frame is the payload length in decimal, a colon, then the payload itself (see abnf.txt).
+    :param data: The Session attached to a registered object
+    :return: A list of payloads (bytes); raises ValueError if the buffer holds a malformed frame
+    """
+    payloads = []
+    pos = 0
+    while True:
+        sep = data.inb.find(b":", pos, pos + MAX_LENGTH_DIGITS + 1)
+        if sep == -1:
+            # Either the length field is still arriving, or it is longer than any legal frame
+            if len(data.inb) - pos > MAX_LENGTH_DIGITS:
+                raise ValueError("frame length field too long")
+            break
+        length_field = bytes(data.inb[pos:sep])
+        if not length_field.isdigit() or int(length_field) > MAX_FRAME_LEN:
+            raise ValueError("bad frame length")
+        end = sep + 1 + int(length_field)
+        if end > len(data.inb):
+            # Frame not fully received yet, wait for more bytes
+            break
+        payloads.append(bytes(data.inb[sep + 1:end]))
+        pos = end
+    del data.inb[:pos]
+    return payloads
+
+def extract_messages(data):
+    """ Removes the complete client messages buffered in data.inb and returns them as strings, or as request
+    frames (bytes) on a binary connection. Framed and binary connections may deliver any number of messages per
+    read; legacy (unframed) connections treat everything received as a single message.
+    :param data: The Session attached to a registered object
+    """
+    if not data.inb:
+        return []
+    if data.framed is None:
+        if data.inb[0] == bank_wire.MAGIC:
+            negotiate_binary(data)
+        else:
+            # A framed client always starts with a length digit, a legacy client with a request code
+            data.framed = data.inb[:1].isdigit()
+    if data.binary:
+        return split_binary_frames(data)
+    if data.framed:
+        payloads = split_frames(data)
+    else:
+        payloads = [bytes(data.inb)]
+        data.inb.clear()
+    return [payload.decode("utf-8", errors="replace") for payload in payloads]
+
+def encode_message(data, msg):
+    """ Return msg as bytes, framed if the client speaks framed mode. Binary messages are already frames.
+    :param data: The Session attached to a registered object
+    """
+    if data.binary:
+        return msg
+    payload = msg.encode("utf-8")
+    if data.framed:
+        return str(len(payload)).encode("ascii") + b":" + payload
+    return payload
+
+def queue_reply(data, reply):
+    """ Appends a reply to the connection's outgoing buffer, framing it if the client speaks framed mode.
+    :param data: The Session attached to a registered object
+    :param reply: The reply string, a binary reply frame, or None if the request has no reply
+    """
+    if reply is None:
+        return
+    if data.binary:
+        data.outb += reply if isinstance(reply, bytes) else binary_reply(reply)
+        return
+    data.outb += encode_message(data, reply)
+
+def update_interest(key):
+    """ Registers interest in EVENT_WRITE only while replies are waiting in data.outb, and stops
+    reading from a connection that is closing or that has let OUTB_HIGH_WATER bytes of replies pile up.
     :param key: A registered object
-    """  
-        
-    # Client specific socket
+    """
+    data = key.data
+    backlogged = data.closing or len(data.outb) >= OUTB_HIGH_WATER
+    events = selectors.EVENT_WRITE if backlogged else selectors.EVENT_READ
+    if data.outb:
+        events |= selectors.EVENT_WRITE
+    if sel.get_key(key.fileobj).events != events:
+        sel.modify(key.fileobj, events, data=data)
+
+def read_requests(key):
+    """ Receives whatever the client has sent, processes every complete message in order and queues the replies.
+    :param key: A registered object
+    """
     client_conn = key.fileobj
-    # Receives client's request
-    client_message = client_conn.recv(1024)  
-    # Client message handling
-    if client_message:
-        processed_data = process_msg(client_message.decode("utf-8"), key)
+    data = key.data
+    started = time.perf_counter()
+    try:
+        client_message = client_conn.recv(RECV_SIZE)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        client_message = b""
+    if not client_message:
+        # Closes the client connection if no message
+        close_conn(key)
+        return
+    read = time.perf_counter() - started
+    metrics.stages["read"].record(read)
+    if capture is not None:
+        capture.record(data.conn_id, bank_trace.IN, client_message)
+    data.inb += client_message
+    data.last_active = time.monotonic()
+    process_requests(key, started, read)
+
+def process_requests(key, started = None, read = 0.0):
+    """ Processes every complete message buffered for a connection, in order, and queues the replies.
+    :param key: A registered object
+    :param started: The time.perf_counter() at which the read that brought the messages in began
+    :param read: How long that read took
+    """
+    parse_from = time.perf_counter()
+    messages, parse = parse_requests(key.data)
+    dispatch_requests(key, messages, started or parse_from, read, parse)
+
+def parse_requests(session):
+    """ Extracts every complete message buffered for session. Returns the messages and how long that took; a
+    malformed frame ends them with None, since nothing after it can be trusted. """
+    parse_from = time.perf_counter()
+    try:
+        messages = extract_messages(session)
+    except ValueError:
+        messages = [None]
+    parse = time.perf_counter() - parse_from
+    metrics.stages["parse"].record(parse)
+    return messages, parse
+
+def dispatch_requests(key, messages, started, read = 0.0, parse = 0.0):
+    """ handle_requests for a connection served by the selectors loop, handing it over to another worker if a
+    message asks for that.
+    :param key: A registered object
+    :param started: The time.perf_counter() at which the read that brought the messages in began
+    """
+    unprocessed = handle_requests(key.data, messages, functools.partial(finish_requests, key), started, read, parse)
+    if unprocessed is not None:
+        hand_off(key, unprocessed)
+
+def handle_requests(session, messages, flush, started, read = 0.0, parse = 0.0):
+    """ Processes messages from a connection in order and queues the replies, for either engine. A message for a
+    session whose login waits for its PIN check is held until the check completes (see finish_pin_check).
+    :param session: The Session of the connection
+    :param flush: Called once the replies are queued, to have the engine send them (or close the connection)
+    :param started: The time.perf_counter() at which the read that brought the messages in began
+    Returns the messages not processed yet, the first being a LOG, if the connection must be handed over to
+    another worker; flush is not called then. Returns None otherwise.
+    """
+    handle_from = time.perf_counter()
+    for index, msg in enumerate(messages):
+        if session.closing:
+            break
+        target = held_session(session, msg)
+        if target is not None:
+            processed_data = hold_request(target, msg)
+            if processed_data is None:
+                continue
+        else:
+            processed_data = process_msg(msg, session) if msg is not None else "050"
+        handled = time.perf_counter()
+        metrics.stages["handle"].record(handled - handle_from)
+        if processed_data is PIN_CHECK:
+            # The reply follows when the check completes
+            handle_from = handled
+            continue
+        if processed_data is HANDOFF:
+            return messages[index:]
+        trace_request(session, msg, started, read, parse, handled - handle_from)
+        handle_from = handled
+        queue_reply(session, processed_data)
         #Drops clients that sends unrecognisable and potentionall harmful messages
         if (processed_data == "050"):
-            close_conn(key)
-        if (processed_data):
-            client_conn.sendall(processed_data.encode("utf-8"))
-    else:
-        # Closes the client connection if no message
+            session.closing = True
+    flush()
+    return None
+
+def finish_requests(key):
+    """ Closes a connection whose session is over once its replies are sent, or waits for it to be writable.
+    :param key: A registered object
+    """
+    if key.data.closing and not key.data.outb:
         close_conn(key)
+    else:
+        update_interest(key)
 
-def connect_obj(key, acct_num):
-    """ Adds a client_coon, account pair to the dictionary of active clients.
+def flush_replies(key):
+    """ Sends as much of data.outb as the socket will take without blocking.
     :param key: A registered object
-    :return acct_num: The account number of the client
     """
     client_conn = key.fileobj
-    client_dict[acct_num] = client_conn
+    data = key.data
+    started = time.perf_counter()
+    try:
+        sent = client_conn.send(data.outb)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        close_conn(key)
+        return
+    if capture is not None:
+        capture.record(data.conn_id, bank_trace.OUT, bytes(data.outb[:sent]))
+    del data.outb[:sent]
+    trace_sent(data, time.perf_counter() - started)
+    if data.closing and not data.outb:
+        close_conn(key)
+    else:
+        update_interest(key)
+
+def transaction(key, mask):
+    """ Receives, processes and sends messages between clients.
+    Replies are flushed before new requests are read: everything already in data.outb was committed at the
+    end of an earlier batch, while replies produced by this read must wait for this batch's commit.
+    :param key: A registered object
+    :param mask: The events the connection is ready for
+    """  
+    if mask & selectors.EVENT_WRITE:
+        flush_replies(key)
+    # The flush may have closed the connection, in which case it is no longer registered
+    if mask & selectors.EVENT_READ and key.fileobj.fileno() != -1:
+        read_requests(key)
+
+def connect_obj(session, acct_num):
+    """ Binds an account to a session in the registry of active clients.
+    :param session: A Session, or the Channel of a multiplexed logical session
+    :param acct_num: The account number of the client
+    """
+    sessions.bind(session, acct_num)
 
 
-def client_duplicate_log(key, acct_num):
+def client_duplicate_log(session, acct_num):
     """ Checks is a client with an account number is currently on the server.
-    :param key: A registered object
-    :return acct_num: The account number of the client
+    :param session: A Session
+    :param acct_num: The account number of the client
+    :return: True if a different session is already logged in to the account
     """
-    all_accts_active = list(client_dict.keys())
-    if (acct_num in all_accts_active):
-        return True
-    else:
-        connect_obj(key, acct_num)
-        return False
+    holder = sessions.by_acct.get(acct_num)
+    return holder is not None and holder is not session
 
-def run_network_server():
-    """ Runs the server.
+def get_server_address():
+    """ Returns the (host, port) the server listens on: the ip address of the local machine and the bank's port.
     """
-    # Gets the ip address of the local machine.
     try:
-        host = socket.gethostbyname(socket.gethostname())
-        port = 65432
+        return socket.gethostbyname(socket.gethostname()), 65432
     except socket.gaierror:
-        print('Could not get hostname...Ending server.')
+        log.error('Could not get hostname...Ending server.')
         sys.exit()
-        
+
+class SelectorsEngine:
+    """ What the request handling shared by both network engines needs from the one running: the selectors loop of
+    run_network_server, or bank_aio.AsyncioEngine. """
+
+    def call_soon_threadsafe(self, func, *args):
+        """ Runs func(*args) on the event loop thread. May be called from any thread. """
+        loop_calls.put((func, args))
+        try:
+            loop_wakeup[1].send(b"\0")
+        except BlockingIOError:
+            # The wakeup socket is full, so the loop is already due to wake up
+            pass
+
+    def wake_writer(self, session):
+        """ Makes the loop send session.outb, which has had a message pushed to it. """
+        update_interest(sel.get_key(session.conn))
+
+    def resume_requests(self, session, target):
+        """ Processes the requests held behind target's login once it has completed.
+        :param session: The Session of the connection
+        :param target: The Session or Channel whose login has completed
+        """
+        messages, target.held = target.held, []
+        dispatch_requests(sel.get_key(session.conn), messages, time.perf_counter())
+
+    def evict_session(self, session):
+        """ Closes a session's connection at once, discarding anything still unsent. """
+        close_conn(sel.get_key(session.conn))
+
+engine = SelectorsEngine()      # the network engine serving the connections; see use_engine
+
+def use_engine(new_engine):
+    """ Serve the connections with another network engine, one with the methods of SelectorsEngine. """
+    global engine
+    engine = new_engine
+
+def open_loop_wakeup():
+    """ Creates the socket pair through which other threads wake the selectors loop, and registers its receiving end. """
+    global loop_wakeup
+    loop_wakeup = socket.socketpair()
+    for end in loop_wakeup:
+        end.setblocking(False)
+    sel.register(loop_wakeup[0], selectors.EVENT_READ, data=LOOP_WAKEUP)
+
+def open_listener(host, port):
+    """ Returns a socket listening for client connections on host:port. """
+    serv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Lets a restarted server (e.g. recovering from a crash) rebind while old connections sit in TIME_WAIT
+    serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if shard_count > 1:
+        # Every worker listens on the same port and the kernel spreads new connections across them
+        serv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # Binds the  socket to the specified address and port above
+    serv_sock.bind((host, port))
+    # Listening for incoming connections
+    serv_sock.listen()
+    log.info("Listening on %s:%s", host, port)
+    return serv_sock
+
+def run_network_server():
+    """ Runs the server.
+    """
+    # Gets the ip address of the local machine.
+    host, port = get_server_address()
+
     # Creates a socket
-    print(f"Server is starting - listening for connections at IP, {host}, and port, {port}")
+    log.info("Server is starting - listening for connections at IP, %s, and port, %s", host, port)
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as serv_sock:
-            # Binds the  socket to the specified address and port above
-            serv_sock.bind((host, port))
-            # Listening for incoming connections
-            serv_sock.listen()
-            print(f"Listening on {host}:{port}")
+        # A server that took over from a running one keeps accepting on that server's socket
+        with inherited_listener or open_listener(host, port) as serv_sock:
             # Creats a non blocking socket
             serv_sock.setblocking(False)
             #Registers the socket with the selector
             sel.register(serv_sock, selectors.EVENT_READ, data=None)
+            if shard_inbox is not None:
+                sel.register(shard_inbox, selectors.EVENT_READ, data=SHARD_INBOX)
+            if admin_path is not None:
+                sel.register(open_admin_socket(shard_file(admin_path)), selectors.EVENT_READ, data=ADMIN_LISTENER)
+            open_loop_wakeup()
         
 
             while True:
-                events = sel.select(timeout=None)
+                waited_from = time.perf_counter()
+                # The timeout bounds how long buffered log records can wait to be written and idle timers can lag
+                timeout = bank_metrics.LOG_FLUSH_INTERVAL
+                if reload_steps is not None:
+                    # A reload is under way; poll so its next slice runs as soon as waiting requests are served
+                    timeout = 0
+                elif idle_timers is not None:
+                    timeout = min(timeout, idle_timers.next_tick_in(time.monotonic()))
+                events = sel.select(timeout=timeout)
+                busy_from = time.perf_counter()
+                metrics.loop_wait.record(busy_from - waited_from)
+                woken = None
                 for key, mask in events:
                     if key.data is None:
                         accept_wrapper(key.fileobj)
+                    elif key.data is SHARD_INBOX:
+                        receive_handoff(key.fileobj)
+                    elif isinstance(key.data, ShardOutbox):
+                        send_handoffs(key.data)
+                    elif key.data is LOOP_WAKEUP:
+                        woken = key.fileobj
+                    elif key.data is ADMIN_LISTENER:
+                        accept_admin(key.fileobj)
+                    elif isinstance(key.data, AdminConnection):
+                        serve_admin(key)
                     else:
-                        transaction(key)
+                        transaction(key, mask)
+                if woken is not None:
+                    # After every flush of this batch: the replies of a completed login must wait for the commit below
+                    run_loop_calls(woken)
+                evict_idle_sessions(time.monotonic())
+                step_reload(time.monotonic())
+                # Replies queued in this batch are only sent on a later EVENT_WRITE, after this commit
+                commit_batch()
+                busy = time.perf_counter() - busy_from
+                metrics.loop_busy.record(busy)
+                if admission is not None:
+                    # A request that became ready just after select() returned waited for the whole iteration
+                    admission.record_lag(busy)
+                bank_metrics.flush_logs(stale_only=True)
+                if capture is not None:
+                    capture.flush_if_stale()
             
 
     except Exception as e:
-        print(e)
+        log.error("%s", e)
         sys.exit()
+    finally:
+        if admin_path is not None:
+            remove_admin_socket(shard_file(admin_path))
     
+##########################################################
+#                                                        #
+# Bank Server Administration                             #
+#                                                        #
+# A local (Unix domain) socket answers one-line admin    #
+# commands such as STATS. See bank_metrics.py.           #
+#                                                        #
+##########################################################
+
+ADMIN_LISTENER = "admin-listener"   # selector data marking the admin socket
+ADMIN_MAX = 1024                    # longest admin command line
+
+class AdminConnection:
+    """ The partly received command line of one admin connection. """
+    __slots__ = ("inb",)
+
+    def __init__(self):
+        self.inb = bytearray()
+
+def admin_stats(args):
+    """ STATS: the metrics report, as JSON. """
+    report = metrics.report(sessions)
+    if admission is not None:
+        report["admission"] = admission.report()
+    return json.dumps(report, indent=2)
+
+# Maps each admin command to its handler
+ADMIN_COMMANDS = {
+    "STATS": admin_stats,
+    "RELOAD": admin_reload,
+    "POST": admin_post,
+    "PROFILE": admin_profile,
+    "SLOW": admin_slow,
+}
+
+def admin_reply(line):
+    """ Runs one admin command line and returns the reply text. """
+    command, _, arg_str = line.strip().partition(" ")
+    handler = ADMIN_COMMANDS.get(command.upper())
+    if handler is None:
+        return f"unknown command {command!r}; commands are: {', '.join(sorted(ADMIN_COMMANDS))}"
+    return handler(arg_str.split())
+
+def open_admin_socket(path):
+    """ Returns a non-blocking Unix socket listening at path, replacing a socket file left behind by an earlier run. """
+    remove_admin_socket(path)
+    admin_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    admin_sock.bind(path)
+    admin_sock.listen()
+    admin_sock.setblocking(False)
+    log.info("Admin socket at %s", path)
+    return admin_sock
+
+def remove_admin_socket(path):
+    """ Removes the admin socket file at path, if there is one. Any other kind of file is left alone. """
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def accept_admin(admin_sock):
+    """ Accepts a connection on the admin socket. """
+    admin_conn, _ = admin_sock.accept()
+    admin_conn.setblocking(False)
+    sel.register(admin_conn, selectors.EVENT_READ, data=AdminConnection())
+
+def serve_admin(key):
+    """ Reads an admin command line; once it is complete, sends the reply and closes the connection.
+    Replies are small and the peer is local, so they are sent with a short blocking write.
+    :param key: A registered admin connection
+    """
+    admin_conn = key.fileobj
+    data = key.data
+    try:
+        chunk = admin_conn.recv(ADMIN_MAX)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        chunk = b""
+    data.inb += chunk
+    if chunk and b"\n" not in data.inb and len(data.inb) < ADMIN_MAX:
+        return
+    sel.unregister(admin_conn)
+    line = data.inb.split(b"\n")[0].decode("utf-8", errors="replace")
+    if line.strip().upper() == "HANDOVER":
+        # Only returns if this process is to carry on serving
+        hand_over(admin_conn)
+        admin_conn.close()
+        return
+    if data.inb:
+        reply = admin_reply(line)
+        admin_conn.settimeout(1.0)
+        try:
+            admin_conn.sendall(reply.encode("utf-8") + b"\n")
+        except OSError:
+            pass
+    admin_conn.close()
+
+##########################################################
+#                                                        #
+# Bank Server Handover                                   #
+#                                                        #
+# A new server process started with --take-over asks the #
+# running one, over its admin socket, for the listening  #
+# socket, the client sockets, the sessions and the       #
+# accounts, so a redeploy drops no connection and no     #
+# login. Connections arriving meanwhile wait in the      #
+# listen backlog.                                        #
+#                                                        #
+##########################################################
+
+HANDOVER_MAGIC = b"BKHO"
+HANDOVER_HEADER = struct.Struct("!4sQ")     # magic, length of the JSON session table that follows
+HANDOVER_FDS = 250                  # descriptors passed per message; the kernel allows at most 253
+HANDOVER_TIMEOUT = 10.0             # seconds either process waits on the other before giving up
+inherited_listener = None           # the listening socket taken over from the previous process, if any
+
+def session_state(session):
+    """ Returns what another process needs to carry on with a connection, as plain data. """
+    return {
+        "conn_id": session.conn_id,
+        "addr": session.addr,
+        "acct_num": session.acct_num,
+        "watching": session.watching,
+        "framed": session.framed,
+        "binary": session.binary,
+        "closing": session.closing,
+        "inb": base64.b64encode(session.inb).decode("ascii"),
+        "outb": base64.b64encode(session.outb).decode("ascii"),
+        "connected_at": session.connected_at,
+        "last_active": session.last_active,
+        "channels": [[channel.sid, channel.acct_num, channel.watching] for channel in session.channels.values()],
+    }
+
+def restore_session(state, client_conn):
+    """ Adopts a connection handed over by the previous process, as described by session_state. """
+    client_conn.setblocking(False)
+    session = Session(client_conn, tuple(state["addr"]) if state["addr"] else None)
+    session.conn_id = state["conn_id"]
+    session.framed = state["framed"]
+    session.binary = state["binary"]
+    session.closing = state["closing"]
+    session.inb += base64.b64decode(state["inb"])
+    session.outb += base64.b64decode(state["outb"])
+    session.connected_at = state["connected_at"]
+    session.last_active = state["last_active"]
+    sessions.add(session)
+    for channel_state in [[None, state["acct_num"], state["watching"]]] + state["channels"]:
+        sid, acct_num, watching = channel_state
+        channel = session if sid is None else session.channels.setdefault(sid, Channel(session, sid))
+        if acct_num is not None:
+            sessions.bind(channel, acct_num)
+            channel.watching = watching
+    sel.register(client_conn, selectors.EVENT_READ, data=session)
+    update_interest(sel.get_key(client_conn))
+
+def drain_requests(deadline):
+    """ Completes the logins waiting for PIN checks, with the requests held behind them, and any account reload
+    under way, then commits and waits for a background snapshot. Raises TimeoutError if PIN checks are still running
+    at deadline. """
+    global reload_steps, reload_applied
+    while any(session.verifying or any(channel.verifying for channel in session.channels.values())
+              for session in sessions.by_fd.values()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("logins are still waiting for PIN checks")
+        select.select([loop_wakeup[0]], [], [], remaining)
+        run_loop_calls(loop_wakeup[0])
+    steps, reload_steps = reload_steps, None
+    if steps is not None:
+        for _ in steps:
+            pass
+        reload_applied = reload_stamp
+    commit_batch()
+    # The next process opens the journal, and must not find it rotated
+    finish_compaction(block=True)
+
+def send_handover(admin_conn, listener):
+    """ Sends the session table, then the listening socket, the accounts (as a snapshot in an anonymous file) and
+    every client socket, in the order of the session table. """
+    accounts_fd = os.memfd_create("bank-accounts")
+    try:
+        with open(accounts_fd, "wb", closefd=False) as f:
+            f.write(bank_snapshot.pack_records(journal.seq if journal is not None else 0,
+                                               bank_snapshot.account_records(ALL_ACCOUNTS.values()),
+                                               account_file_source()))
+        if history is not None:
+            history.spill_all()
+        live = list(sessions.by_fd.values())
+        state = json.dumps({"next_conn_id": next(connection_ids),
+                            "sessions": [session_state(session) for session in live]}).encode("utf-8")
+        admin_conn.sendall(HANDOVER_HEADER.pack(HANDOVER_MAGIC, len(state)) + state)
+        fds = [listener.fileno(), accounts_fd] + [session.fd for session in live]
+        for start in range(0, len(fds), HANDOVER_FDS):
+            batch = fds[start:start + HANDOVER_FDS]
+            socket.send_fds(admin_conn, [struct.pack("!I", len(batch))], batch)
+    finally:
+        os.close(accounts_fd)
+
+def hand_over(admin_conn):
+    """ HANDOVER: stops accepting, drains the requests in flight and passes everything to the process on the
+    other end of admin_conn. Exits once that process confirms it has taken over; if anything goes wrong before,
+    starts accepting again and carries on serving. """
+    global admin_path
+    admin_conn.settimeout(HANDOVER_TIMEOUT)
+    if shard_count > 1:
+        admin_conn.sendall(b"handover needs a single-process server\n")
+        return
+    listener = next(key.fileobj for key in sel.get_map().values() if key.data is None)
+    sel.unregister(listener)
+    started = time.perf_counter()
+    try:
+        drain_requests(time.monotonic() + HANDOVER_TIMEOUT)
+        send_handover(admin_conn, listener)
+        if admin_conn.recv(16) != b"OK\n":
+            raise ConnectionError("the new process did not confirm the handover")
+    except (OSError, ValueError) as e:
+        log.error("Handover failed, carrying on: %s", e)
+        sel.register(listener, selectors.EVENT_READ, data=None)
+        return
+    log.info("Handed over %d connections in %.3f s; exiting", len(sessions), time.perf_counter() - started)
+    # The admin socket file now belongs to the new process
+    admin_path = None
+    sys.exit(0)
+
+def recv_exactly(conn, length):
+    """ Returns exactly length bytes read from a blocking socket. """
+    data = bytearray()
+    while len(data) < length:
+        chunk = conn.recv(min(length - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed during handover")
+        data += chunk
+    return bytes(data)
+
+def take_over(path):
+    """ Takes over from the server whose admin socket is at path: adopts its listening socket, client connections,
+    sessions and accounts. Returns the journal sequence number the accounts cover. """
+    global inherited_listener, connection_ids
+    started = time.perf_counter()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(HANDOVER_TIMEOUT)
+        conn.connect(path)
+        conn.sendall(b"HANDOVER\n")
+        header = recv_exactly(conn, HANDOVER_HEADER.size)
+        magic, length = HANDOVER_HEADER.unpack(header)
+        if magic != HANDOVER_MAGIC:
+            refusal = header + conn.recv(ADMIN_MAX)
+            raise ConnectionError(f"the running server refused: {refusal.decode('utf-8', errors='replace').strip()}")
+        state = json.loads(recv_exactly(conn, length))
+        fds = []
+        while len(fds) < len(state["sessions"]) + 2:
+            _, batch, _, _ = socket.recv_fds(conn, 4, HANDOVER_FDS)
+            if not batch:
+                raise ConnectionError("the running server stopped before passing every socket")
+            fds += batch
+        inherited_listener = socket.socket(fileno=fds[0])
+        try:
+            snapshot = load_snapshot(fds[1])
+        finally:
+            os.close(fds[1])
+        adopt_source(snapshot)
+        connection_ids = itertools.count(state["next_conn_id"])
+        for session, client_fd in zip(state["sessions"], fds[2:]):
+            restore_session(session, socket.socket(fileno=client_fd))
+        conn.sendall(b"OK\n")
+    log.info("Took over %d connections in %.3f s", len(sessions), time.perf_counter() - started)
+    return snapshot.journal_seq
 
 ##########################################################
 #                                                        #
@@ -420,12 +2480,130 @@ def run_network_server():
 #                                                        #
 ##########################################################
 
-if __name__ == "__main__":
-    # on startup, load all the accounts from the account file
-    load_all_accounts(ACCT_FILE)
+def parse_args(argv):
+    """ Parse the server's command line options. """
+    parser = argparse.ArgumentParser(description="ACME bank server")
+    parser.add_argument("--accounts", default=ACCT_FILE, help="account file loaded when there is no snapshot")
+    parser.add_argument("--journal", default=JOURNAL_FILE, help="write-ahead journal of balance changes")
+    parser.add_argument("--snapshot", default=SNAPSHOT_FILE,
+                        help="binary snapshot loaded at startup if present, and the journal is compacted into")
+    parser.add_argument("--no-journal", action="store_true", help="keep balances in memory only")
+    parser.add_argument("--history", default=HISTORY_FILE,
+                        help="file the older entries of the transaction histories are spilled to")
+    parser.add_argument("--history-depth", type=int, default=bank_history.DEPTH,
+                        help="transaction history entries kept in memory per account; 0 disables history and HIST")
+    parser.add_argument("--store", choices=("dict", "array"), default="dict",
+                        help="keep accounts as BankAccount objects (dict) or packed into arrays with integer-cent balances")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes to partition the accounts across; keep it fixed while journals exist")
+    parser.add_argument("--engine", choices=("selectors", "asyncio"), default="selectors",
+                        help="network engine: the selectors loop or asyncio (uvloop when installed)")
+    parser.add_argument("--admin-socket", default=ADMIN_SOCKET,
+                        help="local socket answering admin commands such as STATS (workers add .N); '' disables it")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a logged-in session may sit silent before it is disconnected; 0 never")
+    parser.add_argument("--login-timeout", type=float, default=LOGIN_TIMEOUT,
+                        help="seconds a connection may sit silent without logging in before it is disconnected; 0 never")
+    parser.add_argument("--max-connections", type=int,
+                        help="most client connections served at once, per worker; by default what the open file limit allows")
+    parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL,
+                        help="seconds between checks of the account file for changes to apply; 0 disables hot reload")
+    parser.add_argument("--take-over", action="store_true",
+                        help="take the listening socket, connections, sessions and accounts over from the server "
+                             "running at --admin-socket, which then exits")
+    parser.add_argument("--peer-rate", type=float, default=0.0,
+                        help="requests per second admitted from each client address; 0 for no limit")
+    parser.add_argument("--peer-burst", type=float,
+                        help="requests a client address may send at once beyond its rate; one second's worth by default")
+    parser.add_argument("--account-rate", type=float, default=0.0,
+                        help="requests per second admitted for each account, logins included; 0 for no limit")
+    parser.add_argument("--account-burst", type=float,
+                        help="requests an account may receive at once beyond its rate; one second's worth by default")
+    parser.add_argument("--overload-lag", type=float, default=0.0,
+                        help="average event loop lag, in seconds, above which every request is answered busy; 0 never")
+    parser.add_argument("--slow-request", type=float, default=0.0,
+                        help="seconds from reading a request to sending its reply beyond which the request is logged "
+                             "with the time each stage took; 0 never")
+    parser.add_argument("--profile-file", default=PROFILE_FILE,
+                        help="file a profile is written to when SIGUSR1 (or PROFILE STOP) stops the profiler "
+                             "(workers add .N)")
+    parser.add_argument("--capture", metavar="TRACE",
+                        help="record all client traffic to TRACE for replay with bank_trace.py")
+    parser.add_argument("--pin-workers", type=int, default=4,
+                        help="threads checking hashed PINs off the event loop; 0 checks them inline")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="info",
+                        help="least severe log messages written; per-connection and per-account messages are debug")
+    args = parser.parse_args(argv)
+    if args.engine == "asyncio" and args.workers > 1:
+        parser.error("--engine asyncio runs a single process; it cannot be combined with --workers")
+    if args.take_over and (args.workers > 1 or args.engine == "asyncio" or not args.admin_socket):
+        parser.error("--take-over needs a single-process server on the selectors engine with an admin socket")
+    if any(burst is not None and burst < 1 for burst in (args.peer_burst, args.account_burst)):
+        parser.error("--peer-burst and --account-burst must allow at least one request")
+    if args.capture and args.workers > 1:
+        # Connections move between workers after login, which would split them across several traces
+        parser.error("--capture records a single process; it cannot be combined with --workers")
+    return args
+
+def start_server(args):
+    """ Load the account state and run the network server in this process. """
+    global admin_path, idle_timeout, login_timeout, max_connections, slow_request, profile_file
+    admin_path = args.admin_socket or None
+    slow_request = args.slow_request
+    profile_file = args.profile_file
+    # SIGUSR1 starts the profiler, and the next one stops it
+    signal.signal(signal.SIGUSR1, toggle_profiler)
+    idle_timeout = args.idle_timeout
+    login_timeout = args.login_timeout
+    max_connections = default_max_connections() if args.max_connections is None else args.max_connections
+    start_pin_pool(args.pin_workers)
+    start_idle_timers()
+    start_admission(args)
+    # Changes made while the accounts load are picked up by the first check
+    watch_account_file(args.accounts, args.reload_interval)
+    if args.store == "array":
+        use_account_store()
+    # on startup, load all the accounts, then replay the journal on top of them unless it is disabled
+    if args.take_over:
+        try:
+            journal_seq = take_over(args.admin_socket)
+        except (OSError, ValueError) as e:
+            log.error("Could not take over from the running server: %s", e)
+            sys.exit(1)
+        if not args.no_journal:
+            open_journal(args.journal, args.snapshot, journal_seq)
+    elif args.no_journal:
+        load_accounts(args.accounts, args.snapshot)
+    else:
+        load_durable_state(args.accounts, args.journal, args.snapshot)
+    # After a take over, the previous process's history entries are only in the spill file once it has handed over
+    open_history(args.history, args.history_depth)
+    start_capture(args.capture)
+    try:
+        if args.engine == "asyncio":
+            import bank_aio
+            bank_aio.run_asyncio_server()
+        else:
+            run_network_server()
+    finally:
+        finish_compaction(block=True)
+        stop_capture()
+
+def main(argv):
+    """ Runs the server with the command line arguments argv. """
+    args = parse_args(argv)
+    bank_metrics.configure_logging(args.log_level)
     # uncomment the next line in order to run a simple demo of the server in action
     #demo_bank_server()
-    run_network_server()
-    print("bank server exiting...")
+    if args.workers > 1:
+        run_sharded_server(args)
+    else:
+        start_server(args)
+    log.info("bank server exiting...")
+
+if __name__ == "__main__":
+    # Run the imported module, which the helper modules share, rather than this __main__ copy of it
+    import bank_server
+    bank_server.main(sys.argv[1:])
 
   
\ No newline at end of file
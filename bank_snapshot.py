@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+#
+# Bank Server binary account snapshot
+#
+# A snapshot is a fixed-size header followed by fixed-size account records sorted by account number,
+# so the server can memory-map the file and find any account with a binary search instead of parsing
+# every line up front. Balances are stored as integer cents.
+#
+#     header: magic "ACMEBNK1", version (uint32), record size (uint32), record count (uint64),
+#             journal sequence number the snapshot covers (uint64), size (uint64) and modification
+#             time in nanoseconds (int64) of the account file the accounts are in line with
+#     record: account number (8 ASCII bytes), PIN (4 ASCII bytes), balance in cents (int64)
+#
+# When any account has a hashed PIN (see bank_pins.py) every record's PIN field is widened to hold
+# a hash, NUL padded; the record size in the header tells readers which layout a file uses.
+#
+# The account file stamp lets startup skip comparing the accounts with an account file that has not
+# changed since; it is 0, 0 when not known. Version 1 snapshots, without the stamp, are still read.
+#
+# Convert a text account file with:   python3 bank_snapshot.py accounts.txt accounts.snap
+
+import mmap
+import os
+import struct
+import sys
+
+import bank_accountfile
+import bank_pins
+import bank_store
+
+
+MAGIC = b"ACMEBNK1"
+VERSION = 2
+HEADER = struct.Struct("<8sIIQQQq")
+V1_HEADER = struct.Struct("<8sIIQQ")     # the header of version 1 snapshots, which carry no account file stamp
+RECORD = struct.Struct("<8s4sq")
+WIDE_RECORD = struct.Struct(f"<8s{bank_pins.HASH_WIDTH}sq")     # for snapshots holding hashed PINs
+RECORD_LAYOUTS = {layout.size: layout for layout in (RECORD, WIDE_RECORD)}
+
+
+def fsync_dir(path):
+    """ Flush the directory entry changes (creates, renames) for the directory holding path. """
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def pack_header(record_size, count, seq, source = None):
+    """ Return the header of a snapshot of count records of record_size bytes, stamped with journal sequence number
+    seq and with source, the (size, mtime in ns) of the account file the accounts are in line with, if known. """
+    size, mtime = source or (0, 0)
+    return HEADER.pack(MAGIC, VERSION, record_size, count, seq, size, mtime)
+
+def pack_records(seq, records, source = None):
+    """ Return the contents of a snapshot holding records, stamped with journal sequence number seq and account file
+    stamp source (see pack_header). Raises ValueError for a record a snapshot cannot hold, before anything is written.
+    :param records: An iterable of (acct_num, pin, cents) tuples
+    """
+    packed = sorted((acct_num.encode("ascii"), pin.encode("ascii"), cents) for acct_num, pin, cents in records)
+    for acct_num, pin, cents in packed:
+        if len(acct_num) != 8 or len(pin) > bank_pins.HASH_WIDTH or abs(cents) > bank_store.MAX_CENTS:
+            raise ValueError(f"account {acct_num.decode('ascii')!r} cannot be stored in a snapshot "
+                             f"(PIN of {len(pin)} characters, balance {cents} cents)")
+    layout = RECORD if all(len(pin) <= 4 for _, pin, _ in packed) else WIDE_RECORD
+    return pack_header(layout.size, len(packed), seq, source) + b"".join(layout.pack(*record) for record in packed)
+
+def write_records(path, seq, records, source = None):
+    """ Atomically replace the snapshot at path with records, stamped with journal sequence number seq and account
+    file stamp source (see pack_header).
+    :param records: An iterable of (acct_num, pin, cents) tuples
+    """
+    write_packed(path, pack_records(seq, records, source))
+
+def write_packed(path, data):
+    """ Atomically replace the snapshot at path with data, the contents of a snapshot file. """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+
+def account_records(accounts):
+    """ Return the (acct_num, pin, cents) records of an iterable of BankAccount-like objects. """
+    return ((acct.acct_number, acct.acct_pin, round(acct.acct_balance * 100)) for acct in accounts)
+
+def write_snapshot(path, seq, accounts):
+    """ Atomically replace the snapshot at path with the given accounts, stamped with journal sequence seq.
+    :param accounts: An iterable of BankAccount-like objects
+    """
+    write_records(path, seq, account_records(accounts))
+
+class Snapshot:
+    """ A read-only, memory-mapped view of a snapshot file. """
+
+    def __init__(self, path):
+        """ Map the snapshot at path, a file name or an open file descriptor, and check its header.
+        Raises ValueError if it is not a snapshot file. """
+        with open(path, "rb", closefd=not isinstance(path, int)) as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < V1_HEADER.size:
+            raise ValueError(f"{path}: too short to be a snapshot")
+        magic, version, record_size, self.count, self.journal_seq = V1_HEADER.unpack_from(self.mm)
+        self.layout = RECORD_LAYOUTS.get(record_size)
+        if magic != MAGIC or version not in (1, VERSION) or self.layout is None:
+            raise ValueError(f"{path}: not a version 1 or {VERSION} bank snapshot")
+        self.records_at = HEADER.size if version == VERSION else V1_HEADER.size
+        if len(self.mm) < self.records_at + self.count * self.layout.size:
+            raise ValueError(f"{path}: truncated snapshot")
+        # (size, mtime in ns) of the account file the accounts are in line with, or None if not known
+        self.source = None
+        if version == VERSION:
+            size, mtime = HEADER.unpack_from(self.mm)[5:]
+            if size or mtime:
+                self.source = (size, mtime)
+
+    def record(self, index):
+        """ Return (acct_num, pin, cents) for the record at index. """
+        acct, pin, cents = self.layout.unpack_from(self.mm, self.records_at + index * self.layout.size)
+        return acct.decode("ascii"), pin.rstrip(b"\0").decode("ascii"), cents
+
+    def find(self, acct_num):
+        """ Return (acct_num, pin, cents) for acct_num, or None if the snapshot has no such account. """
+        key = acct_num.encode("ascii", errors="replace")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self.records_at + mid * self.layout.size
+            probe = self.mm[offset:offset + 8]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return self.record(mid)
+        return None
+
+    def __iter__(self):
+        """ Iterate over every (acct_num, pin, cents) record, in account number order. """
+        for index in range(self.count):
+            yield self.record(index)
+
+    def pins(self):
+        """ Return {acct_num: pin} for every record, sliced straight from the map without unpacking the balances. """
+        mm, size = self.mm, self.layout.size
+        pin_end = size - 8
+        return {mm[offset:offset + 8].decode("ascii"): mm[offset + 8:offset + pin_end].rstrip(b"\0").decode("ascii")
+                for offset in range(self.records_at, self.records_at + self.count * size, size)}
+
+class SnapshotAccounts(dict):
+    """ An account dictionary backed by a Snapshot. Accounts are looked up in the memory map on first use and
+    only then turned into account objects (by make_account) and kept in the dictionary, so startup costs the
+    same for a million accounts as for one. Accounts added later are stored in the dictionary as usual. """
+
+    def __init__(self, snapshot, make_account):
+        """ Wrap snapshot; make_account(acct_num, pin, cents) builds the account object for a record. """
+        super().__init__()
+        self.snapshot = snapshot
+        self.make_account = make_account
+        self.unloaded = snapshot.count
+        self.removed = set()    # accounts deleted since the snapshot was taken, which its records must not revive
+
+    def __missing__(self, acct_num):
+        """ Materialize acct_num from the snapshot the first time it is used. """
+        record = self.snapshot.find(acct_num) if acct_num not in self.removed else None
+        if record is None:
+            raise KeyError(acct_num)
+        acct = self.make_account(*record)
+        dict.__setitem__(self, acct_num, acct)
+        self.unloaded -= 1
+        return acct
+
+    def __contains__(self, acct_num):
+        return dict.__contains__(self, acct_num) or \
+            (acct_num not in self.removed and self.snapshot.find(acct_num) is not None)
+
+    def __delitem__(self, acct_num):
+        """ Remove an account, whether or not it has been materialized. """
+        if dict.__contains__(self, acct_num):
+            dict.__delitem__(self, acct_num)
+        elif acct_num in self:
+            self.unloaded -= 1
+        else:
+            raise KeyError(acct_num)
+        if self.snapshot.find(acct_num) is not None:
+            self.removed.add(acct_num)
+
+    def get(self, acct_num, default = None):
+        try:
+            return self[acct_num]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return dict.__len__(self) + self.unloaded
+
+    def __iter__(self):
+        """ Iterate over the account numbers: materialized ones first, then those still only in the snapshot.
+        Accounts materialized while the iteration is under way may be missed, but never cause an error. """
+        yield from list(dict.keys(self))
+        for acct_num, _, _ in self.snapshot:
+            if not dict.__contains__(self, acct_num) and acct_num not in self.removed:
+                yield acct_num
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        """ Iterate over every account. Records still only in the snapshot are built on the fly and not kept. """
+        yield from dict.values(self)
+        for record in self.snapshot:
+            if not dict.__contains__(self, record[0]) and record[0] not in self.removed:
+                yield self.make_account(*record)
+
+    def items(self):
+        return ((acct.acct_number, acct) for acct in self.values())
+
+##########################################################
+#                                                        #
+# Offline Converter                                      #
+#                                                        #
+##########################################################
+
+def convert(acct_file, snapshot_file):
+    """ Convert a text account file into a binary snapshot. Returns the number of accounts written. """
+    # Stamped before it is read, so that an edit made meanwhile is not taken to be in the snapshot
+    st = os.stat(acct_file)
+    records = list(bank_accountfile.read_account_file(acct_file))
+    write_records(snapshot_file, 0, records, (st.st_size, st.st_mtime_ns))
+    return len(records)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: bank_snapshot.py ACCOUNT_FILE SNAPSHOT_FILE")
+        sys.exit(2)
+    print(f"wrote {convert(sys.argv[1], sys.argv[2])} accounts to {sys.argv[2]}")
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# Bank Server compact account store
+#
+# AccountStore keeps every account in three parallel arrays (packed account id, PIN, balance in
+# integer cents) plus an open-addressing hash table from packed account id to array slot. That is
+# about 22 bytes per account instead of a BankAccount object with its own __dict__, and balances
+# never drift the way repeated float additions do.
+#
+# The store behaves like the ALL_ACCOUNTS dictionary as far as the server is concerned: lookups hand
+# out lightweight AccountView objects that honour the BankAccount deposit/withdraw contract.
+
+from array import array
+
+import bank_pins
+
+
+NO_PIN = 0xFFFF         # PIN slot value for an account loaded without a valid PIN
+HASHED_PIN = 0xFFFE     # PIN slot value for an account whose PIN hash is kept in AccountStore.pin_hashes
+EMPTY = -1              # hash table value for an unused bucket
+MAX_CENTS = (1 << 63) - 1   # largest balance or amount, in cents, the int64 fields of the store, snapshot and history hold
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+# two-letter account prefix -> its packed value, so packing an account number is a single dict lookup
+PREFIX_IDS = {hi + lo: (i * 26 + j) * 100000 for i, hi in enumerate(LETTERS) for j, lo in enumerate(LETTERS)}
+
+
+def pack_acct_num(acct_num):
+    """ Pack a lower-case account number 'aa-nnnnn' into an int below 26*26*100000, or return -1 if it is not one. """
+    prefix_id = PREFIX_IDS.get(acct_num[:2])
+    if prefix_id is None or len(acct_num) != 8 or acct_num[2] != "-" or not acct_num.isascii() or not acct_num[3:].isdigit():
+        return -1
+    return prefix_id + int(acct_num[3:])
+
+def unpack_acct_num(acct_id):
+    """ Return the account number string for a packed account id. """
+    letters, digits = divmod(acct_id, 100000)
+    return f"{LETTERS[letters // 26]}{LETTERS[letters % 26]}-{digits:05d}"
+
+def amount_to_cents(amount):
+    """ Return amount as integer cents if it is a valid transaction amount (see amountIsValid), else None. """
+    if isinstance(amount, float) and amount >= 0 and round(amount, 2) == amount:
+        return round(amount * 100)
+    return None
+
+class AccountView:
+    """ A BankAccount look-alike for one slot of an AccountStore. Views hold no state of their own, so they can
+    be created per lookup and thrown away. """
+    __slots__ = ("store", "slot")
+
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
+
+    @property
+    def acct_number(self):
+        return unpack_acct_num(self.store.ids[self.slot])
+
+    @property
+    def acct_pin(self):
+        pin = self.store.pins[self.slot]
+        if pin == HASHED_PIN:
+            return self.store.pin_hashes[self.slot]
+        return "" if pin == NO_PIN else f"{pin:04d}"
+
+    @acct_pin.setter
+    def acct_pin(self, pin):
+        self.store.set_pin(self.slot, pin)
+
+    @property
+    def acct_balance(self):
+        return self.store.cents[self.slot] / 100
+
+    @acct_balance.setter
+    def acct_balance(self, balance):
+        self.store.cents[self.slot] = round(balance * 100)
+
+    def deposit(self, amount):
+        """ Make a deposit, with the same arguments, result codes (020/021) and return values as BankAccount.deposit. """
+        balances = self.store.cents
+        cents = amount_to_cents(amount)
+        if cents is None or balances[self.slot] + cents > MAX_CENTS:
+            # A balance past MAX_CENTS cannot be stored; the deposit is refused like a malformed amount
+            return self, "021", balances[self.slot] / 100
+        balances[self.slot] += cents
+        return self, "020", balances[self.slot] / 100
+
+    def withdraw(self, amount):
+        """ Make a withdrawal, with the same arguments, result codes (020/021/022) and return values as BankAccount.withdraw. """
+        balances = self.store.cents
+        cents = amount_to_cents(amount)
+        if cents is None:
+            return self, "021", balances[self.slot] / 100
+        if cents > balances[self.slot]:
+            return self, "022", balances[self.slot] / 100
+        balances[self.slot] -= cents
+        return self, "020", balances[self.slot] / 100
+
+class AccountStore:
+    """ Array-backed replacement for the ALL_ACCOUNTS dictionary. """
+
+    def __init__(self, capacity = 1024):
+        """ Create an empty store whose hash table starts with room for capacity accounts. """
+        self.ids = array("i")
+        self.pins = array("H")
+        self.cents = array("q")
+        self.pin_hashes = dict()    # array slot -> PIN hash text, for the accounts that have one
+        self.table = array("i", [EMPTY]) * self.table_size_for(capacity)
+        self.mask = len(self.table) - 1
+
+    @staticmethod
+    def table_size_for(capacity):
+        """ Return the power-of-two table size that keeps capacity accounts at most half full. """
+        size = 8
+        while size < capacity * 2:
+            size *= 2
+        return size
+
+    def find_slot(self, acct_id):
+        """ Return the array slot holding acct_id, or the negative of (bucket + 1) for the empty bucket it would go in. """
+        table, mask, ids = self.table, self.mask, self.ids
+        bucket = (acct_id * 2654435761) & mask
+        while True:
+            slot = table[bucket]
+            if slot == EMPTY:
+                return -(bucket + 1)
+            if ids[slot] == acct_id:
+                return slot
+            bucket = (bucket + 1) & mask
+
+    def grow(self):
+        """ Double the hash table and re-insert every account. """
+        self.table = array("i", [EMPTY]) * (len(self.table) * 2)
+        self.mask = len(self.table) - 1
+        for slot, acct_id in enumerate(self.ids):
+            self.table[-(self.find_slot(acct_id) + 1)] = slot
+
+    def add(self, acct_num, pin, cents):
+        """ Add a new account, or overwrite the PIN and balance of an existing one. Raises KeyError for a malformed account number. """
+        acct_id = pack_acct_num(acct_num)
+        if acct_id < 0:
+            raise KeyError(acct_num)
+        slot = self.find_slot(acct_id)
+        if slot >= 0:
+            self.cents[slot] = cents
+        else:
+            bucket, slot = -(slot + 1), len(self.ids)
+            self.table[bucket] = slot
+            self.ids.append(acct_id)
+            self.pins.append(NO_PIN)
+            self.cents.append(cents)
+            if len(self.ids) * 2 > len(self.table):
+                self.grow()
+        self.set_pin(slot, pin)
+
+    def set_pin(self, slot, pin):
+        """ Store the PIN of the account in slot: four digits, a PIN hash, or anything else for no valid PIN. """
+        pin_value = int(pin) if len(pin) == 4 and pin.isdigit() else NO_PIN
+        if pin_value == NO_PIN and bank_pins.is_pin_hash(pin):
+            pin_value = HASHED_PIN
+        self.pins[slot] = pin_value
+        if pin_value == HASHED_PIN:
+            self.pin_hashes[slot] = pin
+        elif self.pin_hashes:
+            self.pin_hashes.pop(slot, None)
+
+    def bucket_of(self, slot):
+        """ Return the hash table bucket pointing at slot. """
+        table, mask = self.table, self.mask
+        bucket = (self.ids[slot] * 2654435761) & mask
+        while table[bucket] != slot:
+            bucket = (bucket + 1) & mask
+        return bucket
+
+    def remove(self, acct_num):
+        """ Remove an account. The last account moves into its array slot, so slots of other accounts can change.
+        Raises KeyError if the store does not hold acct_num. """
+        slot = self.slot_of(acct_num)
+        if slot < 0:
+            raise KeyError(acct_num)
+        table, mask, ids = self.table, self.mask, self.ids
+        # Empty the bucket, then shift later buckets of the same probe run back so that lookups still find them
+        hole = self.bucket_of(slot)
+        table[hole] = EMPTY
+        bucket = hole
+        while True:
+            bucket = (bucket + 1) & mask
+            if table[bucket] == EMPTY:
+                break
+            home = (ids[table[bucket]] * 2654435761) & mask
+            if (bucket - home) & mask >= (bucket - hole) & mask:
+                table[hole], table[bucket] = table[bucket], EMPTY
+                hole = bucket
+        # Fill the array slot with the last account so the arrays stay dense
+        last = len(ids) - 1
+        self.pin_hashes.pop(slot, None)
+        if slot != last:
+            table[self.bucket_of(last)] = slot
+            ids[slot], self.pins[slot], self.cents[slot] = ids[last], self.pins[last], self.cents[last]
+            if last in self.pin_hashes:
+                self.pin_hashes[slot] = self.pin_hashes.pop(last)
+        for column in (ids, self.pins, self.cents):
+            column.pop()
+
+    def copy(self):
+        """ Return a store holding the same accounts, sharing no arrays with this one. """
+        other = AccountStore.__new__(AccountStore)
+        other.ids, other.pins, other.cents = self.ids[:], self.pins[:], self.cents[:]
+        other.pin_hashes = dict(self.pin_hashes)
+        other.table, other.mask = self.table[:], self.mask
+        return other
+
+    def slot_of(self, acct_num):
+        """ Return the array slot of acct_num, or -1 if the store does not hold it. """
+        acct_id = pack_acct_num(acct_num)
+        return self.find_slot(acct_id) if acct_id >= 0 else -1
+
+    # The dictionary protocol the server uses on ALL_ACCOUNTS
+
+    def __contains__(self, acct_num):
+        return self.slot_of(acct_num) >= 0
+
+    def __getitem__(self, acct_num):
+        slot = self.slot_of(acct_num)
+        if slot < 0:
+            raise KeyError(acct_num)
+        return AccountView(self, slot)
+
+    def __setitem__(self, acct_num, acct):
+        """ Store a BankAccount-like object under acct_num. """
+        self.add(acct_num, acct.acct_pin, round(acct.acct_balance * 100))
+
+    def __delitem__(self, acct_num):
+        self.remove(acct_num)
+
+    def get(self, acct_num, default = None):
+        slot = self.slot_of(acct_num)
+        return AccountView(self, slot) if slot >= 0 else default
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (unpack_acct_num(acct_id) for acct_id in self.ids)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (AccountView(self, slot) for slot in range(len(self.ids)))
+
+    def items(self):
+        return ((view.acct_number, view) for view in self.values())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# Bank Server timer wheel
+#
+# A hierarchical timing wheel: level 0 has one slot per tick, and each higher level has one slot per
+# full turn of the level below. A timer is filed in the lowest level whose span covers it; whenever a
+# level completes a turn, the next slot of the level above is emptied and its timers are filed again,
+# closer to their expiry. Scheduling, cancelling and each tick are constant time no matter how many
+# timers are pending, which suits one timer per connection. Times are in seconds on any monotonic
+# clock, and a timer fires within one tick after it is due.
+
+import math
+
+
+class TimerWheel:
+    """ Timers for arbitrary hashable items, at most one per item. """
+
+    def __init__(self, tick, now, slots = 64, levels = 3):
+        """ tick is the wheel's resolution in seconds and now the current time. Timers due more than
+        tick * slots ** levels seconds ahead are refiled on every turn of the top level until they come in range. """
+        self.tick = tick
+        self.slots = slots
+        self.wheels = [[dict() for _ in range(slots)] for _ in range(levels)]
+        self.where = dict()     # item -> the slot holding its timer
+        self.current = int(now / tick)  # the last tick processed
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, item, when):
+        """ Start item's timer so that it fires at time when, replacing any timer it already had. """
+        self.cancel(item)
+        self.place(item, max(math.ceil(when / self.tick), self.current + 1))
+
+    def cancel(self, item):
+        """ Stop item's timer, if it has one. """
+        slot = self.where.pop(item, None)
+        if slot is not None:
+            del slot[item]
+
+    def place(self, item, expiry):
+        """ File item's timer, due at tick number expiry, in the lowest level whose span reaches it. """
+        level, span = 0, self.slots
+        while expiry - self.current >= span and level < len(self.wheels) - 1:
+            level += 1
+            span *= self.slots
+        slot = self.wheels[level][expiry // (span // self.slots) % self.slots]
+        slot[item] = expiry
+        self.where[item] = slot
+
+    def advance(self, now):
+        """ Process every tick up to now and return the items whose timers fired, which are then forgotten. """
+        fired = []
+        target = int(now / self.tick)
+        if not self.where:
+            # Nothing is pending, so the ticks in between have nothing to do
+            self.current = max(self.current, target)
+            return fired
+        while self.current < target:
+            self.current += 1
+            self.cascade()
+            slot = self.wheels[0][self.current % self.slots]
+            for item in slot:
+                del self.where[item]
+            fired.extend(slot)
+            slot.clear()
+        return fired
+
+    def cascade(self):
+        """ At the start of each turn of a level, refile the timers of the matching slot of the level above. """
+        span = 1
+        for level in range(1, len(self.wheels)):
+            span *= self.slots
+            if self.current % span:
+                return
+            slot = self.wheels[level][self.current // span % self.slots]
+            pending = list(slot.items())
+            slot.clear()
+            for item, expiry in pending:
+                self.place(item, expiry)
+
+    def next_tick_in(self, now):
+        """ Return the seconds until the next tick is due, for use as a poll timeout. """
+        return max(0.0, (self.current + 1) * self.tick - now)
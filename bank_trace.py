@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+#
+# Bank Server traffic capture and replay
+#
+# Started with --capture TRACE, the server records the bytes of every client connection, exactly as they
+# crossed the socket, in a binary trace:
+#
+#     file header:  MAGIC, VERSION u8
+#     record:       nanoseconds since the capture started u64, connection id u32, kind u8, length u32,
+#                   then length bytes of payload
+#
+# where kind is OPEN, IN (received from the client), OUT (sent to it) or CLOSE. Records are packed into a
+# buffer and written in chunks of CAPTURE_BUFFER bytes, so capturing costs one struct pack per read or send.
+#
+# The replay tool plays a trace's client side against a running server, one socket per captured
+# connection, and compares what the server sends back with what it sent during the capture:
+#
+#     python3 bank_trace.py TRACE [--speed 1] [--host HOST] [--port PORT]
+#
+# --speed 1 sends each request at its captured time, 2 at twice the pace, 0 as fast as possible. A
+# connection never runs ahead of its replies: a request is held until the replies captured before it
+# have arrived (or --timeout passes), as the client that sent it would have done. Replies are compared
+# byte for byte, so start the server from the state the capture started from (for example with a copy of
+# its snapshot and --no-journal) or balances will be reported as mismatches.
+
+import argparse
+import collections
+import selectors
+import socket
+import struct
+import sys
+import time
+
+
+MAGIC = b"BKTR"
+VERSION = 1
+RECORD = struct.Struct("<QIBI")
+OPEN, IN, OUT, CLOSE = 0, 1, 2, 3
+CAPTURE_BUFFER = 65536      # trace bytes buffered before they are written out
+CAPTURE_FLUSH_INTERVAL = 1.0    # seconds a buffered trace record may wait to be written
+REPLAY_TIMEOUT = 5.0        # seconds the replay waits for a captured reply before counting it as missing
+SHOW_MISMATCHES = 5         # mismatched replies printed in full
+
+
+class TraceWriter:
+    """ Appends capture records to a trace file through a buffer. """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + bytes([VERSION]))
+        self.buffer = bytearray()
+        self.started = time.monotonic_ns()
+        self.flushed = time.monotonic()
+
+    def record(self, conn_id, kind, payload = b""):
+        """ Add one record for connection conn_id, timestamped now. """
+        self.buffer += RECORD.pack(time.monotonic_ns() - self.started, conn_id, kind, len(payload))
+        self.buffer += payload
+        if len(self.buffer) >= CAPTURE_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer.clear()
+        self.flushed = time.monotonic()
+
+    def flush_if_stale(self):
+        """ Write out buffered records once CAPTURE_FLUSH_INTERVAL has passed since the last write; called from the
+        server's loop so a quiet server's trace does not lag behind. """
+        if self.buffer and time.monotonic() - self.flushed >= CAPTURE_FLUSH_INTERVAL:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def read_trace(path):
+    """ Return the records of the trace at path as (seconds since the capture started, connection id, kind, payload),
+    in the order they were captured. A record cut short by the end of the file is dropped. """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC or len(data) <= len(MAGIC) or data[len(MAGIC)] != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} bank server trace")
+    records = []
+    pos = len(MAGIC) + 1
+    while pos + RECORD.size <= len(data):
+        nanos, conn_id, kind, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if pos + length > len(data):
+            break
+        records.append((nanos / 1e9, conn_id, kind, data[pos:pos + length]))
+        pos += length
+    return records
+
+##########################################################
+#                                                        #
+# Replay                                                 #
+#                                                        #
+##########################################################
+
+class ReplayConnection:
+    """ The client side of one captured connection: what it sent and what it was sent, replayed in order. """
+
+    def __init__(self, conn_id):
+        self.conn_id = conn_id
+        self.steps = collections.deque()    # (captured time, kind, payload) after the OPEN
+        self.opened_at = 0.0    # captured time of the OPEN
+        self.sock = None
+        self.outb = bytearray()     # request bytes not yet taken by the socket
+        self.received = bytearray()
+        self.expected = 0       # bytes of replies consumed by OUT steps so far
+        self.waiting_since = None   # when the replay started waiting for the current OUT step
+        self.request_sent = None    # when the latest request was sent
+        self.request_captured = None    # captured time of the latest request
+        self.hung_up = False    # the server has closed the connection
+        self.done = False
+
+class Replay:
+    """ Replays a trace against the server at address and collects the results. """
+
+    def __init__(self, records, address, speed, timeout):
+        self.address = address
+        self.speed = speed
+        self.timeout = timeout
+        self.sel = selectors.DefaultSelector()
+        self.connections = dict()
+        for when, conn_id, kind, payload in records:
+            if kind == OPEN:
+                conn = self.connections[conn_id] = ReplayConnection(conn_id)
+                conn.opened_at = when
+            elif conn_id in self.connections:
+                self.connections[conn_id].steps.append((when, kind, payload))
+        self.pending = sorted(self.connections.values(), key=lambda conn: conn.opened_at, reverse=True)
+        self.live = []
+        self.captured_latency = []
+        self.replayed_latency = []
+        self.replies = self.mismatched = self.missing = self.requests = 0
+        self.examples = []
+
+    def due(self, captured):
+        """ Return the replay clock time at which something captured at time captured should happen. """
+        return self.started + captured / self.speed if self.speed else self.started
+
+    def run(self):
+        """ Replay every connection to its end. Returns the elapsed time. """
+        self.started = time.perf_counter()
+        while self.pending or self.live:
+            now = time.perf_counter()
+            while self.pending and self.due(self.pending[-1].opened_at) <= now:
+                self.open(self.pending.pop())
+            wakes = [self.advance(conn, now) for conn in self.live]
+            self.live = [conn for conn in self.live if not conn.done]
+            if self.pending:
+                wakes.append(self.due(self.pending[-1].opened_at))
+            wakes = [wake for wake in wakes if wake is not None]
+            if not wakes:
+                continue
+            for key, mask in self.sel.select(max(0.0, min(wakes) - time.perf_counter())):
+                self.service(key.data, mask)
+        return time.perf_counter() - self.started
+
+    def open(self, conn):
+        conn.sock = socket.create_connection(self.address)
+        conn.sock.setblocking(False)
+        self.sel.register(conn.sock, selectors.EVENT_READ, data=conn)
+        self.live.append(conn)
+
+    def advance(self, conn, now):
+        """ Take conn through every step it can complete now. Returns when it next needs attention, or None once
+        it has been replayed to its end. """
+        while conn.steps:
+            captured, kind, payload = conn.steps[0]
+            if kind == OUT:
+                if not self.check_reply(conn, payload, now):
+                    return conn.waiting_since + self.timeout
+            elif self.due(captured) > now:
+                return self.due(captured)
+            elif kind == IN and not conn.hung_up:
+                conn.outb += payload
+                conn.request_sent, conn.request_captured = now, captured
+                self.requests += 1
+                self.update_interest(conn)
+            elif kind == CLOSE:
+                break
+            conn.steps.popleft()
+        self.close(conn)
+        return None
+
+    def check_reply(self, conn, payload, now):
+        """ Compare the next captured reply with what the server has sent. Returns False while it is still due. """
+        end = conn.expected + len(payload)
+        if len(conn.received) < end:
+            if conn.waiting_since is None:
+                conn.waiting_since = now
+            if now - conn.waiting_since < self.timeout and not conn.hung_up:
+                return False
+            self.missing += 1
+        elif conn.received[conn.expected:end] != payload:
+            self.mismatched += 1
+            if len(self.examples) < SHOW_MISMATCHES:
+                self.examples.append((conn.conn_id, bytes(payload), bytes(conn.received[conn.expected:end])))
+        self.replies += 1
+        if conn.request_sent is not None and len(conn.received) >= end:
+            captured = conn.steps[0][0]
+            self.captured_latency.append(captured - conn.request_captured)
+            self.replayed_latency.append(now - conn.request_sent)
+            # Later replies to the same request (pushes, or one reply split over sends) are not timed again
+            conn.request_sent = None
+        conn.expected = end
+        conn.waiting_since = None
+        return True
+
+    def close(self, conn):
+        if not conn.hung_up:
+            self.sel.unregister(conn.sock)
+            conn.sock.close()
+        conn.done = True
+
+    def update_interest(self, conn):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outb else 0)
+        self.sel.modify(conn.sock, events, data=conn)
+
+    def service(self, conn, mask):
+        """ Send pending request bytes and take in reply bytes for one connection. """
+        try:
+            if mask & selectors.EVENT_WRITE:
+                del conn.outb[:conn.sock.send(conn.outb)]
+                self.update_interest(conn)
+            if mask & selectors.EVENT_READ:
+                chunk = conn.sock.recv(65536)
+                conn.received += chunk
+                if not chunk:
+                    self.hang_up(conn)
+        except BlockingIOError:
+            pass
+        except ConnectionError:
+            self.hang_up(conn)
+
+    def hang_up(self, conn):
+        """ The server closed the connection: whatever the trace still expects on it is counted as missing. """
+        if not conn.hung_up:
+            self.sel.unregister(conn.sock)
+            conn.sock.close()
+            conn.hung_up = True
+            conn.outb.clear()
+
+def percentiles_ms(samples):
+    """ Return the p50, p99, p999 and maximum of samples (in seconds) in milliseconds. """
+    if not samples:
+        return [0.0] * 4
+    ordered = sorted(samples)
+    return [ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000 for fraction in (0.5, 0.99, 0.999)] + \
+        [ordered[-1] * 1000]
+
+def print_report(replay, records, elapsed):
+    """ Print what the replay found: reply mismatches and the captured and replayed latency distributions. """
+    captured_span = records[-1][0] - records[0][0] if records else 0.0
+    print(f"connections {len(replay.connections)}, requests {replay.requests}, replies {replay.replies}")
+    print(f"captured over {captured_span:.3f} s, replayed in {elapsed:.3f} s")
+    print(f"mismatched replies {replay.mismatched}, missing replies {replay.missing}")
+    print(f"{'latency ms':>12} {'p50':>9} {'p99':>9} {'p999':>9} {'max':>9}")
+    for name, samples in (("captured", replay.captured_latency), ("replayed", replay.replayed_latency)):
+        print(f"{name:>12} " + " ".join(f"{value:>9.3f}" for value in percentiles_ms(samples)))
+    for conn_id, expected, got in replay.examples:
+        print(f"connection {conn_id}: expected {expected!r}, got {got!r}")
+
+def parse_args(argv):
+    """ Parse the replay tool's command line options. """
+    parser = argparse.ArgumentParser(description="Replay a captured bank server trace")
+    parser.add_argument("trace", help="trace file written by bank_server.py --capture")
+    parser.add_argument("--host", default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument("--port", type=int, default=65432)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="pace relative to the capture: 1 at the original timing, 2 twice as fast, 0 as fast as possible")
+    parser.add_argument("--timeout", type=float, default=REPLAY_TIMEOUT,
+                        help="seconds to wait for a captured reply before counting it as missing")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    records = read_trace(args.trace)
+    replay = Replay(records, (args.host, args.port), args.speed, args.timeout)
+    elapsed = replay.run()
+    print_report(replay, records, elapsed)
+    return 1 if replay.mismatched or replay.missing else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Bank Server binary protocol
+#
+# A compact alternative to the text protocol for ATMs that can speak it. The client opens the
+# connection with HELLO (the MAGIC byte, which no text client sends first, and the protocol VERSION it
+# speaks); the server answers with its own HELLO, and from then on every message in both directions is
+# a fixed-width little-endian struct:
+#
+#     request (16 bytes):  opcode u8, 3 pad bytes, account id u32, value i64
+#     reply   (16 bytes):  result code u16, 6 pad bytes, value i64
+#
+# Amounts and balances are whole cents, so nothing is parsed or formatted as text. The value of a
+# request is the amount for DEP, WD and TRANSFER and the PIN for LOG; the account id is the LOG or
+# TRANSFER account, packed from its AA-NNNNN form the way bank_store.py packs it. A reply carries the
+# text protocol's result code (040, 031, ...) as a number, with the balance as its value where the text
+# reply has one; a bare balance in the text protocol is code 020 here. Balance pushes after WATCH are
+# code 070.
+# BATCH and multiplexed sessions are only available in the text protocol. Should the versions differ,
+# the server still answers with its HELLO, then with 050, and hangs up.
+
+import struct
+
+import bank_store
+
+
+MAGIC = 0xBA
+VERSION = 1
+HELLO = bytes([MAGIC, VERSION])
+REQUEST = struct.Struct("<B3xIq")
+REPLY = struct.Struct("<H6xq")
+
+OP_LOG = 1
+OP_BAL = 2
+OP_DEP = 3
+OP_WD = 4
+OP_TRANSFER = 5
+OP_WATCH = 6
+OP_WATCH_OFF = 7
+OP_EXIT = 8
+
+MAX_ACCT_ID = len(bank_store.PREFIX_IDS) * 100000   # account ids run from 0 up to, not including, this
+
+
+def pack_acct(acct_num):
+    """ Return the account id of an AA-NNNNN account number. Raises ValueError if it is not one. """
+    acct_id = bank_store.pack_acct_num(acct_num.lower())
+    if acct_id < 0:
+        raise ValueError(f"not an account number: {acct_num!r}")
+    return acct_id
+
+def unpack_acct(acct_id):
+    """ Return the account number an account id stands for, or None if it stands for none. """
+    if not 0 <= acct_id < MAX_ACCT_ID:
+        return None
+    return bank_store.unpack_acct_num(acct_id)
+
+def to_cents(amount):
+    """ Return a balance or amount in dollars (a float or its text) as whole cents. """
+    return round(float(amount) * 100)
+
+def encode_request(opcode, acct_num = None, value = 0):
+    """ Return the request frame for opcode, naming acct_num (for LOG and TRANSFER) and carrying value. """
+    return REQUEST.pack(opcode, 0 if acct_num is None else pack_acct(acct_num), value)
+
+def decode_replies(buf):
+    """ Remove every complete reply frame from buf and return them as (code, value) pairs. """
+    count = len(buf) // REPLY.size
+    replies = list(REPLY.iter_unpack(buf[:count * REPLY.size]))
+    del buf[:count * REPLY.size]
+    return replies
+
+class BinaryConnection:
+    """ A blocking client connection speaking the binary protocol, one request at a time. """
+
+    def __init__(self, sock):
+        """ Negotiate the binary protocol on a connected socket. Raises ConnectionError if the server refuses it. """
+        self.sock = sock
+        self.buf = bytearray()
+        sock.sendall(HELLO)
+        while len(self.buf) < len(HELLO):
+            self.receive()
+        if self.buf[:len(HELLO)] != HELLO:
+            raise ConnectionError(f"bank server speaks binary protocol version {self.buf[1]}, not {VERSION}")
+        del self.buf[:len(HELLO)]
+
+    def receive(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed by bank server")
+        self.buf += chunk
+
+    def request(self, opcode, acct_num = None, value = 0):
+        """ Send one request and return its reply as (code, value), skipping balance pushes (code 070). """
+        self.sock.sendall(encode_request(opcode, acct_num, value))
+        while True:
+            while len(self.buf) < REPLY.size:
+                self.receive()
+            code, value = REPLY.unpack_from(self.buf)
+            del self.buf[:REPLY.size]
+            if code != 70:
+                return code, value
+
+    def login(self, acct_num, pin):
+        return self.request(OP_LOG, acct_num, int(pin))
+
+    def balance(self):
+        return self.request(OP_BAL)
+
+    def deposit(self, cents):
+        return self.request(OP_DEP, value=cents)
+
+    def withdraw(self, cents):
+        return self.request(OP_WD, value=cents)
+
+    def transfer(self, acct_num, cents):
+        return self.request(OP_TRANSFER, acct_num, cents)
+
+    def exit(self):
+        """ Log out; the server hangs up without a reply. """
+        self.sock.sendall(encode_request(OP_EXIT))
@@ -0,0 +1,101 @@
+# The server and client modules live at the top of the repository, next to this directory
+import os
+import selectors
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank_server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """ The bank server module with two accounts, ac-12345 (PIN 1324, $100) and wf-14351 (PIN 9834, $50), a fresh
+    session registry and selector, and neither journal nor history. """
+    accounts = {"ac-12345": bank_server.BankAccount("ac-12345", "1324", 100.0),
+                "wf-14351": bank_server.BankAccount("wf-14351", "9834", 50.0)}
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", accounts)
+    monkeypatch.setattr(bank_server, "sessions", bank_server.SessionRegistry())
+    monkeypatch.setattr(bank_server, "journal", None)
+    monkeypatch.setattr(bank_server, "history", None)
+    monkeypatch.setattr(bank_server, "pending_pushes", [])
+    monkeypatch.setattr(bank_server, "sel", selectors.DefaultSelector())
+    monkeypatch.setattr(bank_server, "loop_wakeup", None)
+    yield bank_server
+    bank_server.sel.close()
+
+@pytest.fixture
+def connect(server):
+    """ Returns a function that opens a client connection: the server end is registered with the server's selector
+    as a new Session, and the function returns that Session and the (non-blocking) client end. framed, if given,
+    sets the protocol mode the first bytes would otherwise decide. """
+    socks = []
+
+    def connect(framed = None):
+        conn, peer = socket.socketpair()
+        socks.extend((conn, peer))
+        conn.setblocking(False)
+        peer.setblocking(False)
+        session = server.Session(conn, ("127.0.0.1", 50000))
+        session.framed = framed
+        server.sessions.add(session)
+        server.sel.register(conn, selectors.EVENT_READ, data=session)
+        return session, peer
+
+    yield connect
+    for sock in socks:
+        sock.close()
+
+@pytest.fixture
+def exchange(server):
+    """ Returns a function that sends request bytes from a client end opened by connect, lets the server read,
+    handle and flush them as its loop would, and returns what the server sent back (b"" for nothing). """
+
+    def exchange(session, peer, request):
+        peer.sendall(request)
+        key = server.sel.get_key(session.conn)
+        server.read_requests(key)
+        server.commit_batch()
+        if session.outb:
+            server.transaction(key, selectors.EVENT_WRITE)
+        try:
+            return peer.recv(65536)
+        except BlockingIOError:
+            return b""
+
+    return exchange
+
+@pytest.fixture
+def listening(server):
+    """ Serves the server's accounts on a local TCP port from a thread running the selectors loop's accept, read,
+    write and commit steps, and the calls other threads (such as PIN checks) queue for it. Yields the (host, port)
+    address to connect to. """
+    sock = socket.create_server(("127.0.0.1", 0))
+    sock.setblocking(False)
+    server.sel.register(sock, selectors.EVENT_READ, data=None)
+    server.open_loop_wakeup()
+    stopping = threading.Event()
+
+    def serve():
+        while not stopping.is_set():
+            for key, mask in server.sel.select(timeout=0.01):
+                if key.data is None:
+                    server.accept_wrapper(key.fileobj)
+                elif key.data is server.LOOP_WAKEUP:
+                    server.run_loop_calls(key.fileobj)
+                else:
+                    server.transaction(key, mask)
+            server.commit_batch()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield sock.getsockname()
+    stopping.set()
+    thread.join()
+    for key in list(server.sel.get_map().values()):
+        key.fileobj.close()
+    server.loop_wakeup[1].close()
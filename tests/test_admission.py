@@ -0,0 +1,61 @@
+# Requests beyond a peer address's or an account's rate, or that arrive while the event loop is lagging, are answered
+# "060 <ms>" without being carried out; the client may send them again after ms milliseconds. EXIT is always let
+# through, and buckets that have refilled are forgotten.
+
+import pytest
+
+import bank_admission
+
+
+def test_buckets_allow_a_burst_then_the_rate():
+    table = bank_admission.BucketTable(rate=10, burst=2)
+    assert table.take("a", 0.0) == table.take("a", 0.0) == 0.0
+    assert table.take("a", 0.0) == pytest.approx(0.1)
+    assert table.take("b", 0.0) == 0.0
+    assert table.take("a", 0.1) == 0.0
+    assert table.shed == 1
+
+def test_refilled_buckets_are_swept(monkeypatch):
+    monkeypatch.setattr(bank_admission, "SWEEP_MIN", 4)
+    table = bank_admission.BucketTable(rate=1, burst=1)
+    for key in "abcd":
+        table.take(key, 0.0)
+    table.take("e", 0.5)
+    assert list(table.buckets) == ["a", "b", "c", "d", "e"]
+    table.sweep(1.2)
+    assert list(table.buckets) == ["e"]
+
+def test_a_lagging_loop_turns_every_request_away():
+    admission = bank_admission.Admission(overload_lag=0.05)
+    assert admission.admit("10.0.0.1", None, 0.0) == 0
+    for _ in range(20):
+        admission.record_lag(0.2)
+    assert admission.overloaded()
+    assert admission.admit("10.0.0.1", None, 0.0) == pytest.approx(200, abs=5)
+    for _ in range(30):
+        admission.record_lag(0.0)
+    assert admission.admit("10.0.0.1", None, 0.0) == 0
+    assert admission.report()["overload"]["shed"] == 1
+
+@pytest.fixture
+def limited(server, monkeypatch):
+    """ Admission control allowing each account one request, and no more for a long while. """
+    monkeypatch.setattr(server, "admission", bank_admission.Admission(account_rate=0.001, account_burst=1))
+    return server.admission
+
+def test_requests_beyond_an_accounts_rate_are_not_carried_out(server, connect, exchange, limited):
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    code, delay = exchange(session, peer, b"DEP 5").split()
+    assert code == b"060" and int(delay) > 0
+    assert server.get_acct("ac-12345").acct_balance == 100.0
+    # Another account has a bucket of its own
+    other, other_peer = connect()
+    assert exchange(other, other_peer, b"LOG wf-14351 9834") == b"040"
+    assert exchange(session, peer, b"EXIT") == b""
+    assert session.acct_num is None
+
+def test_logins_count_against_the_account_they_name(server, connect, exchange, limited):
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG ac-12345 1111") == b"041"
+    assert exchange(session, peer, b"LOG ac-12345 1324").startswith(b"060 ")
@@ -0,0 +1,64 @@
+# The asyncio engine serves connections with the same request handling as the selectors loop: replies follow the
+# requests in order, and a connection that sends something unrecognisable gets 050 and is closed. A client that
+# stops reading its replies stops being read from, and connections beyond the limit are turned away.
+
+import asyncio
+import socket
+import time
+
+import bank_aio
+
+
+def serve_one(server, check):
+    """ Accepts one connection with the asyncio engine and runs check(transport, protocol, reader, writer) on it. """
+    async def run():
+        loop = asyncio.get_running_loop()
+        server.use_engine(bank_aio.AsyncioEngine(loop))
+        conn, peer = socket.socketpair()
+        transport, protocol = await loop.connect_accepted_socket(bank_aio.BankProtocol, conn)
+        reader, writer = await asyncio.open_connection(sock=peer)
+        try:
+            await check(transport, protocol, reader, writer)
+        finally:
+            writer.close()
+            transport.close()
+
+    engine = server.engine
+    try:
+        asyncio.run(run())
+    finally:
+        server.use_engine(engine)
+
+def test_asyncio_engine_serves_requests(server):
+    async def check(transport, protocol, reader, writer):
+        replies = []
+        for request in (b"LOG ac-12345 1324", b"BAL", b"bogus"):
+            writer.write(request)
+            replies.append(await reader.read(100))
+        assert replies == [b"040", b"100.0", b"050"]
+        assert await reader.read(100) == b""
+        # Idle timers run on the clock the selectors loop uses
+        assert abs(protocol.session.last_active - time.monotonic()) < 5
+
+    serve_one(server, check)
+
+def test_a_client_behind_on_its_replies_is_not_read_from(server):
+    async def check(transport, protocol, reader, writer):
+        protocol.pause_writing()
+        assert not transport.is_reading()
+        protocol.resume_writing()
+        assert transport.is_reading()
+
+    serve_one(server, check)
+
+def test_connections_beyond_the_limit_are_turned_away(server, monkeypatch):
+    monkeypatch.setattr(server, "max_connections", 1)
+    server.sessions.by_fd[-1] = None
+    refused = server.metrics.refused
+
+    async def check(transport, protocol, reader, writer):
+        assert protocol.session is None
+        assert await reader.read(100) == b""
+
+    serve_one(server, check)
+    assert server.metrics.refused == refused + 1
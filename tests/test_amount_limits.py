@@ -0,0 +1,65 @@
+# Amounts and balances must fit the 64-bit integer cents of the store, snapshot and history: a request that would
+# go beyond them is answered 030 and the server carries on.
+
+import pytest
+
+import bank_history
+import bank_wire
+import bank_store
+
+
+HUGE = "100000000000000000000"
+
+
+@pytest.fixture(params=["dict", "array"])
+def server(server, request, tmp_path, monkeypatch):
+    """ The server's two accounts in either store, with transaction history enabled. """
+    if request.param == "array":
+        accounts = bank_store.AccountStore()
+        for acct in server.ALL_ACCOUNTS.values():
+            accounts[acct.acct_number] = acct
+        monkeypatch.setattr(server, "ALL_ACCOUNTS", accounts)
+    history = bank_history.History(str(tmp_path / "accounts.hist"))
+    monkeypatch.setattr(server, "history", history)
+    yield server
+    history.close()
+
+def log_in(server, connect, acct_num, pin):
+    session, peer = connect()
+    assert server.process_msg(f"LOG {acct_num} {pin}", session).startswith("040")
+    return session
+
+def test_huge_deposit_is_refused(server, connect):
+    session = log_in(server, connect, "ac-12345", "1324")
+    assert server.process_msg(f"DEP {HUGE}", session) == "030"
+    assert server.process_msg("BAL", session) == "100.0"
+
+def test_deposit_past_the_balance_limit_is_refused(server, connect):
+    session = log_in(server, connect, "ac-12345", "1324")
+    balance = server.process_msg(f"DEP {bank_store.MAX_CENTS // 100 - 1000}", session)
+    assert server.process_msg("DEP 1000", session) == "030"
+    assert server.process_msg("BAL", session) == balance
+
+def test_transfer_into_a_full_account_is_rolled_back(server, connect):
+    server.ALL_ACCOUNTS["wf-14351"].acct_balance = 92233720368547700.0
+    session = log_in(server, connect, "ac-12345", "1324")
+    assert server.process_msg("TRANSFER wf-14351 100", session) == "030"
+    assert server.process_msg("BAL", session) == "100.0"
+    assert server.process_msg(f"BATCH DEP 1;TRANSFER wf-14351 {HUGE}", session) == "035 020 030 100.0"
+
+def test_binary_deposit_of_the_largest_frame_value_is_refused(server, connect):
+    session = log_in(server, connect, "ac-12345", "1324")
+    largest = (1 << 63) - 1
+    for opcode in (bank_wire.OP_DEP, bank_wire.OP_WD):
+        assert server.process_msg(bank_wire.encode_request(opcode, value=largest), session) == "030"
+    assert server.process_msg(bank_wire.encode_request(bank_wire.OP_TRANSFER, "wf-14351", largest), session) == "030"
+    assert server.process_msg(bank_wire.encode_request(bank_wire.OP_BAL), session) == bank_wire.REPLY.pack(20, 10000)
+    assert server.binary_reply("030") == bank_wire.REPLY.pack(30, 0)
+
+def test_failed_transfer_is_recorded_with_the_rolled_back_balance(server, connect):
+    server.ALL_ACCOUNTS["wf-14351"].acct_balance = 92233720368547700.0
+    session = log_in(server, connect, "ac-12345", "1324")
+    assert server.process_msg("TRANSFER wf-14351 100", session) == "030"
+    assert server.process_msg(bank_wire.encode_request(bank_wire.OP_TRANSFER, "wf-14351", 10000), session) == "030"
+    _, entries = server.history.page("ac-12345", 0, 2)
+    assert [(verb, code, balance) for _, verb, _, code, balance in entries] == [("TRANSFER", 30, 10000)] * 2
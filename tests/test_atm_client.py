@@ -0,0 +1,68 @@
+# The ATM client waits out a busy server ("060 <ms>") and sends the request again, and tells the customer when the
+# server stays busy instead of taking the busy reply for a balance.
+
+import select
+import socket
+
+import pytest
+
+import atm_client
+
+
+@pytest.fixture
+def atm(monkeypatch):
+    """ A client socket whose server end answers with canned replies, the customer's answers to the prompts, and
+    the waits the client made. """
+    client, server = socket.socketpair()
+    answers, waits = [], []
+    monkeypatch.setattr("builtins.input", lambda prompt: answers.pop(0))
+    monkeypatch.setattr(atm_client.time, "sleep", waits.append)
+    yield client, server, answers, waits
+    client.close()
+    server.close()
+
+def canned(server, *replies):
+    server.sendall(b"".join(atm_client.frame_msg(reply) for reply in replies))
+
+def received(server):
+    msgs = []
+    while select.select([server], [], [], 0)[0]:
+        msgs.append(atm_client.get_from_server(server))
+    return msgs
+
+def test_deposit_is_sent_again_after_a_busy_reply(atm):
+    client, server, answers, waits = atm
+    answers.append("20")
+    canned(server, "060 85", "120.0")
+    cache = atm_client.CachedBalance("100.0")
+    atm_client.process_deposit(client, cache)
+    assert cache.balance == "120.0"
+    assert waits == [0.085]
+    assert received(server) == ["DEP 20", "DEP 20"]
+
+def test_withdrawal_gives_up_while_the_server_stays_busy(atm, capsys):
+    client, server, answers, waits = atm
+    answers.append("20")
+    canned(server, *["060 10"] * (atm_client.BUSY_RETRIES + 1))
+    cache = atm_client.CachedBalance("100.0")
+    atm_client.process_withdrawal(client, cache)
+    assert cache.balance == "100.0"
+    assert len(waits) == atm_client.BUSY_RETRIES
+    assert "busy" in capsys.readouterr().out
+
+def test_transfer_is_sent_again_after_a_busy_reply(atm):
+    client, server, answers, waits = atm
+    answers.extend(["wf-14351", "20"])
+    canned(server, "060 5", "80.0")
+    cache = atm_client.CachedBalance("100.0")
+    atm_client.process_transfer(client, cache)
+    assert cache.balance == "80.0"
+    assert waits == [0.005]
+
+def test_login_is_asked_again_while_the_server_stays_busy(atm, capsys):
+    client, server, answers, waits = atm
+    answers.extend(["ac-12345", "1324", "ac-12345", "1324", "x"])
+    canned(server, *["060 10"] * (atm_client.BUSY_RETRIES + 1), "040 100.0", "100.0")
+    assert atm_client.run_atm_core_loop(client)
+    assert "busy" in capsys.readouterr().out
+    assert received(server)[-3:] == ["LOG ac-12345 1324", "WATCH", "EXIT"]
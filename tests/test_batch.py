@@ -0,0 +1,54 @@
+# TRANSFER moves money between two accounts as one journaled change, and BATCH applies several operations
+# all-or-nothing: a failing operation rolls back every one before it, marks the rest as not attempted (036), and
+# leaves neither a journal record nor a balance push behind.
+
+import pytest
+
+import bank_journal
+
+
+@pytest.fixture
+def session(server, connect, tmp_path):
+    """ A framed session logged in to ac-12345 ($100), with journaling to tmp_path. """
+    server.journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), str(tmp_path / "accounts.snap"))
+    session, _ = connect(framed=True)
+    server.process_msg("LOG ac-12345 1324", session)
+    yield session
+    server.journal.close()
+
+def balances(server):
+    return server.get_acct("ac-12345").acct_balance, server.get_acct("wf-14351").acct_balance
+
+@pytest.mark.parametrize("msg, reply, after", [
+    ("TRANSFER wf-14351 20", "80.0", (80.0, 70.0)),
+    ("TRANSFER wf-14351 200", "031", (100.0, 50.0)),
+    ("TRANSFER zz-99999 20", "032", (100.0, 50.0)),
+    ("TRANSFER ac-12345 20", "032", (100.0, 50.0)),
+    ("TRANSFER wf-14351 2.5", "030", (100.0, 50.0)),
+])
+def test_transfer(server, session, msg, reply, after):
+    assert server.process_msg(msg, session) == reply
+    assert balances(server) == after
+
+def test_a_batch_is_applied_whole(server, session):
+    assert server.process_msg("BATCH DEP 100;TRANSFER wf-14351 50;WD 10", session) == "020 020 020 020 140.0"
+    server.journal.commit()
+    assert balances(server) == (140.0, 100.0)
+    records, _ = bank_journal.read_journal(server.journal.path, 0)
+    assert records == [(1, [("ac-12345", 140.0), ("wf-14351", 100.0)])]
+
+@pytest.mark.parametrize("ops, codes", [
+    ("DEP 10;WD 99999;DEP 5", "020 031 036"),
+    ("TRANSFER wf-14351 50;TRANSFER zz-99999 1", "020 032"),
+    ("WD 10;FLY 5;DEP 1", "020 034 036"),
+])
+def test_a_failing_batch_is_rolled_back(server, session, ops, codes):
+    assert server.process_msg(f"BATCH {ops}", session) == f"035 {codes} 100.0"
+    server.journal.commit()
+    assert balances(server) == (100.0, 50.0)
+    assert bank_journal.read_journal(server.journal.path, 0)[0] == []
+    assert server.pending_pushes == []
+
+@pytest.mark.parametrize("ops", ["", ";".join(["DEP 1"] * 101)])
+def test_an_empty_or_oversized_batch_is_rogue(server, session, ops):
+    assert server.process_msg(f"BATCH {ops}".strip(), session) == "050"
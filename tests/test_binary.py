@@ -0,0 +1,57 @@
+# The binary protocol names accounts by the ids the array-backed store packs them into, and refuses anything that
+# is not an account number. A connection that opens with HELLO is answered with the server's HELLO and then served
+# fixed-width frames with amounts in cents, several to a read; one that speaks another version gets 050 after the
+# HELLO and is closed.
+
+import pytest
+
+import bank_store
+import bank_wire
+
+
+@pytest.mark.parametrize("acct_num", ["aa-00000", "ac-12345", "zz-99999"])
+def test_account_ids_are_the_stores(acct_num):
+    assert bank_wire.pack_acct(acct_num) == bank_wire.pack_acct(acct_num.upper()) == bank_store.pack_acct_num(acct_num)
+    assert bank_wire.unpack_acct(bank_wire.pack_acct(acct_num)) == acct_num
+
+@pytest.mark.parametrize("acct_num", ["ac12345", "a1-12345", "ac-1234x", "ac-123456", "éa-12345"])
+def test_malformed_account_numbers_are_refused(acct_num):
+    with pytest.raises(ValueError):
+        bank_wire.pack_acct(acct_num)
+
+def test_ids_past_the_last_account_stand_for_none():
+    assert bank_wire.unpack_acct(bank_wire.MAX_ACCT_ID) is None
+    assert bank_wire.unpack_acct(-1) is None
+
+def replies(data):
+    return bank_wire.decode_replies(bytearray(data))
+
+def test_binary_sessions_are_served_in_cents(server, connect, exchange):
+    session, peer = connect()
+    assert exchange(session, peer, bank_wire.HELLO + bank_wire.encode_request(bank_wire.OP_LOG, "ac-12345", 1324)) \
+        == bank_wire.HELLO + bank_wire.REPLY.pack(40, 10000)
+    requests = (bank_wire.encode_request(bank_wire.OP_DEP, value=250)
+                + bank_wire.encode_request(bank_wire.OP_WD, value=50)
+                + bank_wire.encode_request(bank_wire.OP_WD, value=100000)
+                + bank_wire.encode_request(bank_wire.OP_TRANSFER, "wf-14351", 1000)
+                + bank_wire.encode_request(bank_wire.OP_BAL))
+    assert replies(exchange(session, peer, requests)) == [(20, 10250), (20, 10200), (31, 0), (20, 9200), (20, 9200)]
+    assert server.get_acct("wf-14351").acct_balance == 60.0
+
+def test_binary_requests_may_arrive_in_pieces(server, connect, exchange):
+    session, peer = connect()
+    frame = bank_wire.HELLO + bank_wire.encode_request(bank_wire.OP_LOG, "ac-12345", 1111)
+    assert exchange(session, peer, frame[:7]) == bank_wire.HELLO
+    assert replies(exchange(session, peer, frame[7:])) == [(41, 0)]
+
+def test_binary_requests_before_login_are_refused(server, connect, exchange):
+    session, peer = connect()
+    exchange(session, peer, bank_wire.HELLO)
+    code, _ = replies(exchange(session, peer, bank_wire.encode_request(bank_wire.OP_BAL)))[0]
+    assert code != 20 and server.get_acct("ac-12345").acct_balance == 100.0
+
+def test_other_versions_are_hung_up_on(server, connect, exchange):
+    session, peer = connect()
+    reply = exchange(session, peer, bytes([bank_wire.MAGIC, bank_wire.VERSION + 1]))
+    assert reply[:2] == bank_wire.HELLO and replies(reply[2:]) == [(50, 0)]
+    assert session.conn.fileno() == -1
@@ -0,0 +1,28 @@
+# Requests are dispatched through REQUEST_HANDLERS: an unknown request code, a request other than LOG or EXIT before
+# a login, or the wrong number of arguments is a rogue request (050), while a well-formed request with a bad value
+# gets that value's error code.
+
+import pytest
+
+
+@pytest.fixture
+def session(server, connect):
+    """ A legacy session logged in to ac-12345 ($100). """
+    session, _ = connect(framed=False)
+    assert server.process_msg("LOG ac-12345 1324", session) == "040"
+    return session
+
+@pytest.mark.parametrize("msg", ["HELLO", "bal", "", "BAL 5", "DEP", "DEP 5 5", "TRANSFER wf-14351",
+                                 "LOG ac-12345", "EXIT now"])
+def test_rogue_requests_get_050(server, session, msg):
+    assert server.process_msg(msg, session) == "050"
+
+@pytest.mark.parametrize("msg", ["BAL", "DEP 5", "WD 5", "TRANSFER wf-14351 5", "WATCH", "HIST"])
+def test_requests_before_a_login_get_050(server, connect, msg):
+    session, _ = connect(framed=True)
+    assert server.process_msg(msg, session) == "050"
+
+@pytest.mark.parametrize("msg, reply", [("DEP 5", "105.0"), ("WD 5", "95.0"), ("WD 500", "031"), ("DEP x", "030"),
+                                        ("TRANSFER wf-14351 5", "95.0"), ("BAL", "100.0")])
+def test_requests_reach_their_handler(server, session, msg, reply):
+    assert server.process_msg(msg, session) == reply
@@ -0,0 +1,42 @@
+# Framed connections send any number of length-prefixed requests per read, in as many pieces as the network cuts
+# them into, and get one framed reply per request, in order. A malformed frame ends the connection with 050. The
+# largest request the protocol allows, a BATCH of MAX_BATCH_OPS transfers of the largest amount sent on a
+# multiplexed logical session, fits in a single frame.
+
+import pytest
+
+
+def test_largest_batch_fits_in_a_frame(server, connect):
+    session, peer = connect()
+    # As many digits as an amount may have
+    amount = "1" + "0" * (server.MAX_AMOUNT_DIGITS - 1)
+    batch = "@999999999 BATCH " + ";".join([f"TRANSFER wf-14351 {amount}"] * server.MAX_BATCH_OPS)
+    for msg in ("@999999999 LOG ac-12345 1324", batch):
+        session.inb += f"{len(msg)}:{msg}".encode()
+    login, reply = server.extract_messages(session)[:2]
+    assert server.process_msg(login, session) == "@999999999 040 100.0"
+    # Every transfer is refused for want of funds, so the batch is not applied
+    assert server.process_msg(reply, session).startswith("@999999999 035 031")
+
+def test_pipelined_requests_are_answered_in_order(connect, exchange):
+    session, peer = connect()
+    replies = exchange(session, peer, b"17:LOG ac-12345 1324" b"6:DEP 10" b"3:BAL" b"5:WD 20")
+    assert replies == b"9:040 100.0" b"5:110.0" b"5:110.0" b"4:90.0"
+
+def test_a_frame_split_across_reads_is_handled_once_complete(connect, exchange):
+    session, peer = connect()
+    assert exchange(session, peer, b"17:LOG ac-") == b""
+    assert exchange(session, peer, b"12345 1324" b"3:B") == b"9:040 100.0"
+    assert exchange(session, peer, b"AL") == b"5:100.0"
+
+@pytest.mark.parametrize("request_bytes", [b"x5:BAL", b"99999:BAL", b"3BAL" + b"0" * 8])
+def test_a_malformed_frame_ends_the_connection(server, connect, exchange, request_bytes):
+    session, peer = connect(framed=True)
+    assert exchange(session, peer, request_bytes) == b"3:050"
+    assert session.conn.fileno() == -1
+    assert peer.recv(16) == b""
+
+def test_a_client_starting_with_a_request_code_is_not_framed(connect, exchange):
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    assert session.framed is False
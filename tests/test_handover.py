@@ -0,0 +1,106 @@
+# A new server process taking over from a running one gets its listening socket, its client connections with their
+# sessions (logins, logical sessions, watches and unsent bytes) and its accounts, so clients carry on where they were
+# without logging in again. A handover the new process does not confirm leaves the old one serving.
+
+import itertools
+import json
+import selectors
+import socket
+import threading
+
+import pytest
+
+
+def test_session_state_survives_serialization(server, connect, exchange, monkeypatch):
+    session, peer = connect()
+    assert exchange(session, peer, b"17:LOG ac-12345 1324" b"5:WATCH") == b"9:040 100.0" b"5:100.0"
+    assert exchange(session, peer, b"20:@7 LOG wf-14351 9834") == b"11:@7 040 50.0"
+    session.inb += b"3:BA"
+    state = json.loads(json.dumps(server.session_state(session)))
+    monkeypatch.setattr(server, "sessions", server.SessionRegistry())
+    conn = session.conn.dup()
+    server.sel.unregister(session.conn)
+    server.restore_session(state, conn)
+    restored = server.sessions.by_acct["ac-12345"]
+    try:
+        assert restored.conn is conn and restored.watching and restored.framed and restored.inb == b"3:BA"
+        assert server.sessions.by_acct["wf-14351"] is restored.channels["7"]
+        assert (restored.conn_id, restored.addr) == (session.conn_id, session.addr)
+    finally:
+        conn.close()
+
+@pytest.fixture
+def admin_path(tmp_path):
+    return str(tmp_path / "admin.sock")
+
+def test_take_over_carries_on_every_session(server, connect, exchange, admin_path, monkeypatch):
+    listener = socket.create_server(("127.0.0.1", 0))
+    server.sel.register(listener, selectors.EVENT_READ, data=None)
+    address = listener.getsockname()
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    assert exchange(session, peer, b"DEP 5") == b"105.0"
+    monkeypatch.setattr(server, "inherited_listener", None)
+    monkeypatch.setattr(server, "connection_ids", itertools.count(7))
+    # The new process only loads what it was sent once the old one has let go of its sessions
+    handed_over = threading.Event()
+    load_snapshot = server.load_snapshot
+    monkeypatch.setattr(server, "load_snapshot", lambda fd: handed_over.wait(5) and load_snapshot(fd))
+    taken = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as admin:
+        admin.bind(admin_path)
+        admin.listen()
+        new_process = threading.Thread(target=lambda: taken.append(server.take_over(admin_path)))
+        new_process.start()
+        admin_conn, _ = admin.accept()
+        with admin_conn:
+            assert admin_conn.recv(16) == b"HANDOVER\n"
+            server.send_handover(admin_conn, listener)
+            old_sel = server.sel
+            monkeypatch.setattr(server, "sessions", server.SessionRegistry())
+            monkeypatch.setattr(server, "sel", selectors.DefaultSelector())
+            handed_over.set()
+            assert admin_conn.recv(16) == b"OK\n"
+        new_process.join()
+    for key in list(old_sel.get_map().values()):
+        key.fileobj.close()
+    old_sel.close()
+    try:
+        assert taken == [0]
+        assert server.inherited_listener.getsockname() == address
+        restored = server.sessions.by_acct["ac-12345"]
+        assert exchange(restored, peer, b"BAL") == b"105.0"
+        assert next(server.connection_ids) == 8
+    finally:
+        server.inherited_listener.close()
+        for key in list(server.sel.get_map().values()):
+            key.fileobj.close()
+
+def test_a_refused_take_over_is_reported(server, admin_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as admin:
+        admin.bind(admin_path)
+        admin.listen()
+
+        def refuse():
+            conn, _ = admin.accept()
+            with conn:
+                conn.recv(16)
+                conn.sendall(b"handover needs a single-process server\n")
+
+        old_process = threading.Thread(target=refuse)
+        old_process.start()
+        with pytest.raises(ConnectionError, match="single-process"):
+            server.take_over(admin_path)
+        old_process.join()
+
+def test_an_unconfirmed_handover_carries_on_serving(server, connect):
+    listener = socket.create_server(("127.0.0.1", 0))
+    server.sel.register(listener, selectors.EVENT_READ, data=None)
+    connect()
+    old_end, new_end = socket.socketpair()
+    with old_end, new_end:
+        new_end.sendall(b"NO\n")
+        server.hand_over(old_end)
+    assert server.sel.get_key(listener).data is None
+    assert len(server.sessions) == 1
+    listener.close()
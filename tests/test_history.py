@@ -0,0 +1,76 @@
+# Each account's transaction history keeps its newest entries in memory and spills older ones to an append-only
+# file. A page is the same wherever its entries are held, histories survive a restart up to what was spilled, and a
+# block torn by a crash is cut off. HIST pages through the history, newest first.
+
+import os
+
+import pytest
+
+import bank_history
+
+
+def entries_for(count):
+    """ Returns the entries fill appends, newest first, as History.page returns them. """
+    return [(float(n), "DEP", n, 20, 100 * n) for n in range(count, 0, -1)]
+
+def fill(history, acct_num, count):
+    for when, verb, amount, code, balance in reversed(entries_for(count)):
+        history.append(acct_num, when, verb, amount, code, balance)
+
+def test_pages_are_the_same_from_memory_and_file(tmp_path):
+    history = bank_history.History(str(tmp_path / "accounts.hist"), depth=4)
+    try:
+        fill(history, "ac-12345", 37)
+        fill(history, "wf-14351", 5)
+        expected = entries_for(37)
+        for skip in range(0, 40):
+            for count in (1, 3, 7, 40):
+                assert history.page("ac-12345", skip, count) == (37, expected[skip:skip + count])
+        assert history.page("wf-14351", 0, 10) == (5, entries_for(5))
+        assert history.page("qx-99999", 0, 10) == (0, [])
+    finally:
+        history.close()
+
+def test_spilled_history_survives_a_restart(tmp_path):
+    path = str(tmp_path / "accounts.hist")
+    history = bank_history.History(path, depth=4)
+    fill(history, "ac-12345", 10)
+    history.spill_all()
+    history.close()
+    with open(path, "ab") as f:
+        # A block header torn off by a crash
+        f.write(b"\x01" * (bank_history.BLOCK_HEADER.size - 3))
+    history = bank_history.History(path, depth=4)
+    try:
+        assert history.page("ac-12345", 0, 20) == (10, entries_for(10))
+        assert os.path.getsize(path) == history.size
+    finally:
+        history.close()
+
+@pytest.fixture
+def logged_in(server, connect, exchange, tmp_path, monkeypatch):
+    """ A session logged in to ac-12345, with history kept four entries deep in memory. """
+    history = bank_history.History(str(tmp_path / "accounts.hist"), depth=4)
+    monkeypatch.setattr(server, "history", history)
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    yield session, peer
+    history.close()
+
+def test_hist_pages_newest_first(server, exchange, logged_in):
+    session, peer = logged_in
+    for n in range(1, 8):
+        exchange(session, peer, f"DEP {n}".encode())
+    exchange(session, peer, b"WD 500")
+    reply = exchange(session, peer, b"HIST 0 3").decode().split(";")
+    assert reply[0] == "020 8"
+    assert [entry.split()[1:] for entry in reply[1:]] == [["WD", "500.00", "031", "128.00"],
+                                                          ["DEP", "7.00", "020", "128.00"],
+                                                          ["DEP", "6.00", "020", "121.00"]]
+    reply = exchange(session, peer, b"HIST 6").decode().split(";")
+    assert [entry.split()[2] for entry in reply[1:]] == ["2.00", "1.00"]
+
+@pytest.mark.parametrize("request_", [b"HIST 0 0", b"HIST 0 21", b"HIST -1", b"HIST x", b"HIST 0 1 2"])
+def test_malformed_hist_requests_are_refused(server, exchange, logged_in, request_):
+    session, peer = logged_in
+    assert exchange(session, peer, request_) == b"050"
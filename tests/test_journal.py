@@ -0,0 +1,57 @@
+# Every balance change is journaled, and a batch of changes becomes durable together at the end of the loop
+# iteration (group commit). A transfer is one record, so it is replayed whole or not at all, and a torn record at the
+# end of the journal, left by a crash part way through a write, is ignored and cut off.
+
+import os
+
+import pytest
+
+import bank_journal
+
+
+@pytest.fixture
+def journal_file(server, tmp_path):
+    """ The path of the journal the server writes to while the test runs. """
+    path = str(tmp_path / "accounts.journal")
+    server.journal = bank_journal.Journal(path, str(tmp_path / "accounts.snap"))
+    yield path
+    server.journal.close()
+
+def restarted(server, journal_file):
+    """ Return the balances of ac-12345 and wf-14351, starting from $100 and $50, after replaying journal_file. """
+    for acct_num, balance in (("ac-12345", 100.0), ("wf-14351", 50.0)):
+        server.ALL_ACCOUNTS[acct_num].acct_balance = balance
+    server.replay_journal(journal_file, 0)
+    return server.get_acct("ac-12345").acct_balance, server.get_acct("wf-14351").acct_balance
+
+def test_a_batch_is_written_at_once(server, connect, journal_file):
+    session, _ = connect(framed=True)
+    session.inb += b"17:LOG ac-12345 1324" b"6:DEP 10" b"19:TRANSFER wf-14351 5"
+    server.process_requests(server.sel.get_key(session.conn))
+    assert os.path.getsize(journal_file) == 0
+    server.commit_batch()
+    records, _ = bank_journal.read_journal(journal_file, 0)
+    assert records == [(1, [("ac-12345", 110.0)]), (2, [("ac-12345", 105.0), ("wf-14351", 55.0)])]
+    assert restarted(server, journal_file) == (105.0, 55.0)
+
+def test_a_torn_record_is_cut_off(server, tmp_path, journal_file):
+    server.deposit_req("ac-12345", "10")
+    server.commit_batch()
+    intact = os.path.getsize(journal_file)
+    with open(journal_file, "a") as f:
+        f.write(bank_journal.format_record(2, [("ac-12345", 105.0), ("wf-14351", 55.0)])[:20])
+    assert restarted(server, journal_file) == (110.0, 50.0)
+    last_seq, valid_length = server.replay_journal(journal_file, 0)
+    assert (last_seq, valid_length) == (1, intact)
+    bank_journal.Journal(journal_file, str(tmp_path / "accounts.snap"), last_seq, valid_length).close()
+    assert os.path.getsize(journal_file) == intact
+
+def test_a_corrupt_record_ends_the_replay(server, journal_file):
+    server.deposit_req("ac-12345", "10")
+    server.deposit_req("ac-12345", "10")
+    server.commit_batch()
+    with open(journal_file) as f:
+        lines = f.readlines()
+    with open(journal_file, "w") as f:
+        f.write(lines[0] + lines[1].replace("120.00", "920.00"))
+    assert restarted(server, journal_file) == (110.0, 50.0)
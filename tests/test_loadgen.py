@@ -0,0 +1,59 @@
+# The load generator logs in with the PINs of the account file, which it cannot do with hashed ones: those come from
+# a second file with the plain PINs, or it refuses to run. Latencies are kept in log-spaced buckets, 2% wide, that
+# merge across threads and processes, and replies are tallied by result code.
+
+import argparse
+
+import pytest
+
+import atm_loadgen
+import bank_pins
+
+
+@pytest.fixture
+def files(tmp_path):
+    """ Paths of an account file with one hashed and one plain PIN, and of the plain account file it came from. """
+    plain = tmp_path / "accounts.txt"
+    plain.write_text("ac-12345,1324,100.0\nwf-14351,9834,50.0\n")
+    hashed = tmp_path / "hashed.txt"
+    hashed.write_text(f"ac-12345,{bank_pins.hash_pin('1324', iterations=1)},100.0\nwf-14351,9834,50.0\n")
+    return str(hashed), str(plain)
+
+def test_plain_pins_are_used_as_they_are(files):
+    _, plain = files
+    assert atm_loadgen.session_accounts(plain, None, 10) == [("ac-12345", "1324"), ("wf-14351", "9834")]
+
+def test_hashed_pins_are_refused(files):
+    hashed, _ = files
+    with pytest.raises(SystemExit, match="ac-12345 first, with --pins"):
+        atm_loadgen.session_accounts(hashed, None, 10)
+
+def test_hashed_pins_come_from_the_pin_file(files):
+    hashed, plain = files
+    assert atm_loadgen.session_accounts(hashed, plain, 10) == [("ac-12345", "1324"), ("wf-14351", "9834")]
+
+def test_percentiles_are_within_a_bucket_of_the_samples():
+    histogram = atm_loadgen.LatencyHistogram()
+    for ms in range(1, 101):
+        histogram.record(ms / 1000)
+    for fraction, ms in ((0.5, 50), (0.99, 99), (1.0, 100)):
+        assert ms <= histogram.percentile_ms(fraction) <= ms * atm_loadgen.HISTOGRAM_GROWTH ** 2
+
+def test_merged_stats_add_up():
+    first, second = atm_loadgen.CommandStats(), atm_loadgen.CommandStats()
+    for stats, reply in ((first, "100.0"), (first, "031"), (second, "060 250"), (second, "5.00")):
+        stats.record(0.001, reply)
+    # As the stats cross the process boundary
+    merged = atm_loadgen.CommandStats()
+    merged.histogram = atm_loadgen.LatencyHistogram(first.histogram.buckets)
+    merged.replies = dict(first.replies)
+    merged.merge(second)
+    assert merged.replies == {"balance": 2, "031": 1, "060": 1}
+    assert merged.histogram.count() == 4
+    report = atm_loadgen.summarize({"WD": merged}, 0, {"duration": 2.0}, 2.5)
+    assert report["commands"]["WD"]["count"] == 4 and report["commands"]["WD"]["per_sec"] == 2.0
+
+def test_mix_names_known_requests_only():
+    assert atm_loadgen.parse_mix("BAL=60,DEP=20,WD=20") == {"BAL": 60.0, "DEP": 20.0, "WD": 20.0}
+    with pytest.raises(argparse.ArgumentTypeError):
+        atm_loadgen.parse_mix("BAL=50,HIST=50")
@@ -0,0 +1,21 @@
+# A successful login on a framed connection carries the starting balance ("040 <balance>"); a legacy ATM, which
+# compares the reply with "040", gets a bare 040 as it always has.
+
+import bank_wire
+
+
+def test_legacy_login_is_a_bare_040(connect, exchange):
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    assert exchange(session, peer, b"BAL") == b"100.0"
+
+def test_framed_login_carries_the_balance(connect, exchange):
+    session, peer = connect()
+    assert exchange(session, peer, b"17:LOG ac-12345 1324") == b"9:040 100.0"
+    assert exchange(session, peer, b"20:@1 LOG wf-14351 9834") == b"11:@1 040 50.0"
+
+def test_binary_login_carries_the_balance(connect, exchange):
+    session, peer = connect()
+    assert exchange(session, peer, bank_wire.HELLO) == bank_wire.HELLO
+    reply = exchange(session, peer, bank_wire.encode_request(bank_wire.OP_LOG, "ac-12345", 1324))
+    assert bank_wire.REPLY.unpack(reply) == (40, 10000)
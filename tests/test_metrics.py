@@ -0,0 +1,55 @@
+# Latency percentiles are estimated within their power-of-two bucket and never reported above the largest sample.
+# Every request is counted under its request code and its reply under its result code, and the STATS admin command
+# reports them with the sessions and connections. Log records are buffered and written out together.
+
+import io
+import json
+import logging
+
+import bank_metrics
+
+
+def test_percentile_is_not_above_the_largest_sample():
+    histogram = bank_metrics.Histogram()
+    for _ in range(10):
+        # 1.1 ms falls in the bucket that ends at 2.048 ms
+        histogram.record(0.0011)
+    report = histogram.report()
+    assert report["p50_ms"] <= report["max_ms"] == 1.1
+    assert report["p999_ms"] == 1.1
+
+def test_percentile_is_interpolated_within_its_bucket():
+    histogram = bank_metrics.Histogram()
+    for micros in range(1024, 2048):
+        histogram.record(micros / 1e6)
+    assert 1.4 < histogram.percentile_ms(0.5) < 1.6
+
+def test_stats_count_requests_and_replies(server, connect, monkeypatch):
+    monkeypatch.setattr(server, "metrics", bank_metrics.Metrics())
+    session, _ = connect(framed=True)
+    for msg in ("LOG ac-12345 1324", "BAL", "WD 500", "NOPE"):
+        server.process_msg(msg, session)
+    report = json.loads(server.admin_reply("stats"))
+    assert {verb: stats["count"] for verb, stats in report["requests"].items()} == {"BAL": 1, "LOG": 1, "WD": 1,
+                                                                                    "other": 1}
+    assert report["results"] == {"040": 1, "balance": 1, "031": 1, "050": 1}
+    assert report["sessions"] == {"active": 1, "logged_in": 1}
+
+def test_unknown_admin_commands_are_listed(server):
+    assert server.admin_reply("REBOOT").startswith("unknown command 'REBOOT'; commands are: ")
+
+def test_log_records_are_written_together():
+    stream = io.StringIO()
+    handler = bank_metrics.BufferedHandler(stream)
+    logger = logging.getLogger("test_buffered_log")
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.warning("first")
+        logger.warning("second")
+        assert stream.getvalue() == ""
+        # An error is written out at once, with everything before it
+        logger.error("third")
+        assert stream.getvalue().split() == ["first", "second", "third"]
+    finally:
+        logger.removeHandler(handler)
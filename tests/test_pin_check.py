@@ -0,0 +1,60 @@
+# A login waiting for its PIN hash to be checked holds only the requests of its own session: the other logical
+# sessions multiplexed on the connection carry on, and its held requests follow its reply.
+
+import pytest
+
+import bank_pins
+
+
+@pytest.fixture
+def checks(server, monkeypatch):
+    """ Gives ac-12345 a hashed PIN and makes the PIN check pool record the checks (see finish_checks) instead of
+    running them. Returns the list they are recorded in. """
+    server.ALL_ACCOUNTS["ac-12345"] = server.BankAccount("ac-12345", bank_pins.hash_pin("1324", iterations=1), 100.0)
+    checks = []
+    monkeypatch.setattr(server, "pin_pool", object())
+    monkeypatch.setattr(server, "start_pin_check", lambda *args: checks.append(args))
+    return checks
+
+def send(server, session, *messages):
+    for msg in messages:
+        session.inb += f"{len(msg)}:{msg}".encode()
+    server.process_requests(server.sel.get_key(session.conn))
+
+def replies(session):
+    out, payloads = session.outb.decode(), []
+    session.outb.clear()
+    while out:
+        length, _, out = out.partition(":")
+        payloads.append(out[:int(length)])
+        out = out[int(length):]
+    return payloads
+
+def finish_checks(server, checks):
+    for session, acct_num, stored_pin, acct_pin in checks:
+        server.finish_pin_check(session, acct_num, acct_pin, bank_pins.verify_pin(stored_pin, acct_pin), 0.0)
+    checks.clear()
+
+def test_other_channels_carry_on_during_a_pin_check(server, connect, checks):
+    session, peer = connect()
+    send(server, session, "@1 LOG ac-12345 1324", "@1 BAL", "@2 LOG wf-14351 9834", "@2 BAL")
+    assert replies(session) == ["@2 040 50.0", "@2 50.0"]
+    assert session.channels["1"].held == ["@1 BAL"]
+    finish_checks(server, checks)
+    assert replies(session) == ["@1 040 100.0", "@1 100.0"]
+    assert not session.channels["1"].verifying and not session.channels["1"].held
+
+def test_untagged_login_holds_the_untagged_session(server, connect, checks):
+    session, peer = connect()
+    send(server, session, "LOG ac-12345 1324", "BAL", "@2 LOG wf-14351 9834")
+    assert replies(session) == ["@2 040 50.0"]
+    finish_checks(server, checks)
+    assert replies(session) == ["040 100.0", "100.0"]
+
+def test_too_many_held_requests_end_the_channel(server, connect, checks):
+    session, peer = connect()
+    send(server, session, "@1 LOG ac-12345 1324", *["@1 BAL"] * (server.MAX_HELD + 1))
+    assert replies(session) == ["@1 050"]
+    assert "1" not in session.channels
+    finish_checks(server, checks)
+    assert not session.outb
@@ -0,0 +1,47 @@
+# PINs may be stored as salted PBKDF2 hashes, which the PIN check pool verifies off the event loop: a login with the
+# right PIN succeeds and one with a wrong PIN is refused (041), as with plain PINs, while other connections are
+# served meanwhile.
+
+import io
+import socket
+
+import pytest
+
+import bank_accountfile
+import bank_pins
+
+
+def test_hashes_verify_only_their_pin():
+    stored = bank_pins.hash_pin("1324", iterations=10)
+    assert bank_pins.is_pin_hash(stored) and not bank_pins.is_pin_hash("1324")
+    assert bank_pins.verify_pin(stored, "1324")
+    assert not bank_pins.verify_pin(stored, "1325")
+    assert stored != bank_pins.hash_pin("1324", iterations=10)
+    assert not bank_pins.verify_pin(stored.replace("$10$", "$x$"), "1324")
+
+def test_hashed_account_files_load(tmp_path):
+    acct_file = tmp_path / "accounts.txt"
+    acct_file.write_text("# account number, pin, balance\nac-12345, 1324, 100.0\n")
+    hashed = io.StringIO()
+    bank_pins.hash_account_file(str(acct_file), hashed, iterations=10)
+    acct_file.write_text(hashed.getvalue())
+    [(acct_num, stored, cents)] = bank_accountfile.read_account_file(str(acct_file))
+    assert (acct_num, cents) == ("ac-12345", 10000) and bank_pins.verify_pin(stored, "1324")
+
+@pytest.fixture
+def pool(server, monkeypatch):
+    """ A running PIN check pool, with ac-12345's PIN hashed. """
+    server.ALL_ACCOUNTS["ac-12345"].acct_pin = bank_pins.hash_pin("1324", iterations=10)
+    monkeypatch.setattr(server, "pin_pool", None)
+    server.start_pin_pool(2)
+    yield server.pin_pool
+    server.pin_pool.shutdown()
+
+def log_in(address, pin):
+    with socket.create_connection(address, timeout=5) as sock:
+        sock.sendall(f"LOG ac-12345 {pin}".encode())
+        return sock.recv(64)
+
+@pytest.mark.parametrize("pin, reply", [("1324", b"040"), ("1111", b"041")])
+def test_logins_are_checked_in_the_pool(server, pool, listening, pin, reply):
+    assert log_in(listening, pin) == reply
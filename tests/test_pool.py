@@ -0,0 +1,53 @@
+# An ATMPool multiplexes many logical ATM sessions over a few framed connections: each session's replies find their
+# way back to it, a session can be closed while the others carry on, and balance pushes reach the watching session.
+
+import threading
+
+import pytest
+
+import atm_pool
+
+
+@pytest.fixture
+def pool(listening):
+    with atm_pool.ATMPool(listening, size=2) as pool:
+        yield pool
+
+def test_sessions_share_connections(server, pool):
+    atms = [pool.open_session() for _ in range(3)]
+    assert len(pool.conns) == 2
+    assert atms[0].login("ac-12345", "1324") == "040 100.0"
+    assert atms[1].login("wf-14351", "9834") == "040 50.0"
+    assert atms[2].login("ac-12345", "1324") == "043"
+    assert atms[0].deposit(20) == "120.0"
+    assert atms[1].transfer("ac-12345", 10) == "40.0"
+    assert atms[0].balance() == "130.0"
+    assert atms[1].batch(["DEP 5", "WD 500"]) == "035 020 031 40.0"
+    for atm in atms:
+        atm.close()
+    assert sum(conn.sessions for conn in pool.conns) == 0
+
+def test_requests_from_many_threads(server, pool):
+    atm = pool.open_session()
+    other = pool.open_session()
+    atm.login("ac-12345", "1324")
+    other.login("wf-14351", "9834")
+    futures = [session.submit("DEP 1") for _ in range(50) for session in (atm, other)]
+    assert [future.result(5) for future in futures][-2:] == ["150.0", "100.0"]
+
+def test_a_watching_session_is_pushed_its_balance(server, pool):
+    watcher, sender = pool.open_session(), pool.open_session()
+    watcher.login("ac-12345", "1324")
+    sender.login("wf-14351", "9834")
+    pushed = threading.Event()
+    assert watcher.watch(lambda balance: pushed.set()) == "100.0"
+    sender.transfer("ac-12345", 5)
+    assert pushed.wait(5)
+    assert watcher.cached_balance == "105.00"
+
+def test_a_rogue_request_fails_the_connections_requests(server, pool):
+    atm = pool.open_session()
+    # An untagged request is answered untagged, then the server hangs up
+    atm.conn.sock.sendall(b"3:BAL")
+    with pytest.raises(ConnectionError):
+        atm.submit("BAL").result(5)
@@ -0,0 +1,101 @@
+# POST applies interest and a fee to every account at once. The NumPy and loop paths give the same result, interest
+# that would take a balance past bank_store.MAX_CENTS is refused rather than wrapped around, and a posting whose
+# snapshot cannot be written is taken back and reported. Sessions watching their account are pushed the posted
+# balance.
+
+import json
+import selectors
+
+import pytest
+
+import bank_journal
+import bank_posting
+import bank_store
+
+MAX = bank_store.MAX_CENTS
+
+
+@pytest.mark.parametrize("post", [bank_posting.post_cents, bank_posting.post_cents_loop])
+def test_interest_and_fee_follow_the_schedule(post):
+    posted, result = post([10000, 5000, 150, 0, -500], bank_posting.Schedule(0.01, 200, 10000))
+    assert list(posted) == [10100, 4850, 152, 0, -500]
+    assert result == {"accounts": 5, "interest_cents": 152, "interest_refused": 0, "fee_cents": 200,
+                      "fees_charged": 1, "fees_refused": 3}
+
+@pytest.mark.parametrize("post", [bank_posting.post_cents, bank_posting.post_cents_loop])
+@pytest.mark.parametrize("rate", [0.01, 1e300])
+def test_interest_past_the_largest_balance_is_refused(post, rate):
+    posted, result = post([MAX - 5, MAX, 1000], bank_posting.Schedule(rate))
+    assert list(posted)[:2] == [MAX - 5, MAX]
+    assert result["interest_refused"] == (2 if rate < 1 else 3)
+
+def test_paths_agree_near_the_limit():
+    balances = [MAX // 2, MAX // 3, MAX - 10 ** 17, 1]
+    for rate in (0.5, 1.0, 2.0):
+        schedule = bank_posting.Schedule(rate, 1)
+        posted, result = bank_posting.post_cents(balances, schedule)
+        looped, looped_result = bank_posting.post_cents_loop(balances, schedule)
+        assert list(posted) == list(looped) and result == looped_result
+
+def test_post_reports_refused_interest(server):
+    store = bank_store.AccountStore()
+    store.add("ac-12345", "1324", MAX - 1)
+    store.add("wf-14351", "9834", 5000)
+    server.ALL_ACCOUNTS = store
+    result = json.loads(server.admin_post(["rate=0.5"]))
+    assert result["interest_refused"] == 1 and result["interest_cents"] == 2500
+    assert list(store.cents) == [MAX - 1, 7500]
+
+@pytest.mark.parametrize("backend", ["dict", "array"])
+def test_unwritable_snapshot_takes_the_posting_back(server, tmp_path, backend):
+    if backend == "array":
+        store = bank_store.AccountStore()
+        store.add("ac-12345", "1324", 10000)
+        store.add("wf-14351", "9834", 5000)
+        server.ALL_ACCOUNTS = store
+    server.journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), str(tmp_path / "gone" / "accounts.snap"))
+    try:
+        reply = server.admin_post(["rate=0.1", "fee=1"])
+    finally:
+        server.journal.close()
+    assert reply.startswith("could not post: the snapshot could not be written")
+    assert server.get_acct("ac-12345").acct_balance == 100.0
+    assert server.get_acct("wf-14351").acct_balance == 50.0
+
+def test_written_snapshot_commits_the_posting(server, tmp_path):
+    server.journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), str(tmp_path / "accounts.snap"))
+    try:
+        result = json.loads(server.admin_post(["rate=0.1"]))
+    finally:
+        server.journal.close()
+    assert result["interest_cents"] == 1500
+    assert server.get_acct("ac-12345").acct_balance == 110.0
+    assert (tmp_path / "accounts.snap").exists()
+
+def test_schedules_are_read_from_the_post_arguments():
+    schedule = bank_posting.parse_schedule(["rate=0.02", "FEE=1.5", "waive=1000"])
+    assert (schedule.rate, schedule.fee, schedule.waive_at) == (0.02, 150, 100000)
+    assert bank_posting.parse_schedule([]).fee == 0
+
+@pytest.mark.parametrize("args", [["rate"], ["rate=x"], ["rate=1", "rate=2"], ["bonus=1"], ["fee=-1"],
+                                  ["rate=nan"], ["fee=inf"]])
+def test_bad_schedules_are_refused(server, args):
+    assert server.admin_post(args).startswith("bad schedule: ")
+    assert server.get_acct("ac-12345").acct_balance == 100.0
+
+def test_watchers_are_pushed_the_posted_balance(server, connect):
+    watcher, peer = connect(framed=True)
+    server.process_msg("LOG ac-12345 1324", watcher)
+    server.process_msg("WATCH", watcher)
+    result = json.loads(server.admin_post(["fee=2", "waive=75"]))
+    assert (result["fees_charged"], result["fee_cents"]) == (1, 200)
+    server.commit_batch()
+    server.transaction(server.sel.get_key(watcher.conn), selectors.EVENT_WRITE)
+    # ac-12345 is past the waiver, so only wf-14351 pays the fee and the watcher is told nothing new
+    assert server.get_acct("wf-14351").acct_balance == 48.0
+    with pytest.raises(BlockingIOError):
+        peer.recv(100)
+    server.admin_post(["rate=0.5"])
+    server.commit_batch()
+    server.transaction(server.sel.get_key(watcher.conn), selectors.EVENT_WRITE)
+    assert peer.recv(100) == b"10:070 150.00"
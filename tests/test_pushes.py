@@ -0,0 +1,63 @@
+# A session that asked to WATCH its account is pushed its balance (070) when another session changes it. The push is
+# only sent once the change it reports has been committed, even when the watching connection is flushed in the same
+# batch as the request that made the change, and carries the balance with two decimals, as abnf.txt's amount has.
+# Legacy connections cannot tell a push from a reply, so they cannot WATCH.
+
+import selectors
+
+
+def log_in(server, connect, acct_num, pin):
+    # WATCH needs a framed connection
+    session, peer = connect(framed=True)
+    assert server.process_msg(f"LOG {acct_num} {pin}", session).startswith("040")
+    return server.sel.get_key(session.conn), peer
+
+def sent(peer):
+    try:
+        return peer.recv(4096)
+    except BlockingIOError:
+        return b""
+
+def test_push_waits_for_the_commit(server, connect):
+    watcher, watcher_peer = log_in(server, connect, "ac-12345", "1324")
+    sender, sender_peer = log_in(server, connect, "wf-14351", "9834")
+    assert server.process_msg("WATCH", watcher.data) == "100.0"
+    # A reply from an earlier batch is still waiting to be sent to the watcher
+    server.queue_reply(watcher.data, "100.0")
+    server.process_msg("TRANSFER ac-12345 5", sender.data)
+    server.transaction(watcher, selectors.EVENT_WRITE)
+    assert sent(watcher_peer) == b"5:100.0"
+    server.commit_batch()
+    server.transaction(watcher, selectors.EVENT_WRITE)
+    assert sent(watcher_peer) == b"10:070 105.00"
+
+def test_pushed_balance_has_two_decimals(server, connect):
+    server.ALL_ACCOUNTS["ac-12345"].acct_balance = 0.56
+    watcher, watcher_peer = log_in(server, connect, "ac-12345", "1324")
+    sender, sender_peer = log_in(server, connect, "wf-14351", "9834")
+    server.process_msg("WATCH", watcher.data)
+    # 0.56 + 5 is 5.5600000000000005 in floating point
+    server.process_msg("TRANSFER ac-12345 5", sender.data)
+    server.commit_batch()
+    server.transaction(watcher, selectors.EVENT_WRITE)
+    assert sent(watcher_peer) == b"8:070 5.56"
+
+def test_only_other_sessions_changes_are_pushed(server, connect):
+    watcher, watcher_peer = log_in(server, connect, "ac-12345", "1324")
+    sender, sender_peer = log_in(server, connect, "wf-14351", "9834")
+    server.process_msg("WATCH", watcher.data)
+    # The watcher's own deposit is answered with the balance already
+    server.process_msg("DEP 5", watcher.data)
+    server.commit_batch()
+    server.transaction(watcher, selectors.EVENT_WRITE)
+    assert sent(watcher_peer) == b""
+    assert server.process_msg("WATCH OFF", watcher.data) == "105.0"
+    server.process_msg("TRANSFER ac-12345 5", sender.data)
+    server.commit_batch()
+    server.transaction(watcher, selectors.EVENT_WRITE)
+    assert sent(watcher_peer) == b""
+
+def test_legacy_connections_cannot_watch(server, connect):
+    session, _ = connect(framed=False)
+    server.process_msg("LOG ac-12345 1324", session)
+    assert server.process_msg("WATCH", session) == "050"
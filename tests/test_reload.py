@@ -0,0 +1,115 @@
+# Edits made to the account file while the server was down are applied when it starts from a snapshot, before the
+# journal is replayed, and the next commit snapshots the new account set. Startup neither reads an account file the
+# snapshot is already in line with nor builds the snapshot's accounts to compare them. While serving, a changed
+# account file is applied a slice at a time between requests: accounts are added and removed and PINs changed, but
+# the balances of accounts already loaded are kept.
+
+import os
+
+import pytest
+
+import bank_accountfile
+import bank_journal
+import bank_server
+import bank_snapshot
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """ Paths of a snapshot holding ac-12345 and wf-14351, and of a journal and an account file for it, with hot
+    reload enabled and the server's account state put back afterwards. """
+    paths = {name: str(tmp_path / name) for name in ("accounts.txt", "accounts.journal", "accounts.snap")}
+    bank_snapshot.write_records(paths["accounts.snap"], 0, [("ac-12345", "1324", 10000), ("wf-14351", "9834", 5000)])
+    for name in ("ALL_ACCOUNTS", "journal", "reload_file", "reload_stamp", "reload_applied", "reload_checked",
+                 "reload_steps"):
+        monkeypatch.setattr(bank_server, name, getattr(bank_server, name))
+    bank_server.watch_account_file(paths["accounts.txt"], 60)
+    yield paths
+    if bank_server.journal is not None:
+        bank_server.journal.close()
+
+def test_startup_applies_edits_made_while_down(state):
+    with open(state["accounts.txt"], "w") as f:
+        f.write("ac-12345,4321,100.0\nqx-99999,1111,1.0\n")
+    # A deposit to the added account, journaled before the server went down
+    with open(state["accounts.journal"], "w") as f:
+        f.write(bank_journal.format_record(1, [("qx-99999", 75.0)]))
+    bank_server.load_durable_state(state["accounts.txt"], state["accounts.journal"], state["accounts.snap"])
+    assert bank_server.get_acct("ac-12345").acct_pin == "4321"
+    assert not bank_server.get_acct("wf-14351")
+    assert bank_server.get_acct("qx-99999").acct_balance == 75.0
+    assert bank_server.journal.needs_compaction()
+
+def test_startup_without_edits_needs_no_snapshot(state):
+    with open(state["accounts.txt"], "w") as f:
+        f.write("ac-12345,1324,100.0\nwf-14351,9834,50.0\n")
+    bank_server.load_durable_state(state["accounts.txt"], state["accounts.journal"], state["accounts.snap"])
+    assert bank_server.get_acct("wf-14351").acct_balance == 50.0
+    assert not bank_server.journal.needs_compaction()
+
+def test_startup_skips_an_account_file_the_snapshot_is_in_line_with(state, monkeypatch):
+    with open(state["accounts.txt"], "w") as f:
+        f.write("ac-12345,1324,100.0\nwf-14351,9834,50.0\n")
+    bank_server.watch_account_file(state["accounts.txt"], 60)
+    bank_server.load_durable_state(state["accounts.txt"], state["accounts.journal"], state["accounts.snap"])
+    bank_server.compact_journal()
+    bank_server.journal.close()
+    st = os.stat(state["accounts.txt"])
+    assert bank_snapshot.Snapshot(state["accounts.snap"]).source == (st.st_size, st.st_mtime_ns)
+    monkeypatch.setattr(bank_accountfile, "read_account_file", None)
+    bank_server.watch_account_file(state["accounts.txt"], 60)
+    bank_server.load_durable_state(state["accounts.txt"], state["accounts.journal"], state["accounts.snap"])
+    assert not bank_server.journal.needs_compaction()
+    assert dict.__len__(bank_server.ALL_ACCOUNTS) == 0
+
+def test_startup_only_builds_the_accounts_the_file_changes(state):
+    with open(state["accounts.txt"], "w") as f:
+        f.write("ac-12345,4321,100.0\nwf-14351,9834,50.0\n")
+    bank_server.load_durable_state(state["accounts.txt"], state["accounts.journal"], state["accounts.snap"])
+    assert list(dict.keys(bank_server.ALL_ACCOUNTS)) == ["ac-12345"]
+    assert bank_server.get_acct("ac-12345").acct_pin == "4321"
+
+@pytest.fixture
+def watched(server, tmp_path, monkeypatch):
+    """ An account file listing the server's two accounts, watched every second and applied one record per step. """
+    acct_file = tmp_path / "accounts.txt"
+    acct_file.write_text("ac-12345,1324,100.0\nwf-14351,9834,50.0\n")
+    for name in ("reload_file", "reload_interval", "reload_stamp", "reload_applied", "reload_checked",
+                 "reload_steps"):
+        monkeypatch.setattr(server, name, getattr(server, name))
+    monkeypatch.setattr(server, "RELOAD_SLICE", 1)
+    server.watch_account_file(str(acct_file), 1)
+    return acct_file
+
+def test_changes_are_applied_a_slice_at_a_time(server, connect, exchange, watched):
+    session, peer = connect()
+    assert exchange(session, peer, b"LOG wf-14351 9834") == b"040"
+    other, other_peer = connect()
+    assert exchange(other, other_peer, b"LOG ac-12345 1324") == b"040"
+    watched.write_text("ac-12345,4321,900.0\nqx-99999,1111,1.0\nzz-00001,2222,2.0\n")
+    now = server.reload_checked + 1
+    steps = 0
+    while server.step_reload(now):
+        steps += 1
+        # Requests are served in between
+        assert exchange(other, other_peer, b"BAL") == b"100.0"
+    assert steps > 2
+    assert server.get_acct("ac-12345").acct_pin == "4321"
+    assert server.get_acct("ac-12345").acct_balance == 100.0
+    assert server.get_acct("qx-99999").acct_balance == 1.0
+    assert not server.get_acct("wf-14351")
+    # The session logged in to the removed account is ended
+    assert session.conn.fileno() == -1
+    assert server.reload_applied == server.account_file_stamp()
+
+def test_unchanged_files_are_not_reread(server, watched, monkeypatch):
+    monkeypatch.setattr(bank_accountfile, "read_account_file", None)
+    assert not server.step_reload(server.reload_checked + 5)
+
+def test_an_emptied_file_removes_nothing(server, watched):
+    watched.write_text("# being rewritten\n")
+    assert server.admin_reload([]) == "reload started"
+    assert server.admin_reload([]) == "reload already in progress"
+    while server.step_reload(server.reload_checked):
+        pass
+    assert server.get_acct("ac-12345") and server.get_acct("wf-14351")
@@ -0,0 +1,45 @@
+# The session registry finds sessions by socket and by account in constant time: an account held by one session is
+# refused to every other (043, after which that connection is dropped) until the holder logs in elsewhere, exits or
+# disconnects.
+
+import selectors
+
+
+def test_an_account_is_held_by_one_session_at_a_time(server, connect, exchange):
+    first, first_peer = connect()
+    second, second_peer = connect()
+    assert exchange(first, first_peer, b"LOG ac-12345 1324") == b"040"
+    assert exchange(second, second_peer, b"LOG ac-12345 1324") == b"043"
+    assert server.sessions.by_acct["ac-12345"] is first
+    assert second.fd not in server.sessions.by_fd and second_peer.recv(16) == b""
+
+def test_logging_in_elsewhere_gives_the_account_up(server, connect, exchange):
+    first, first_peer = connect()
+    second, second_peer = connect()
+    exchange(first, first_peer, b"LOG ac-12345 1324")
+    assert exchange(first, first_peer, b"LOG wf-14351 9834") == b"040"
+    assert exchange(second, second_peer, b"LOG ac-12345 1324") == b"040"
+    assert server.sessions.by_acct == {"wf-14351": first, "ac-12345": second}
+
+def test_disconnecting_frees_the_account(server, connect, exchange):
+    first, first_peer = connect()
+    second, second_peer = connect()
+    exchange(first, first_peer, b"LOG ac-12345 1324")
+    first_peer.close()
+    server.read_requests(server.sel.get_key(first.conn))
+    assert first.fd not in server.sessions.by_fd and not server.sessions.by_acct
+    assert exchange(second, second_peer, b"LOG ac-12345 1324") == b"040"
+
+def test_exit_frees_the_account_once_its_replies_are_sent(server, connect, exchange):
+    first, first_peer = connect(framed=True)
+    exchange(first, first_peer, b"17:LOG ac-12345 1324")
+    first.outb += b"5:100.0"
+    server.process_requests(server.sel.get_key(first.conn))
+    first.inb += b"4:EXIT"
+    server.process_requests(server.sel.get_key(first.conn))
+    assert "ac-12345" not in server.sessions.by_acct
+    # Still open until the reply already queued has gone out
+    assert server.sel.get_key(first.conn).events & selectors.EVENT_WRITE
+    server.transaction(server.sel.get_key(first.conn), selectors.EVENT_WRITE)
+    assert first_peer.recv(64) == b"5:100.0"
+    assert first.conn.fileno() == -1
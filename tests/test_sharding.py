@@ -0,0 +1,95 @@
+# Each worker owns the accounts that hash to it. A connection logging in to an account another worker owns is
+# handed over to that worker, socket, unsent replies, pipelined requests and all, without waiting for room in the
+# worker's handoff socket. A connection that carries logical sessions cannot move: such a login is refused with 033,
+# and leaves the session logged in to the account it had.
+
+import os
+import selectors
+import socket
+
+import pytest
+
+
+@pytest.fixture
+def shard(server, monkeypatch):
+    """ The server as worker 0 of two, with two accounts it owns. Yields those and an account it does not own. """
+    monkeypatch.setattr(server, "shard_count", 2)
+    monkeypatch.setattr(server, "shard_id", 0)
+    candidates = [f"ac-{number:05d}" for number in range(10000, 10020)]
+    owned = [acct_num for acct_num in candidates if server.owns_account(acct_num)][:2]
+    foreign = next(acct_num for acct_num in candidates if not server.owns_account(acct_num))
+    monkeypatch.setattr(server, "ALL_ACCOUNTS",
+                        {acct_num: server.BankAccount(acct_num, "1324", 100.0) for acct_num in owned})
+    return owned, foreign
+
+def test_login_to_another_workers_account_keeps_the_session(server, connect, shard):
+    (mine, channel_acct), foreign = shard
+    session, peer = connect(framed=True)
+    assert server.process_msg(f"LOG {mine} 1324", session) == "040 100.0"
+    assert server.process_msg(f"@1 LOG {channel_acct} 1324", session) == "@1 040 100.0"
+    assert server.process_msg(f"LOG {foreign} 1324", session) == "033"
+    assert server.process_msg("BAL", session) == "100.0"
+    assert server.process_msg(f"@1 LOG {foreign} 1324", session) == "@1 033"
+    assert server.process_msg("@1 BAL", session) == "@1 100.0"
+    assert server.sessions.by_acct[mine] is session
+
+@pytest.fixture
+def inbox(server, shard, monkeypatch):
+    """ Worker 1's handoff socket, filled up: yields its receiving end, and the outbox worker 0 hands over on. """
+    send_end, recv_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    send_end.setblocking(False)
+    recv_end.setblocking(False)
+    outbox = server.ShardOutbox(send_end)
+    monkeypatch.setattr(server, "shard_inboxes", [None, outbox])
+    with pytest.raises(BlockingIOError):
+        while True:
+            send_end.send(b"x" * 1024)
+    yield recv_end, outbox
+    send_end.close()
+    recv_end.close()
+
+def test_handoff_to_a_full_inbox_waits_for_room(server, connect, shard, inbox):
+    _, foreign = shard
+    recv_end, outbox = inbox
+    session, peer = connect()
+    server.hand_off(server.sel.get_key(session.conn), [f"LOG {foreign} 1324"])
+    # Handed over as far as this worker is concerned, but not sent yet
+    assert session.fd not in server.sessions.by_fd
+    assert len(outbox.waiting) == 1
+    assert server.sel.get_key(outbox.sock).events == selectors.EVENT_WRITE
+    with pytest.raises(BlockingIOError):
+        while True:
+            recv_end.recv(4096)
+    server.send_handoffs(outbox)
+    assert not outbox.waiting and outbox.sock not in server.sel.get_map()
+    state, fds, _, _ = socket.recv_fds(recv_end, server.HANDOFF_MAX, 1)
+    assert state.endswith(f"LOG {foreign} 1324".encode()) and len(fds) == 1
+    os.close(fds[0])
+
+def test_accounts_are_split_between_the_workers(server, shard):
+    owners = {server.shard_of(f"ac-{number:05d}") for number in range(100)}
+    assert owners == {0, 1}
+    assert server.shard_file("accounts.journal") == "accounts.journal.0"
+
+def test_handed_over_connection_carries_on_at_the_owner(server, connect, shard, monkeypatch):
+    _, foreign = shard
+    send_end, recv_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    send_end.setblocking(False)
+    recv_end.setblocking(False)
+    monkeypatch.setattr(server, "shard_inboxes", [None, server.ShardOutbox(send_end)])
+    session, peer = connect(framed=True)
+    session.outb += b"3:050"
+    session.inb += f"{len(foreign) + 9}:LOG {foreign} 1324".encode() + b"3:BAL" + b"4:DE"
+    server.process_requests(server.sel.get_key(session.conn))
+    assert session.fd not in server.sessions.by_fd
+    # Now in the owning worker
+    server.shard_id = 1
+    server.ALL_ACCOUNTS = {foreign: server.BankAccount(foreign, "1324", 7.0)}
+    server.receive_handoff(recv_end)
+    (adopted,) = server.sessions.by_fd.values()
+    assert adopted.framed and adopted.inb == b"4:DE" and server.sessions.by_acct[foreign] is adopted
+    server.transaction(server.sel.get_key(adopted.conn), selectors.EVENT_WRITE)
+    assert peer.recv(64) == b"3:050" b"7:040 7.0" b"3:7.0"
+    adopted.conn.close()
+    send_end.close()
+    recv_end.close()
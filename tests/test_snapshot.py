@@ -0,0 +1,105 @@
+# Snapshots refuse records they cannot hold; a compaction is written in the background, and one that fails keeps
+# the journal instead of losing it.
+
+import os
+
+import pytest
+
+import bank_journal
+import bank_server
+import bank_snapshot
+import bank_store
+
+
+def test_pack_records_refuses_a_balance_beyond_int64():
+    with pytest.raises(ValueError, match="ac-12345"):
+        bank_snapshot.pack_records(0, [("ac-12345", "1324", 1 << 63)])
+
+def test_failed_compaction_keeps_the_journal(tmp_path, monkeypatch):
+    acct = bank_server.BankAccount("ac-12345", "1324", 100.0)
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", {"ac-12345": acct})
+    journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), str(tmp_path / "accounts.snap"), compact_every=1)
+    monkeypatch.setattr(bank_server, "journal", journal)
+    # Only a balance set behind the account's back can get this large
+    acct.acct_balance = 1e20
+    bank_server.record_balance(acct)
+    bank_server.commit_batch()
+    bank_server.finish_compaction(block=True)
+    journal.close()
+    assert not os.path.exists(tmp_path / "accounts.snap")
+    assert not os.path.exists(tmp_path / "accounts.journal.old")
+    records, _ = bank_journal.read_journal(str(tmp_path / "accounts.journal"), 0)
+    assert [changes for _, changes in records] == [[("ac-12345", 1e20)]]
+
+def test_compaction_runs_while_records_keep_coming(tmp_path, monkeypatch):
+    acct = bank_server.BankAccount("ac-12345", "1324", 100.0)
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", {"ac-12345": acct})
+    journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), str(tmp_path / "accounts.snap"), compact_every=1)
+    monkeypatch.setattr(bank_server, "journal", journal)
+    bank_server.deposit_req("ac-12345", "10")
+    bank_server.commit_batch()
+    assert journal.compacting()
+    # Committed while the snapshot is being written; it goes to the fresh journal
+    bank_server.deposit_req("ac-12345", "5")
+    journal.commit()
+    bank_server.finish_compaction(block=True)
+    journal.close()
+    assert not os.path.exists(tmp_path / "accounts.journal.old")
+    snapshot = bank_snapshot.Snapshot(str(tmp_path / "accounts.snap"))
+    assert (snapshot.journal_seq, snapshot.find("ac-12345")) == (1, ("ac-12345", "1324", 11000))
+    records, _ = bank_journal.read_journal(str(tmp_path / "accounts.journal"), snapshot.journal_seq)
+    assert records == [(2, [("ac-12345", 115.0)])]
+
+def test_startup_replays_a_rotated_journal_first(tmp_path, monkeypatch):
+    journal_file = str(tmp_path / "accounts.journal")
+    with open(journal_file + ".old", "w") as f:
+        f.write(bank_journal.format_record(1, [("ac-12345", 110.0)]))
+    with open(journal_file, "w") as f:
+        f.write(bank_journal.format_record(2, [("ac-12345", 115.0)]))
+    acct = bank_server.BankAccount("ac-12345", "1324", 100.0)
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", {"ac-12345": acct})
+    assert bank_server.replay_journal(journal_file, 0)[0] == 2
+    assert acct.acct_balance == 115.0
+    bank_journal.Journal(journal_file, str(tmp_path / "accounts.snap"), 2).close()
+    assert not os.path.exists(journal_file + ".old")
+    records, _ = bank_journal.read_journal(journal_file, 0)
+    assert [seq for seq, _ in records] == [1, 2]
+
+@pytest.mark.parametrize("backend", ["dict", "array"])
+def test_compaction_writes_from_a_copy_without_forking(tmp_path, monkeypatch, backend):
+    # A forked child could inherit a lock held by one of the server's threads
+    monkeypatch.setattr(os, "fork", None)
+    if backend == "array":
+        accounts = bank_store.AccountStore()
+        accounts.add("ac-12345", "1324", 10000)
+    else:
+        accounts = {"ac-12345": bank_server.BankAccount("ac-12345", "1324", 100.0)}
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", accounts)
+    journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), str(tmp_path / "accounts.snap"), compact_every=1)
+    monkeypatch.setattr(bank_server, "journal", journal)
+    bank_server.deposit_req("ac-12345", "10")
+    bank_server.commit_batch()
+    # Changed before the writer is done, after it was started: not in the snapshot
+    bank_server.get_acct("ac-12345").acct_balance = 1.0
+    bank_server.finish_compaction(block=True)
+    journal.close()
+    snapshot = bank_snapshot.Snapshot(str(tmp_path / "accounts.snap"))
+    assert snapshot.find("ac-12345") == ("ac-12345", "1324", 11000)
+
+def test_compaction_leaves_snapshot_accounts_unbuilt(tmp_path, monkeypatch):
+    snapshot_file = str(tmp_path / "accounts.snap")
+    bank_snapshot.write_records(snapshot_file, 0, [("ac-12345", "1324", 10000), ("wf-14351", "9834", 5000),
+                                                   ("zz-00001", "1111", 100)])
+    accounts = bank_snapshot.SnapshotAccounts(bank_snapshot.Snapshot(snapshot_file), bank_server.make_account)
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", accounts)
+    del accounts["zz-00001"]
+    journal = bank_journal.Journal(str(tmp_path / "accounts.journal"), snapshot_file, compact_every=1)
+    monkeypatch.setattr(bank_server, "journal", journal)
+    # A compaction waits for as many records as there are accounts
+    for _ in range(2):
+        bank_server.deposit_req("ac-12345", "5")
+        bank_server.commit_batch()
+    bank_server.finish_compaction(block=True)
+    journal.close()
+    assert list(dict.keys(accounts)) == ["ac-12345"]
+    assert list(bank_snapshot.Snapshot(snapshot_file)) == [("ac-12345", "1324", 11000), ("wf-14351", "9834", 5000)]
@@ -0,0 +1,63 @@
+# A snapshot is mapped, not parsed: an account is found by binary search over its sorted records, and a
+# SnapshotAccounts builds an account object only when that account is first used. Hashed PINs widen every record,
+# and version 1 snapshots, written before the account file stamp was added, are still read.
+
+import struct
+
+import pytest
+
+import bank_pins
+import bank_server
+import bank_snapshot
+
+
+@pytest.fixture
+def snapshot_file(tmp_path):
+    """ The path of a snapshot converted from an account file with three accounts, one of them with a bad line. """
+    acct_file = tmp_path / "accounts.txt"
+    acct_file.write_text("# Columns are: account number, pin, balance\n"
+                         "wf-14351, 9834, 50.00\nAC-12345, 1324, 100.25\nzz-1, 1111, 1.00\nbc-01373, 1234, 0.5\n")
+    path = str(tmp_path / "accounts.snap")
+    assert bank_snapshot.convert(str(acct_file), path) == 3
+    return path
+
+def test_accounts_are_found_by_number(snapshot_file):
+    snapshot = bank_snapshot.Snapshot(snapshot_file)
+    assert list(snapshot) == [("ac-12345", "1324", 10025), ("bc-01373", "1234", 50), ("wf-14351", "9834", 5000)]
+    assert snapshot.find("wf-14351") == ("wf-14351", "9834", 5000)
+    assert snapshot.find("aa-00000") is None and snapshot.find("zz-99999") is None
+
+def test_accounts_are_built_on_first_use(snapshot_file):
+    accounts = bank_snapshot.SnapshotAccounts(bank_snapshot.Snapshot(snapshot_file), bank_server.make_account)
+    assert len(accounts) == 3 and dict.__len__(accounts) == 0
+    assert accounts["bc-01373"].acct_balance == 0.5
+    assert "wf-14351" in accounts and "zz-99999" not in accounts
+    assert list(dict.keys(accounts)) == ["bc-01373"]
+    del accounts["wf-14351"]
+    assert "wf-14351" not in accounts and len(accounts) == 2
+    assert sorted(accounts) == ["ac-12345", "bc-01373"]
+
+def test_hashed_pins_widen_every_record(tmp_path):
+    path = str(tmp_path / "accounts.snap")
+    pin_hash = bank_pins.hash_pin("1324", iterations=1)
+    bank_snapshot.write_records(path, 7, [("ac-12345", pin_hash, 100), ("wf-14351", "9834", 5000)])
+    snapshot = bank_snapshot.Snapshot(path)
+    assert snapshot.layout is bank_snapshot.WIDE_RECORD and snapshot.journal_seq == 7
+    assert list(snapshot) == [("ac-12345", pin_hash, 100), ("wf-14351", "9834", 5000)]
+
+def test_version_1_snapshots_are_read(tmp_path):
+    path = tmp_path / "accounts.snap"
+    record = bank_snapshot.RECORD
+    path.write_bytes(bank_snapshot.V1_HEADER.pack(bank_snapshot.MAGIC, 1, record.size, 1, 3) +
+                     record.pack(b"ac-12345", b"1324", 10000))
+    snapshot = bank_snapshot.Snapshot(str(path))
+    assert (snapshot.journal_seq, snapshot.source) == (3, None)
+    assert snapshot.find("ac-12345") == ("ac-12345", "1324", 10000)
+
+@pytest.mark.parametrize("data", [b"", b"NOTABANK" + bytes(100),
+                                  struct.pack("<8sIIQQQq", b"ACMEBNK1", 2, 20, 5, 0, 0, 0) + bytes(20)])
+def test_other_files_are_refused(tmp_path, data):
+    path = tmp_path / "accounts.snap"
+    path.write_bytes(data)
+    with pytest.raises(ValueError):
+        bank_snapshot.Snapshot(str(path))
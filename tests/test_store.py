@@ -0,0 +1,75 @@
+# The array-backed store keeps accounts in three parallel arrays, found through an open-addressing hash table, with
+# balances in integer cents. It stays a drop-in ALL_ACCOUNTS: lookups, additions and removals behave as the
+# dictionary's do, and the server's requests give the same replies on either.
+
+import random
+
+import pytest
+
+import bank_pins
+import bank_store
+
+
+def test_many_accounts_survive_growth_and_removal():
+    store = bank_store.AccountStore(capacity=4)
+    numbers = [f"{a}{b}-{n:05d}" for a in "abz" for b in "ayz" for n in (0, 1, 99999)]
+    for index, acct_num in enumerate(numbers):
+        store.add(acct_num, f"{index:04d}", index * 100)
+    random.Random(1).shuffle(numbers)
+    removed, kept = numbers[:10], numbers[10:]
+    for acct_num in removed:
+        del store[acct_num]
+    assert len(store) == len(kept) and sorted(store) == sorted(kept)
+    assert all(acct_num not in store for acct_num in removed)
+    for acct_num in kept:
+        view = store[acct_num]
+        assert view.acct_number == acct_num and view.acct_balance == int(view.acct_pin)
+    with pytest.raises(KeyError):
+        store.remove(removed[0])
+
+def test_adding_an_existing_account_overwrites_it():
+    store = bank_store.AccountStore()
+    store.add("ac-12345", "1324", 100)
+    store.add("ac-12345", "4321", 200)
+    assert len(store) == 1 and (store["ac-12345"].acct_pin, store["ac-12345"].acct_balance) == ("4321", 2.0)
+
+def test_pins_that_are_not_four_digits():
+    store = bank_store.AccountStore()
+    pin_hash = bank_pins.hash_pin("1324", iterations=1)
+    store.add("ac-12345", pin_hash, 0)
+    store.add("wf-14351", "12a4", 0)
+    assert store["ac-12345"].acct_pin == pin_hash
+    assert store["wf-14351"].acct_pin == ""
+    store["ac-12345"].acct_pin = "1324"
+    assert store["ac-12345"].acct_pin == "1324" and not store.pin_hashes
+
+@pytest.mark.parametrize("acct_num", ["ac12345", "AC-12345", "ac-1234"])
+def test_malformed_account_numbers_are_not_stored(acct_num):
+    store = bank_store.AccountStore()
+    with pytest.raises(KeyError):
+        store.add(acct_num, "1324", 0)
+    assert acct_num not in store and store.get(acct_num) is None
+
+def test_amounts_are_whole_cents():
+    store = bank_store.AccountStore()
+    store.add("ac-12345", "1324", 1000)
+    view = store["ac-12345"]
+    assert view.deposit(0.1)[1:] == ("020", 10.1)
+    assert view.withdraw(10.11)[1:] == ("022", 10.1)
+    assert view.withdraw(0.001)[1:] == ("021", 10.1)
+    assert view.withdraw(10.1)[1:] == ("020", 0.0)
+    assert store.cents[0] == 0
+
+def test_requests_give_the_same_replies_on_either_backend(server, connect):
+    msgs = ["DEP 10", "WD 1", "TRANSFER wf-14351 20", "WD 500", "BAL"]
+    replies = []
+    for backend in ("dict", "array"):
+        if backend == "array":
+            server.use_account_store()
+            server.ALL_ACCOUNTS.add("ac-12345", "1324", 10000)
+            server.ALL_ACCOUNTS.add("wf-14351", "9834", 5000)
+        session, _ = connect(framed=True)
+        server.process_msg("LOG ac-12345 1324", session)
+        replies.append([server.process_msg(msg, session) for msg in msgs] + [server.get_acct("wf-14351").acct_balance])
+        server.process_msg("EXIT", session)
+    assert replies[0] == replies[1] == ["110.0", "109.0", "89.0", "031", "89.0", 70.0]
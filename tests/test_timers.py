@@ -0,0 +1,85 @@
+# Silent connections are evicted by a timer wheel: one that has not logged in after login_timeout seconds, and a
+# logged-in one after idle_timeout seconds, releasing its account. A timer fires within a tick of its deadline, also
+# when the deadline is far enough ahead to be filed in a higher level of the wheel. Each accept event takes the whole
+# listen backlog, and connections beyond max_connections are closed at once.
+
+import socket
+
+import pytest
+
+import bank_timers
+
+
+@pytest.mark.parametrize("delay", [0.5, 5, 63, 64, 100, 4095, 4096, 300000])
+def test_timers_fire_within_a_tick_of_their_deadline(delay):
+    wheel = bank_timers.TimerWheel(1.0, 10.0, slots=64, levels=3)
+    wheel.schedule("a", 10.0 + delay)
+    fired_at = None
+    now = 10.0
+    while fired_at is None:
+        now += 1.0
+        if wheel.advance(now):
+            fired_at = now
+    assert 10.0 + delay <= fired_at < 10.0 + delay + 1.0
+    assert len(wheel) == 0
+
+def test_cancelled_and_rescheduled_timers():
+    wheel = bank_timers.TimerWheel(1.0, 0.0)
+    wheel.schedule("a", 5.0)
+    wheel.schedule("b", 5.0)
+    wheel.cancel("a")
+    wheel.schedule("b", 200.0)
+    assert wheel.advance(10.0) == [] and len(wheel) == 1
+    assert wheel.advance(200.0) == ["b"]
+    assert wheel.next_tick_in(200.25) == 0.75
+
+@pytest.fixture
+def timers(server, monkeypatch):
+    """ An idle timer wheel starting at time 0, with a 10 second login timeout and a 60 second idle timeout. """
+    monkeypatch.setattr(server, "login_timeout", 10)
+    monkeypatch.setattr(server, "idle_timeout", 60)
+    wheel = bank_timers.TimerWheel(server.TIMER_TICK, 0.0)
+    monkeypatch.setattr(server, "idle_timers", wheel)
+    return wheel
+
+def connect_at(server, connect, now):
+    session, peer = connect()
+    session.last_active = now
+    server.idle_timers.schedule(session, server.idle_deadline(session))
+    return session, peer
+
+def test_sessions_that_do_not_log_in_are_evicted(server, connect, timers):
+    session, peer = connect_at(server, connect, 0.0)
+    server.evict_idle_sessions(9.0)
+    assert session.conn.fileno() != -1
+    server.evict_idle_sessions(10.0)
+    assert session.conn.fileno() == -1 and len(server.sessions) == 0
+    assert peer.recv(10) == b""
+
+def test_logged_in_sessions_get_the_idle_timeout(server, connect, exchange, timers):
+    session, peer = connect_at(server, connect, 0.0)
+    assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    session.last_active = 5.0
+    server.evict_idle_sessions(30.0)
+    assert session.conn.fileno() != -1 and session in timers.where
+    server.evict_idle_sessions(65.0)
+    assert session.conn.fileno() == -1
+    # The account is free for the next login
+    other, other_peer = connect()
+    assert exchange(other, other_peer, b"LOG ac-12345 1324") == b"040"
+
+def test_accepts_drain_the_backlog_up_to_the_limit(server, monkeypatch):
+    monkeypatch.setattr(server, "max_connections", 2)
+    listener = socket.create_server(("127.0.0.1", 0))
+    listener.setblocking(False)
+    clients = [socket.create_connection(listener.getsockname()) for _ in range(3)]
+    try:
+        refused = server.metrics.refused
+        server.accept_wrapper(listener)
+        assert len(server.sessions) == 2 and server.metrics.refused == refused + 1
+        assert clients[2].recv(10) == b""
+    finally:
+        for sock in clients + [listener]:
+            sock.close()
+        for key in list(server.sel.get_map().values()):
+            key.fileobj.close()
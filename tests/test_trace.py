@@ -0,0 +1,66 @@
+# With capture on, every byte a client connection carries is recorded in a trace along with the connection's opening
+# and closing. Replaying the trace against a server in the state the capture started from gets the same replies; one
+# in another state is reported as mismatching.
+
+import socket
+import time
+
+import pytest
+
+import bank_trace
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+@pytest.fixture
+def trace(server, listening, tmp_path, monkeypatch):
+    """ Captures one ATM session against the listening server, puts the balances back as they were, and returns the
+    path of the trace. """
+    path = str(tmp_path / "session.trace")
+    monkeypatch.setattr(server, "capture", None)
+    server.start_capture(path)
+    with socket.create_connection(listening, timeout=5) as sock:
+        for request in (b"LOG ac-12345 1324", b"DEP 25", b"BAL"):
+            sock.sendall(request)
+            sock.recv(64)
+    wait_for(lambda: len(server.sessions) == 0)
+    capture, server.capture = server.capture, None
+    capture.close()
+    server.get_acct("ac-12345").acct_balance = 100.0
+    return path
+
+def test_captures_record_both_directions(trace):
+    records = bank_trace.read_trace(trace)
+    assert [(kind, payload) for _, _, kind, payload in records] == [
+        (bank_trace.OPEN, b""), (bank_trace.IN, b"LOG ac-12345 1324"), (bank_trace.OUT, b"040"),
+        (bank_trace.IN, b"DEP 25"), (bank_trace.OUT, b"125.0"), (bank_trace.IN, b"BAL"), (bank_trace.OUT, b"125.0"),
+        (bank_trace.CLOSE, b"")]
+    times = [when for when, _, _, _ in records]
+    assert times == sorted(times) and len({conn_id for _, conn_id, _, _ in records}) == 1
+
+def test_replays_from_the_same_state_match(server, listening, trace):
+    replay = bank_trace.Replay(bank_trace.read_trace(trace), listening, 0, 5)
+    replay.run()
+    assert (replay.requests, replay.replies, replay.mismatched, replay.missing) == (3, 3, 0, 0)
+    assert len(replay.replayed_latency) == 3
+
+def test_replays_from_another_state_mismatch(server, listening, trace):
+    server.get_acct("ac-12345").acct_balance = 500.0
+    replay = bank_trace.Replay(bank_trace.read_trace(trace), listening, 0, 5)
+    replay.run()
+    assert (replay.mismatched, replay.missing) == (2, 0) and replay.examples[0][1:] == (b"125.0", b"525.0")
+
+def test_torn_records_are_dropped(trace):
+    with open(trace, "rb") as f:
+        data = f.read()
+    with open(trace, "wb") as f:
+        f.write(data[:-1])
+    assert len(bank_trace.read_trace(trace)) == 7
+    with open(trace, "wb") as f:
+        f.write(b"BKTR\x09")
+    with pytest.raises(ValueError):
+        bank_trace.read_trace(trace)
@@ -0,0 +1,61 @@
+# Each stage of a request is timed into the STATS report. With a slow request threshold set, a request whose reply
+# goes out later than that after its read is logged with the time each stage took, naming the request without its
+# amounts or PIN. The profiler can be started and stopped while the server runs.
+
+import json
+import logging
+import os
+
+import pytest
+
+
+@pytest.fixture
+def slow(server, monkeypatch):
+    """ Logs every request as slow. """
+    monkeypatch.setattr(server, "slow_request", server.slow_request)
+    assert server.admin_slow(["1e-9"]) == "requests slower than 1e-09 s are logged"
+    return server
+
+def test_slow_requests_are_logged_with_their_stages(slow, connect, exchange, caplog):
+    session, peer = connect()
+    with caplog.at_level(logging.WARNING, logger="bank_server"):
+        assert exchange(session, peer, b"LOG ac-12345 1324") == b"040"
+    [record] = caplog.records
+    message = record.getMessage()
+    assert message.startswith("Slow request LOG from ") and "1324" not in message
+    for stage in ("read", "parse", "handle", "commit", "send", "waiting"):
+        assert f" {stage} " in message
+    assert not session.traces and not slow.untimed_commits
+
+def test_stages_are_timed_into_stats(server, connect, exchange):
+    session, peer = connect()
+    before = server.metrics.stages["handle"].count()
+    exchange(session, peer, b"LOG ac-12345 1324")
+    assert server.metrics.stages["handle"].count() == before + 1
+    assert "handle" in json.loads(server.admin_reply("STATS"))["stages"]
+
+def test_requests_are_labelled_without_their_arguments(server):
+    assert server.request_label("@7 TRANSFER wf-14351 5") == "@7 TRANSFER"
+    assert server.request_label("DEP 5") == "DEP"
+    assert server.request_label(None) == "malformed"
+
+@pytest.mark.parametrize("args", [["-1"], ["x"], ["1", "2"], ["nan"]])
+def test_bad_thresholds_are_refused(slow, args):
+    assert slow.admin_slow(args) == "usage: SLOW [SECONDS]"
+    assert slow.slow_request == 1e-9
+    assert slow.admin_slow(["0"]) == "slow requests are not logged"
+
+def test_profiles_are_written_on_stop(server, tmp_path):
+    path = str(tmp_path / "server.prof")
+    assert server.admin_profile([]) == "profiler not running"
+    assert server.admin_profile(["start"]) == "profiling started"
+    try:
+        assert server.admin_profile(["START"]) == "profiler already running"
+        assert server.admin_profile(["STOP", str(tmp_path / "gone" / "server.prof")]).startswith(
+            "could not write the profile")
+        assert server.admin_profile([]) == "profiler running"
+    finally:
+        summary = server.admin_profile(["STOP", path])
+    assert summary.startswith("profile of ") and os.path.getsize(path) > 0
+    assert server.admin_profile(["STOP"]) == "profiler not running"
+    assert server.admin_profile(["RESTART"]) == "usage: PROFILE [START | STOP [FILE]]"